@@ -25,7 +25,7 @@ module Aircraft
 
     import JSON
 
-    @time params = load_params(PARAMS_DIR, PARAMS_FILENAME)
+    @time params = load_params(PARAMS_DIR, PARAMS_FILENAME, PARAMS_TABLE_CACHE_DIR)
 
     include("standardised_code/stm.jl")
     include("standardised_code/trm.jl")
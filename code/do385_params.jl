@@ -5,4 +5,8 @@ Parameter file for anything STATIC and SHARED across the main code and the Aircr
 """
 
 PARAMS_DIR = "do385_data/"
-PARAMS_FILENAME = "DO-385_parameter_file.txt"
\ No newline at end of file
+PARAMS_FILENAME = "DO-385_parameter_file.txt"
+
+# Directory of pre-decoded tables written by tools/do385_tables.py, which are
+# memory-mapped rather than decoded at startup. Leave empty to decode the dat files.
+PARAMS_TABLE_CACHE_DIR = ""
\ No newline at end of file
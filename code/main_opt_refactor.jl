@@ -1,38 +1,9 @@
 workspace()
 
-import JSON
-
-cd("/acasx/code/")
-
-include("logger.jl")
-include("utilities.jl")
-
-include("standardised_code/structures.jl")
-include("standardised_code/math_utils.jl")
-include("standardised_code/global_constants.jl")
-
-include("aircraft.jl")
-include("simulator_helpers.jl")
-include("optimise_helpers.jl")
-
-include("experiment_datastructs.jl")
-include("data_export.jl")
-
-include("simulator_core.jl")
-
-include("tests/tests.jl")
-include("tests/test_encounter.jl")
-include("tests/test_run.jl")
-
-include("experiment_tools.jl")
-include("opensky_tools.jl")
-
-include("run_handler.jl")
-include("optimisation_handler.jl")
+include("simulator_includes.jl")
 
 
 #import LoggerTool
-import Aircraft
 
 #import LoggerTool
 
@@ -68,10 +39,23 @@ mkpath(PARAM_COSTS_MAP_FILEPATH)
 
 global SIMULATOR_MODE = parsed_args["sim_mode"]
 
+if PARAM_OPTIMISER_WORKERS > 1 && SIMULATOR_MODE in [3, 4]
+    setup_optimiser_workers(PARAM_OPTIMISER_WORKERS, parsed_args["params_file"])
+end
+
 if parsed_args["test_mode"] == true
     trajectory_list = PARAM_TEST_TRAJECTORY_LIST
+elseif PARAM_TRAJECTORY_LIST_FILE != ""
+    trajectory_list = load_trajectory_list(PARAM_TRAJECTORY_LIST_FILE)
 else
-    dir_list = readdir(PARAM_TRAJECTORY_FILEPATH)
+    # Sharded trajectory directories (see tools/flight_manifest.py) list
+    # their trajectories in a manifest, which is also quicker than readdir
+    manifest_filename = joinpath(PARAM_TRAJECTORY_FILEPATH, TRAJECTORY_MANIFEST_FILENAME)
+    if isfile(manifest_filename)
+        dir_list = load_trajectory_list(manifest_filename)
+    else
+        dir_list = readdir(PARAM_TRAJECTORY_FILEPATH)
+    end
     trajectory_indices = trajectory_selector(dir_list)
     trajectory_list = dir_list[trajectory_indices]
 end
@@ -106,7 +106,7 @@ function trajectory_optimiser(
         start_strategy = 0
         
         try
-            traj_json = JSON.parsefile(filename)
+            traj_json = load_trajectory_json(filename)
 #            println(traj_json)
 
             #Randomise our start strategy if param is set
@@ -197,36 +197,22 @@ function trajectory_optimiser(
                 #This allows us to log the best run data on each run
                 iter_state_logs = Dict{Any, Any}()
 
-                # For each strategy
-                #println("STRATS")
-                #println(keys(opt_strategies))
-                for strategy_key in keys(opt_strategies) # Gives (k,v)
-                    #println("KEY $(strategy_key)")
-                    strategy = opt_strategies[strategy_key]
-                    run_results = 0
-                    if grid_mode == true
-                        run_results = optimise_run(
-                            trajectory_filename,
-                            strategy,
-                            traj_json,
-                            discretes,
-                            grid_mode,
-                            attacker_lat,
-                            attacker_lon
-                            )
-                    else
-                        run_results = optimise_run(
-                            trajectory_filename,
-                            strategy,
-                            traj_json,
-                            discretes)
-                    end
-
-
-
-                    costs[strategy_key] = run_results["costs"]
-                    if run_results["state_logs"] != -1
-                        iter_state_logs[strategy_key] = run_results["state_logs"]
+                # Simulate every strategy in the neighbourhood - in parallel
+                # if workers are set up. Selection below stays in this
+                # process, so the seeded RNGs are used in the same order
+                run_results = optimise_run_batch(
+                    trajectory_filename,
+                    opt_strategies,
+                    traj_json,
+                    discretes,
+                    grid_mode,
+                    attacker_lat,
+                    attacker_lon)
+
+                for strategy_key in keys(opt_strategies)
+                    costs[strategy_key] = run_results[strategy_key]["costs"]
+                    if run_results[strategy_key]["state_logs"] != -1
+                        iter_state_logs[strategy_key] = run_results[strategy_key]["state_logs"]
                     end
                 end
                 #println("Max Cost")
@@ -253,7 +239,7 @@ function trajectory_optimiser(
                     dump_logs_opt(
                         iter_state_logs[max_key], 
                         PARAM_LOGS_FILEPATH, 
-                        trajectory_filename[1:end-5], 
+                        trajectory_basename(trajectory_filename), 
                         opt_strategies[max_key])
                 end
 
@@ -344,36 +330,36 @@ function trajectory_optimiser(
                 #println("Logging")
                 #println(overall_best_statelog)
                 log_costs(PARAM_COSTS_FILEPATH, 
-                            "$(trajectory_filename[1:end-5])-$(grid_id)", 
+                            "$(trajectory_basename(trajectory_filename))-$(grid_id)", 
                             costs_log, 
                             start_cost,
                             overall_best_cost,
                             overall_best_strategy)
                 log_strategies(PARAM_STRATS_FILEPATH,
-                                "$(trajectory_filename[1:end-5])-$(grid_id)", 
+                                "$(trajectory_basename(trajectory_filename))-$(grid_id)", 
                                 strategy_log)
                 #if overall_best_statelog != 0                                
                 dump_logs_opt(overall_best_statelog, 
                                 PARAM_LOGS_FILEPATH, 
-                                "$(trajectory_filename[1:end-5])-$(grid_id)", 
+                                "$(trajectory_basename(trajectory_filename))-$(grid_id)", 
                                 overall_best_strategy)
                 #end
             else 
                 log_costs(
                     PARAM_COSTS_FILEPATH, 
-                    trajectory_filename[1:end-5], 
+                    trajectory_basename(trajectory_filename), 
                     costs_log, 
                     start_cost,
                     overall_best_cost,
                     overall_best_strategy)
                 log_strategies(
                     PARAM_STRATS_FILEPATH,
-                    trajectory_filename[1:end-5], 
+                    trajectory_basename(trajectory_filename), 
                     strategy_log)
                 dump_logs_opt(
                     overall_best_statelog, 
                     PARAM_LOGS_FILEPATH, 
-                    trajectory_filename[1:end-5], 
+                    trajectory_basename(trajectory_filename), 
                     overall_best_strategy)
             end
             #println("Best cost for $(dir_list[i]) is $(overall_best_cost)")
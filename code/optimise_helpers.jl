@@ -94,7 +94,7 @@ function initialisation_run(
         dump_logs(
             ac, 
             PARAM_LOGS_FILEPATH, 
-            trajectory_filename[1:end-5], 
+            trajectory_basename(trajectory_filename), 
             strategy)
 
         current_best_cost = calculate_run_cost(ac.state_log, 1)
@@ -201,7 +201,7 @@ function optimise_run(
             dump_logs(
                 ac, 
                 PARAM_LOGS_FILEPATH, 
-                trajectory_filename[1:end-5], 
+                trajectory_basename(trajectory_filename), 
                 strategy)
         end
         #println("Run finished")
@@ -214,6 +214,68 @@ function optimise_run(
     return return_dict
 end
 
+function optimise_run_batch(
+    trajectory_filename,
+    strategies,
+    trajectory,
+    discretes,
+    grid_mode = false,
+    attacker_lat = -1,
+    attacker_lon = -1
+)
+    """
+    Runs optimise_run for every strategy in an iteration's neighbourhood. If optimiser workers have been started, the strategies are spread across them and this waits for all of them to finish.
+
+    Parameters
+    ----------
+    trajectory_filename : string
+        Filename/descriptor for the trajectory
+    strategies : Dict
+        The strategies to run, keyed by strategy name
+    trajectory : Dict
+        The trajectory to run the simulation on
+    discretes : OwnDiscreteData
+        Standard ownship discretes
+    grid_mode : bool
+        Whether we are using the attacker grid mode or not 
+    attacker_lat : float
+        Latitude of the attacker
+    attacker_lon : float
+        Longitude of the attacker
+
+    Returns
+    -------
+    results : Dict
+        optimise_run results, keyed by strategy name
+    """
+    strategy_keys = collect(keys(strategies))
+
+    run_strategy(strategy_key) = optimise_run(
+        trajectory_filename,
+        strategies[strategy_key],
+        trajectory,
+        discretes,
+        grid_mode,
+        attacker_lat,
+        attacker_lon)
+
+    if nprocs() > 1
+        run_results = pmap(run_strategy, strategy_keys, err_retry=false)
+    else
+        run_results = map(run_strategy, strategy_keys)
+    end
+
+    results = Dict{Any, Any}()
+    for (strategy_key, run_result) in zip(strategy_keys, run_results)
+        # pmap returns errors rather than raising them - raise them here, as a serial run would
+        if isa(run_result, Exception)
+            throw(run_result)
+        end
+        results[strategy_key] = run_result
+    end
+    return results
+end
+
 function starting_strategy_generator(
     strategy_selection_rng
 )
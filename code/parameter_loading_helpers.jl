@@ -10,7 +10,7 @@ import JSON
 # end
 
 
-function load_params(parameter_directory::String, filename::String)
+function load_params(parameter_directory::String, filename::String, table_cache_dir::String="")
     """
     Takes the directory containing the parameters and data files and 
     loads all of them, handling any value replacements which need to be done
@@ -21,78 +21,242 @@ function load_params(parameter_directory::String, filename::String)
             Directory containing all the parameter and data files
         filename - String
             Filename of the DO_385 parameters file to load.
+        table_cache_dir - String
+            Directory of pre-decoded tables written by tools/do385_tables.py, or "" to decode the dat files
     """
 
     LoggerTool.info(logger, "Loading Params...")
     params = JSON.parsefile(string(parameter_directory, filename))
     params = replace_malformed_json(params)
+    table_cache = load_table_cache(table_cache_dir)
 
-    params["modes"][1]["state_estimation"]["tau"]["entry_dist"]["vertical_table_content"] = read_dat_file(
-        string(
-            parameter_directory, 
-            params["modes"][1]["state_estimation"]["tau"]["entry_dist"]["vertical_table"]
-        )
+    params["modes"][1]["state_estimation"]["tau"]["entry_dist"]["vertical_table_content"] = load_dat_table(
+        read_dat_file,
+        parameter_directory, 
+        params["modes"][1]["state_estimation"]["tau"]["entry_dist"]["vertical_table"],
+        table_cache
     )
 
-    params["modes"][1]["state_estimation"]["tau"]["entry_dist"]["horizontal_table_content"] = read_dat_file(
-        string(
-            parameter_directory, 
-            params["modes"][1]["state_estimation"]["tau"]["entry_dist"]["horizontal_table"]
-        )
+    params["modes"][1]["state_estimation"]["tau"]["entry_dist"]["horizontal_table_content"] = load_dat_table(
+        read_dat_file,
+        parameter_directory, 
+        params["modes"][1]["state_estimation"]["tau"]["entry_dist"]["horizontal_table"],
+        table_cache
     )
 
-    params["modes"][1]["state_estimation"]["tau"]["entry_dist"]["horizontal_active_table_content"] = read_dat_file(
-        string(
-            parameter_directory, 
-            params["modes"][1]["state_estimation"]["tau"]["entry_dist"]["horizontal_active_table"]
-        )
+    params["modes"][1]["state_estimation"]["tau"]["entry_dist"]["horizontal_active_table_content"] = load_dat_table(
+        read_dat_file,
+        parameter_directory, 
+        params["modes"][1]["state_estimation"]["tau"]["entry_dist"]["horizontal_active_table"],
+        table_cache
     )
 
-    params["modes"][1]["cost_estimation"]["offline"]["origami"]["equiv_class_table_content"] = read_cost_dat_file(
-        string(
-            parameter_directory, 
-            params["modes"][1]["cost_estimation"]["offline"]["origami"]["equiv_class_table"]
-        )
+    params["modes"][1]["cost_estimation"]["offline"]["origami"]["equiv_class_table_content"] = load_dat_table(
+        read_cost_dat_file,
+        parameter_directory, 
+        params["modes"][1]["cost_estimation"]["offline"]["origami"]["equiv_class_table"],
+        table_cache
     )
 
-    params["modes"][1]["cost_estimation"]["offline"]["origami"]["minblocks_table_content"] = read_minblocks_dat_file(
-        string(
-            parameter_directory, 
-            params["modes"][1]["cost_estimation"]["offline"]["origami"]["minblocks_table"]
-        )
+    params["modes"][1]["cost_estimation"]["offline"]["origami"]["minblocks_table_content"] = load_dat_table(
+        read_minblocks_dat_file,
+        parameter_directory, 
+        params["modes"][1]["cost_estimation"]["offline"]["origami"]["minblocks_table"],
+        table_cache
     )
 
-    params["modes"][2]["state_estimation"]["tau"]["entry_dist"]["vertical_table_content"] = read_dat_file(
-        string(
-            parameter_directory, 
-            params["modes"][2]["state_estimation"]["tau"]["entry_dist"]["vertical_table"]
-        )
+    params["modes"][2]["state_estimation"]["tau"]["entry_dist"]["vertical_table_content"] = load_dat_table(
+        read_dat_file,
+        parameter_directory, 
+        params["modes"][2]["state_estimation"]["tau"]["entry_dist"]["vertical_table"],
+        table_cache
     )
 
-    params["modes"][2]["state_estimation"]["tau"]["entry_dist"]["horizontal_table_content"] = read_dat_file(
-        string(
-            parameter_directory, 
-            params["modes"][2]["state_estimation"]["tau"]["entry_dist"]["horizontal_table"]
-        )
+    params["modes"][2]["state_estimation"]["tau"]["entry_dist"]["horizontal_table_content"] = load_dat_table(
+        read_dat_file,
+        parameter_directory, 
+        params["modes"][2]["state_estimation"]["tau"]["entry_dist"]["horizontal_table"],
+        table_cache
     )
 
-    params["modes"][2]["state_estimation"]["tau"]["entry_dist"]["horizontal_active_table_content"] = read_dat_file(
-        string(
-            parameter_directory, 
-            params["modes"][2]["state_estimation"]["tau"]["entry_dist"]["horizontal_active_table"]
-        )
+    params["modes"][2]["state_estimation"]["tau"]["entry_dist"]["horizontal_active_table_content"] = load_dat_table(
+        read_dat_file,
+        parameter_directory, 
+        params["modes"][2]["state_estimation"]["tau"]["entry_dist"]["horizontal_active_table"],
+        table_cache
     )
 
     
     #params["modes"][2]["cost_estimation"]["offline"]["origami"]["equiv_class_table_content"] = read_cost_dat_file(params["modes"][2]["cost_estimation"]["offline"]["origami"]["equiv_class_table"])
-    params["modes"][2]["cost_estimation"]["offline"]["origami"]["equiv_class_table_content"] = deepcopy(params["modes"][1]["cost_estimation"]["offline"]["origami"]["equiv_class_table_content"])
-
     #params["modes"][2]["cost_estimation"]["offline"]["origami"]["minblocks_table_content"] = read_minblocks_dat_file(params["modes"][2]["cost_estimation"]["offline"]["origami"]["minblocks_table"])
-    params["modes"][2]["cost_estimation"]["offline"]["origami"]["minblocks_table_content"] = deepcopy(params["modes"][1]["cost_estimation"]["offline"]["origami"]["minblocks_table_content"])
+    mode_1_origami = params["modes"][1]["cost_estimation"]["offline"]["origami"]
+    mode_2_origami = params["modes"][2]["cost_estimation"]["offline"]["origami"]
+
+    # Cached tables are memory-mapped, so mapping them again for mode 2 is
+    # cheaper than copying, and the OS shares the pages between them
+    equiv_class_tables = cached_dat_tables(parameter_directory, mode_1_origami["equiv_class_table"], table_cache)
+    minblocks_tables = cached_dat_tables(parameter_directory, mode_1_origami["minblocks_table"], table_cache)
+    if equiv_class_tables != nothing && minblocks_tables != nothing
+        mode_2_origami["equiv_class_table_content"] = equiv_class_tables
+        mode_2_origami["minblocks_table_content"] = minblocks_tables[1]
+    else
+        mode_2_origami["equiv_class_table_content"] = deepcopy(mode_1_origami["equiv_class_table_content"])
+        mode_2_origami["minblocks_table_content"] = deepcopy(mode_1_origami["minblocks_table_content"])
+    end
 
     return params
 end
 
+# Cache layout version written by tools/do385_tables.py - caches of any other
+# version are ignored
+const TABLE_CACHE_VERSION = 1
+
+# numpy dtype strings for the types stored in the table cache
+const NPY_TYPES = {"|u1" => Uint8, "<u4" => Uint32, "<f2" => Float16, "<f8" => Float64}
+
+function load_table_cache(table_cache_dir::String)
+    """
+    Loads the index of a table cache written by tools/do385_tables.py.
+
+    Parameters
+    ----------
+        table_cache_dir : String
+            Cache directory, or "" if no cache is in use
+
+    Returns
+    -------
+        Dict
+            The cache index, with its directory under "path", or nothing if there is no usable cache
+    """
+    if table_cache_dir == ""
+        return nothing
+    end
+
+    cache_path = joinpath(table_cache_dir, "v$(TABLE_CACHE_VERSION)")
+    index_file = joinpath(cache_path, "index.json")
+    if !isfile(index_file)
+        LoggerTool.warn(logger, "No version $(TABLE_CACHE_VERSION) table cache in $(table_cache_dir), decoding dat files instead.")
+        return nothing
+    end
+
+    table_cache = JSON.parsefile(index_file)
+    table_cache["path"] = cache_path
+    return table_cache
+end
+
+function read_npy_array(file_name::String)
+    """
+    Memory-maps a one dimensional array saved by numpy.save.
+
+    Parameters
+    ----------
+        file_name : String
+            Path to the .npy file
+
+    Returns
+    -------
+        Array
+            The array, mapped read-only from the file
+    """
+    file_handle = open(file_name)
+    magic = readbytes(file_handle, 6)
+    if magic != [0x93, uint8('N'), uint8('U'), uint8('M'), uint8('P'), uint8('Y')]
+        error("$(file_name) is not a .npy file")
+    end
+
+    major_version = read(file_handle, Uint8)
+    minor_version = read(file_handle, Uint8)
+    if major_version == 1
+        header_len = int(read(file_handle, Uint16))
+    else
+        header_len = int(read(file_handle, Uint32))
+    end
+    header = bytestring(readbytes(file_handle, header_len))
+
+    element_type = NPY_TYPES[match(r"'descr':\s*'([^']*)'", header).captures[1]]
+    shape = match(r"'shape':\s*\((\d*),?\)", header).captures[1]
+    element_count = shape == "" ? 1 : int(shape)
+
+    if element_count == 0
+        close(file_handle)
+        return Array(element_type, 0)
+    end
+    return mmap_array(element_type, (element_count,), file_handle, position(file_handle))
+end
+
+function cached_dat_tables(parameter_directory::String, table_filename::String, table_cache)
+    """
+    Loads a dat file's tables from the table cache, if it holds an up to date copy.
+
+    Parameters
+    ----------
+        parameter_directory : String
+            Directory containing the dat files
+        table_filename : String
+            Dat filename, as named in the DO-385 parameter file
+        table_cache : Dict
+            Cache index, as returned by load_table_cache, or nothing
+
+    Returns
+    -------
+        tables : RDataTable[]
+            The cached tables, or nothing if they aren't cached or the dat file has changed since
+    """
+    if table_cache == nothing || !haskey(table_cache["sources"], table_filename)
+        return nothing
+    end
+
+    entry = table_cache["sources"][table_filename]
+    source = stat(string(parameter_directory, table_filename))
+    if source.size != entry["size"] || abs(source.mtime - entry["mtime"]) > 1
+        LoggerTool.warn(logger, "$(table_filename) has changed since it was cached, decoding it instead.")
+        return nothing
+    end
+
+    LoggerTool.info(logger, "Loading $(table_filename) from the table cache")
+
+    tables = RDataTable[]
+    for table in entry["tables"]
+        files = table["files"]
+        cuts = read_npy_array(joinpath(table_cache["path"], files["cuts"]))
+        index_data = haskey(files, "index") ? read_npy_array(joinpath(table_cache["path"], files["index"])) : Array(Uint32, 0)
+        main_data = haskey(files, "data") ? read_npy_array(joinpath(table_cache["path"], files["data"])) : nothing
+
+        names = String[i for i in table["names"]]
+        cut_counts = Int64[i for i in table["cut_counts"]]
+        push!(tables, RDataTable(names, cut_counts, cuts, index_data, main_data))
+    end
+    return tables
+end
+
+function load_dat_table(reader::Function, parameter_directory::String, table_filename::String, table_cache)
+    """
+    Loads a dat file from the table cache if possible, otherwise decoding it with reader.
+
+    Parameters
+    ----------
+        reader : Function
+            read_dat_file, read_minblocks_dat_file or read_cost_dat_file, whichever suits the file
+        parameter_directory : String
+            Directory containing the dat files
+        table_filename : String
+            Dat filename, as named in the DO-385 parameter file
+        table_cache : Dict
+            Cache index, as returned by load_table_cache, or nothing
+
+    Returns
+    -------
+        RDataTable, or RDataTable[] for read_cost_dat_file
+            The loaded table(s), as reader would return them
+    """
+    tables = cached_dat_tables(parameter_directory, table_filename, table_cache)
+    if tables == nothing
+        return reader(string(parameter_directory, table_filename))
+    elseif is(reader, read_cost_dat_file)
+        return tables
+    end
+    return tables[1]
+end
 
 
 function bytes2string(input::Array{Uint8,1})
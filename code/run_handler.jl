@@ -55,10 +55,10 @@ function run_trajectory_list(
 
         start_strategy = 0
 
-        traj_json = JSON.parsefile(filename)
+        traj_json = load_trajectory_json(filename)
 
         costs = run_strategy_list(
-            trajectory_name[1:end-5],
+            trajectory_basename(trajectory_name),
             traj_json,
             strategies,
             discretes
@@ -69,7 +69,7 @@ function run_trajectory_list(
         # trajectories 
         log_static_strategies(
             PARAM_STRATS_FILEPATH,
-            trajectory_name[1:end-5], 
+            trajectory_basename(trajectory_name), 
             values(strategies))
 
         best_cost = 0
@@ -83,7 +83,7 @@ function run_trajectory_list(
         
         log_costs(
             PARAM_COSTS_FILEPATH, 
-            trajectory_name[1:end-5], 
+            trajectory_basename(trajectory_name), 
             costs, 
             0,
             best_cost,
@@ -92,7 +92,7 @@ function run_trajectory_list(
         # TODO  Add if sim mode == 5 here
         log_cost_map(
             PARAM_COSTS_MAP_FILEPATH,
-            trajectory_name[1:end-5], 
+            trajectory_basename(trajectory_name), 
             costs)
     end
 
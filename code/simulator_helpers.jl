@@ -40,4 +40,103 @@ function trajectory_selector(dir_list)
     LoggerTool.info(logger, "Selected $(length(trajectory_indices)) trajectories.")
 
     return trajectory_indices
-end
\ No newline at end of file
+end
+
+function setup_optimiser_workers(worker_count, params_file)
+    """
+    Starts worker processes for simulating optimiser strategies in parallel, and loads the simulator code and parameters on each of them.
+
+    Parameters
+    ----------
+    worker_count : Int
+        Number of worker processes to start
+    params_file : String
+        Path to the parameter file in use
+    """
+    addprocs(worker_count)
+
+    setup_exprs = [
+        :(include($(abspath("simulator_includes.jl")))),
+        :(include($(abspath(params_file)))),
+        # Workers only log to stdout, so they don't overwrite the main log file
+        :(const logger = LoggerTool.setup(true, false, 2)),
+        :(global SIMULATOR_MODE = $(SIMULATOR_MODE))
+    ]
+    for worker in workers()
+        for expr in setup_exprs
+            remotecall_fetch(worker, Core.eval, Main, expr)
+        end
+    end
+
+    LoggerTool.info(logger, "Started $(nworkers()) optimiser workers.")
+end
+
+# Written alongside sharded trajectories by tools/opensky_extraction_pipeline.py
+const TRAJECTORY_MANIFEST_FILENAME = "manifest.json"
+
+function load_trajectory_list(list_filename)
+    """
+    Loads a list of trajectory filenames to run from a JSON trajectory list, such as those written by tools/trajectory_clustering.py, or a trajectory directory's manifest.
+
+    Parameters
+    ----------
+    list_filename : String
+        Path to the trajectory list JSON file
+
+    Returns
+    -------
+    trajectory_list : list
+        Trajectory filenames, relative to PARAM_TRAJECTORY_FILEPATH
+    """
+    list_json = JSON.parsefile(list_filename)
+    trajectory_list = [i["name"] for i in list_json["trajectories"]]
+
+    LoggerTool.info(logger, "Loaded $(length(trajectory_list)) trajectories from $(list_filename).")
+
+    return trajectory_list
+end
+
+function trajectory_basename(trajectory_filename)
+    """
+    Gets a trajectory's name from its filename, without any shard directories, the .json suffix or a .json.gz/.json.zst compression suffix.
+
+    Parameters
+    ----------
+    trajectory_filename : String
+        Trajectory filename, e.g. 3c6444-20200525-004231.json.gz or 20200525/3c/3c6444-20200525-004231.json
+
+    Returns
+    -------
+    String
+        Trajectory name, e.g. 3c6444-20200525-004231
+    """
+    trajectory_filename = basename(trajectory_filename)
+    for suffix in [".json.gz", ".json.zst", ".json"]
+        if endswith(trajectory_filename, suffix)
+            return trajectory_filename[1:end-length(suffix)]
+        end
+    end
+    return trajectory_filename
+end
+
+function load_trajectory_json(filename)
+    """
+    Loads a trajectory JSON file, decompressing .json.gz and .json.zst files written by tools/opensky_extraction_pipeline.py --compression.
+
+    Parameters
+    ----------
+    filename : String
+        Path to the trajectory file
+
+    Returns
+    -------
+    Dict
+        The trajectory JSON
+    """
+    if endswith(filename, ".gz")
+        return JSON.parse(readall(`gzip -dc $(filename)`))
+    elseif endswith(filename, ".zst")
+        return JSON.parse(readall(`zstd -dc $(filename)`))
+    end
+    return JSON.parsefile(filename)
+end
@@ -0,0 +1,35 @@
+"""
+This file loads all of the simulator code. It is shared by the main script and any optimiser worker processes, so they run the same code.
+"""
+
+import JSON
+
+cd("/acasx/code/")
+
+include("logger.jl")
+include("utilities.jl")
+
+include("standardised_code/structures.jl")
+include("standardised_code/math_utils.jl")
+include("standardised_code/global_constants.jl")
+
+include("aircraft.jl")
+include("simulator_helpers.jl")
+include("optimise_helpers.jl")
+
+include("experiment_datastructs.jl")
+include("data_export.jl")
+
+include("simulator_core.jl")
+
+include("tests/tests.jl")
+include("tests/test_encounter.jl")
+include("tests/test_run.jl")
+
+include("experiment_tools.jl")
+include("opensky_tools.jl")
+
+include("run_handler.jl")
+include("optimisation_handler.jl")
+
+import Aircraft
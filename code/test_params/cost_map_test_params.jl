@@ -2,6 +2,10 @@ PARAM_TEST_ENCOUNTERS_PATH="/acasx/code/test_encounters/"
 
 PARAM_TRAJECTORY_FILEPATH = "/input_data/test_input/"
 
+# Optional JSON list of trajectories to run (e.g. from tools/trajectory_clustering.py)
+# If left empty, PARAM_NUMBER_OF_TRAJECTORIES are picked at random instead
+PARAM_TRAJECTORY_LIST_FILE = ""
+
 #PARAM_OUTPUT_FILEPATH = "/output_data/gridtest/test_run_grid2/"
 PARAM_OUTPUT_FILEPATH = "/output_data/cost_map/test_run/"
 PARAM_LOGS_FILEPATH = "$(PARAM_OUTPUT_FILEPATH)logs/"
@@ -38,6 +42,8 @@ const PARAM_FULL_LOG_DUMP = true
 const PARAM_BEST_STRAT_DUMP = false
 const PARAM_RANDOM_RESTART = true
 const PARAM_RIDGE_COUNT_THRESHOLD = 4 
+# Worker processes used to simulate each optimiser iteration's strategies in parallel, 1 runs them serially
+const PARAM_OPTIMISER_WORKERS = 1
 
 const PARAM_RUN_SELECTION_SEED = 5431
 const PARAM_STRATEGY_SELECTION_SEED = 554466
@@ -0,0 +1,530 @@
+"""
+cost_surrogate.py
+
+A surrogate model for the simulator's cost function, used to prescreen cost map strategies before simulating them.
+
+The model is trained on the *-costs-map.json files from previous cost map runs. To predict the cost of a strategy against a trajectory, it finds the most similar trained trajectories (by altitude and vertical rate profile), estimates each one's cost for that strategy by kernel smoothing over its simulated (rate, cross_point) lattice, and combines them - the spread between neighbours gives the uncertainty.
+
+Cells that are either uncertain, or could plausibly be the highest cost cell, are written out as PARAM_DEFAULT_STRATEGIES in a parameter file, so they can be run in defined strategy mode (which also logs a cost map) while the rest are skipped. Trajectories which keep the same cells share a parameter file and trajectory list, so each trajectory only simulates its own cells.
+"""
+
+import json
+import argparse
+from pathlib import Path, PurePosixPath
+
+import numpy as np
+
+from flight_files import (
+    find_flight_files,
+    flight_list_name,
+    flight_name,
+    load_flight_json,
+)
+from params_file import replace_param_block, set_param
+from trajectory_clustering import (
+    DEFAULT_PROFILE_POINTS,
+    flight_profile,
+)
+
+# Matches the simulator's defaults in user_params.jl
+PARAM_RATE_MAX = 84
+PARAM_CROSS_POINT_MIN = 0
+PARAM_CROSS_POINT_MAX = 1
+PARAM_COST_MAP_RATE_INTERVAL = 24
+PARAM_COST_MAP_CROSS_POINT_INTERVAL = 0.2
+
+DEFAULT_NEIGHBOURS = 5
+DEFAULT_BANDWIDTH = 0.15
+DEFAULT_UNCERTAINTY_THRESHOLD = 10.0
+DEFAULT_CONFIDENCE = 2.0
+
+
+def julia_number(value) -> str:
+    """Formats a number the way Julia interpolates it into strategy names, e.g. -60 or 0.2.
+
+    Parameters
+    ----------
+    value : int or float
+        The number to format
+
+    Returns
+    -------
+    str
+        Julia's string representation
+    """
+    if isinstance(value, int):
+        return str(value)
+    return repr(round(float(value), 10))
+
+
+def generate_cost_map_strategies(
+    rate_max: float = PARAM_RATE_MAX,
+    rate_interval: float = PARAM_COST_MAP_RATE_INTERVAL,
+    cross_point_min: float = PARAM_CROSS_POINT_MIN,
+    cross_point_max: float = PARAM_CROSS_POINT_MAX,
+    cross_point_interval: float = PARAM_COST_MAP_CROSS_POINT_INTERVAL,
+) -> dict:
+    """Generates the same lattice of strategies as generate_cost_map_strategies in the simulator.
+
+    Parameters
+    ----------
+    rate_max : float, optional
+        Maximum attacker vertical rate, by default PARAM_RATE_MAX
+    rate_interval : float, optional
+        Step between rates, by default PARAM_COST_MAP_RATE_INTERVAL
+    cross_point_min : float, optional
+        Smallest cross point, by default PARAM_CROSS_POINT_MIN
+    cross_point_max : float, optional
+        Largest cross point, by default PARAM_CROSS_POINT_MAX
+    cross_point_interval : float, optional
+        Step between cross points, by default PARAM_COST_MAP_CROSS_POINT_INTERVAL
+
+    Returns
+    -------
+    dict
+        Strategies keyed by run name, in the simulator's strategy format
+    """
+    strategies = {}
+    rates = np.arange(-rate_max, rate_max + 1e-9, rate_interval)
+    cross_points = np.arange(
+        cross_point_min, cross_point_max + 1e-9, cross_point_interval
+    )
+    for rate in rates:
+        rate = int(rate) if float(rate).is_integer() else float(rate)
+        for cross_point in cross_points:
+            cross_point = round(float(cross_point), 10)
+            for suffix, attacker_pos in [("end", 0), ("mid", 1)]:
+                run_name = "cp{}r{}-{}".format(
+                    julia_number(cross_point), julia_number(rate), suffix
+                )
+                strategies[run_name] = {
+                    "run_name": run_name,
+                    "mode": 3,
+                    "start_alt_delta": 0,
+                    "end_alt_delta": 0,
+                    "rate": rate,
+                    "cross_point": cross_point,
+                    "attacker_pos": attacker_pos,
+                }
+    return strategies
+
+
+def load_cost_maps(paths: list) -> dict:
+    """Loads simulated costs from cost map files.
+
+    Parameters
+    ----------
+    paths : list
+        Paths to *-costs-map.json files, as written by log_cost_map
+
+    Returns
+    -------
+    dict
+        Maps trajectory name to a list of strategies (in the simulator's strategy format) with their cost. Strategies which failed (cost -1) are dropped.
+    """
+    cost_maps = {}
+    for path in paths:
+        with open(path, "r") as f:
+            cost_map = json.load(f)
+        strategies = [
+            i for i in cost_map["data"].values() if i != 0 and i.get("cost", -1) >= 0
+        ]
+        if len(strategies) > 0:
+            cost_maps[cost_map["metadata"]["traj_name"]] = strategies
+    return cost_maps
+
+
+def strategy_coordinates(strategies: list) -> np.ndarray:
+    """Places strategies in a normalised (rate, cross_point, attacker_pos) space for smoothing.
+
+    Parameters
+    ----------
+    strategies : list
+        Strategies, in the simulator's strategy format
+
+    Returns
+    -------
+    np.ndarray
+        One row per strategy, with rate scaled to [-1, 1] and cross point to [0, 1]
+    """
+    return np.array(
+        [
+            [
+                float(i["rate"]) / PARAM_RATE_MAX,
+                float(i["cross_point"]),
+                float(bool(i["attacker_pos"])),
+            ]
+            for i in strategies
+        ]
+    ).reshape(len(strategies), 3)
+
+
+def smooth_costs(
+    observed: np.ndarray,
+    costs: np.ndarray,
+    queries: np.ndarray,
+    bandwidth: float,
+) -> np.ndarray:
+    """Estimates a single trajectory's cost at new strategies from its simulated ones.
+
+    Uses a Gaussian kernel over (rate, cross_point), only mixing strategies with the same attacker position. Queries which exactly match a simulated strategy get (almost exactly) its simulated cost.
+
+    Parameters
+    ----------
+    observed : np.ndarray
+        Coordinates of simulated strategies, from strategy_coordinates
+    costs : np.ndarray
+        Simulated costs
+    queries : np.ndarray
+        Coordinates of strategies to estimate
+    bandwidth : float
+        Kernel bandwidth, in normalised units
+
+    Returns
+    -------
+    np.ndarray
+        Estimated cost for each query
+    """
+    distances = ((queries[:, None, :2] - observed[None, :, :2]) ** 2).sum(axis=2)
+    weights = np.exp(-distances / (2 * bandwidth**2))
+    weights *= queries[:, None, 2] == observed[None, :, 2]
+    totals = weights.sum(axis=1)
+    estimates = (weights * costs[None, :]).sum(axis=1) / np.where(totals > 0, totals, 1)
+    return np.where(totals > 0, estimates, np.nan)
+
+
+class CostSurrogate:
+    """
+    Nearest-neighbour surrogate for the cost of (trajectory, strategy) pairs.
+
+    Parameters
+    ----------
+    neighbours : int, optional
+        Number of similar trajectories used per prediction, by default DEFAULT_NEIGHBOURS
+    bandwidth : float, optional
+        Kernel bandwidth over (rate, cross_point), by default DEFAULT_BANDWIDTH
+    profile_points : int, optional
+        Number of points in each trajectory profile, by default DEFAULT_PROFILE_POINTS
+    """
+
+    def __init__(
+        self,
+        neighbours: int = DEFAULT_NEIGHBOURS,
+        bandwidth: float = DEFAULT_BANDWIDTH,
+        profile_points: int = DEFAULT_PROFILE_POINTS,
+    ):
+        self.neighbours = neighbours
+        self.bandwidth = bandwidth
+        self.profile_points = profile_points
+
+    def fit(self, cost_maps: dict, profiles: dict):
+        """Trains the surrogate on simulated cost maps.
+
+        Parameters
+        ----------
+        cost_maps : dict
+            Simulated costs, as returned by load_cost_maps
+        profiles : dict
+            Maps trajectory name to its profile, from flight_profile. Trajectories without a profile are skipped.
+
+        Returns
+        -------
+        CostSurrogate
+            The trained model
+        """
+        self.names = [i for i in cost_maps if i in profiles]
+        if len(self.names) == 0:
+            raise ValueError("No trajectories with both a cost map and a profile")
+
+        raw = np.array([profiles[i] for i in self.names])
+        self.feature_mean = [
+            raw[:, : self.profile_points].mean(),
+            raw[:, self.profile_points :].mean(),
+        ]
+        self.feature_std = [
+            raw[:, : self.profile_points].std() or 1,
+            raw[:, self.profile_points :].std() or 1,
+        ]
+        self.features = self.scale(raw)
+        self.observed = [strategy_coordinates(cost_maps[i]) for i in self.names]
+        self.costs = [
+            np.array([float(j["cost"]) for j in cost_maps[i]]) for i in self.names
+        ]
+        return self
+
+    def scale(self, profiles: np.ndarray) -> np.ndarray:
+        """Scales profiles with the training set's altitude and vertical rate statistics.
+
+        Parameters
+        ----------
+        profiles : np.ndarray
+            Profiles, one per row
+
+        Returns
+        -------
+        np.ndarray
+            Scaled profiles
+        """
+        scaled = np.array(profiles, dtype=float).copy()
+        halves = [slice(0, self.profile_points), slice(self.profile_points, None)]
+        for half, mean, std in zip(halves, self.feature_mean, self.feature_std):
+            scaled[:, half] = (scaled[:, half] - mean) / std
+        return scaled
+
+    def predict(self, profile: np.ndarray, strategies: list) -> tuple:
+        """Predicts the cost, and its uncertainty, of strategies against a trajectory.
+
+        Parameters
+        ----------
+        profile : np.ndarray
+            Profile of the trajectory, from flight_profile
+        strategies : list
+            Strategies, in the simulator's strategy format
+
+        Returns
+        -------
+        (np.ndarray, np.ndarray)
+            Predicted mean cost and standard deviation for each strategy
+        """
+        query = self.scale(profile[None, :])[0]
+        distances = np.sqrt(((self.features - query) ** 2).sum(axis=1))
+        nearest = np.argsort(distances, kind="stable")[: self.neighbours]
+        weights = 1 / (distances[nearest] + 1e-6)
+
+        queries = strategy_coordinates(strategies)
+        estimates = np.array(
+            [
+                smooth_costs(self.observed[i], self.costs[i], queries, self.bandwidth)
+                for i in nearest
+            ]
+        )
+
+        valid = ~np.isnan(estimates)
+        weights = np.where(valid, weights[:, None], 0)
+        totals = np.where(weights.sum(axis=0) > 0, weights.sum(axis=0), 1)
+        mean = (weights * np.nan_to_num(estimates)).sum(axis=0) / totals
+        variance = (weights * (np.nan_to_num(estimates) - mean) ** 2).sum(
+            axis=0
+        ) / totals
+        return mean, np.sqrt(variance)
+
+
+def select_strategies(
+    mean: np.ndarray,
+    std: np.ndarray,
+    uncertainty_threshold: float = DEFAULT_UNCERTAINTY_THRESHOLD,
+    confidence: float = DEFAULT_CONFIDENCE,
+) -> np.ndarray:
+    """Picks the strategies worth simulating for one trajectory.
+
+    A strategy is kept if its prediction is too uncertain to trust, or if its optimistic (upper) estimate could beat the pessimistic (lower) estimate of the best predicted strategy - i.e. it might be the highest cost cell.
+
+    Parameters
+    ----------
+    mean : np.ndarray
+        Predicted costs
+    std : np.ndarray
+        Prediction standard deviations
+    uncertainty_threshold : float, optional
+        Strategies with a standard deviation above this are always kept, by default DEFAULT_UNCERTAINTY_THRESHOLD
+    confidence : float, optional
+        Number of standard deviations used for the upper/lower estimates, by default DEFAULT_CONFIDENCE
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of strategies to simulate
+    """
+    best_lower = (mean - confidence * std).max()
+    return (std > uncertainty_threshold) | (mean + confidence * std >= best_lower)
+
+
+def load_profile(path: Path, points: int) -> np.ndarray:
+    """Loads a trajectory file and returns its profile.
+
+    Parameters
+    ----------
+    path : Path
+        Path to a flight JSON file, optionally compressed
+    points : int
+        Number of points in the profile
+
+    Returns
+    -------
+    np.ndarray
+        The trajectory's profile
+    """
+    return flight_profile(load_flight_json(path), points)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Trains a surrogate cost model on previous cost map runs and writes a parameter file containing only the cost map strategies worth simulating for new trajectories.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "cost_map_path",
+        type=str,
+        help="Directory (searched recursively) of *-costs-map.json files to train on.",
+    )
+    parser.add_argument(
+        "trajectory_path",
+        type=str,
+        help="Directory of trajectory JSON files, both trained and new.",
+    )
+    parser.add_argument(
+        "params_file",
+        type=str,
+        help="Simulator parameter file used as a template for the output.",
+    )
+    parser.add_argument(
+        "output_path",
+        type=str,
+        help="Directory to save the parameter file, trajectory list and predictions to.",
+    )
+    parser.add_argument(
+        "--targets",
+        type=str,
+        help="Trajectory list JSON (e.g. from trajectory_clustering.py) of trajectories to predict for. Defaults to every trajectory without a cost map.",
+        default=None,
+    )
+    parser.add_argument(
+        "--simulator_output_path",
+        type=str,
+        help="output_path as seen by the simulator, used to point each parameter file's PARAM_TRAJECTORY_LIST_FILE at its group's trajectory list. Left unchanged if not set.",
+        default=None,
+    )
+    parser.add_argument(
+        "--neighbours",
+        type=int,
+        help="Number of similar trained trajectories used per prediction.",
+        default=DEFAULT_NEIGHBOURS,
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        help="Kernel bandwidth over normalised (rate, cross_point) when estimating unsimulated strategies.",
+        default=DEFAULT_BANDWIDTH,
+    )
+    parser.add_argument(
+        "--uncertainty_threshold",
+        type=float,
+        help="Strategies predicted with a standard deviation above this are always simulated.",
+        default=DEFAULT_UNCERTAINTY_THRESHOLD,
+    )
+    parser.add_argument(
+        "--confidence",
+        type=float,
+        help="Number of standard deviations used when deciding if a strategy could be the highest cost.",
+        default=DEFAULT_CONFIDENCE,
+    )
+    parser.add_argument(
+        "--rate_interval",
+        type=float,
+        help="Rate step of the candidate strategy lattice.",
+        default=PARAM_COST_MAP_RATE_INTERVAL,
+    )
+    parser.add_argument(
+        "--cross_point_interval",
+        type=float,
+        help="Cross point step of the candidate strategy lattice.",
+        default=PARAM_COST_MAP_CROSS_POINT_INTERVAL,
+    )
+
+    args = parser.parse_args()
+
+    trajectory_path = Path(args.trajectory_path)
+    output_path = Path(args.output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    cost_maps = load_cost_maps(
+        sorted(Path(args.cost_map_path).rglob("*-costs-map.json"))
+    )
+    trajectory_files = find_flight_files(trajectory_path)
+    profiles = {}
+    for path in trajectory_files:
+        if flight_name(path) in cost_maps:
+            profiles[flight_name(path)] = load_profile(path, DEFAULT_PROFILE_POINTS)
+    model = CostSurrogate(args.neighbours, args.bandwidth).fit(cost_maps, profiles)
+    print("Trained on {} trajectories".format(len(model.names)))
+
+    if args.targets is not None:
+        with open(args.targets, "r") as f:
+            targets = [i["name"] for i in json.load(f)["trajectories"]]
+    else:
+        targets = [
+            flight_list_name(i, trajectory_path)
+            for i in trajectory_files
+            if flight_name(i) not in cost_maps
+        ]
+
+    rate_interval = args.rate_interval
+    if float(rate_interval).is_integer():
+        rate_interval = int(rate_interval)
+    candidates = generate_cost_map_strategies(
+        rate_interval=rate_interval, cross_point_interval=args.cross_point_interval
+    )
+    candidate_list = list(candidates.values())
+
+    predictions = {}
+    groups = {}
+    for target in targets:
+        mean, std = model.predict(
+            load_profile(trajectory_path / target, DEFAULT_PROFILE_POINTS),
+            candidate_list,
+        )
+        keep = select_strategies(mean, std, args.uncertainty_threshold, args.confidence)
+        predictions[target] = {
+            i["run_name"]: {
+                "mean": float(m),
+                "std": float(s),
+                "simulate": bool(k),
+            }
+            for i, m, s, k in zip(candidate_list, mean, std, keep)
+        }
+        key = tuple(i["run_name"] for i, k in zip(candidate_list, keep) if k)
+        if len(key) > 0:
+            groups.setdefault(key, []).append(target)
+    groups = sorted(groups.items(), key=lambda x: x[1][0])
+
+    print(
+        "Selected {} of {} trajectory strategy pairs across {} trajectories, in {} groups".format(
+            sum(len(i) * len(j) for i, j in groups),
+            len(candidates) * len(targets),
+            len(targets),
+            len(groups),
+        )
+    )
+
+    with open(output_path / "surrogate-predictions.json", "w") as f:
+        json.dump(predictions, f)
+
+    with open(args.params_file, "r") as f:
+        template_text = f.read()
+    for group, (selected, names) in enumerate(groups):
+        list_file = output_path / "surrogate-trajectories-group{}.json".format(group)
+        with open(list_file, "w") as f:
+            json.dump(
+                {
+                    "metadata": {"source": str(trajectory_path)},
+                    "trajectories": [
+                        {"name": i, "weight": 1 / len(names)} for i in names
+                    ],
+                },
+                f,
+                indent=2,
+            )
+
+        params_text = replace_param_block(
+            template_text,
+            "PARAM_DEFAULT_STRATEGIES",
+            {i: candidates[i] for i in selected},
+        )
+        if args.simulator_output_path is not None:
+            params_text = set_param(
+                params_text,
+                "PARAM_TRAJECTORY_LIST_FILE",
+                str(PurePosixPath(args.simulator_output_path) / list_file.name),
+            )
+        with open(output_path / "surrogate_params_group{}.jl".format(group), "w") as f:
+            f.write(params_text)
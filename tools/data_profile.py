@@ -0,0 +1,577 @@
+"""
+data_profile.py
+
+A tool to profile raw OpenSky inputs (HDF, CSV or tar, as read by opensky_extraction_pipeline.py) in a single streaming pass, to help pick pipeline thresholds.
+
+Inputs are read a chunk at a time into mergeable sketches (see sketches.py), so memory stays bounded however much data is profiled. The report covers the distributions of altitudes, gaps between an aircraft's consecutive reports (see label_flights' split_threshold), runs of missing altitudes and vertical rates between reports, plus the number of distinct aircraft overall and per day.
+
+Each file is profiled separately (so can be profiled by a separate worker) and the results merged. Reports keep their sketches, so reports from separate runs (e.g. one per month) can be merged later without re-reading the data.
+"""
+
+import gzip
+import json
+import tarfile
+import argparse
+import traceback
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from metrics import add_metrics_arguments, metrics_from_args
+from opensky_extraction_pipeline import (
+    DEFAULT_CSV_CHUNKSIZE,
+    STATE_VECTOR_COLUMNS,
+    detect_input_format,
+    iter_state_vector_chunks,
+)
+from sketches import (
+    DEFAULT_HLL_PRECISION,
+    DEFAULT_RELATIVE_ACCURACY,
+    Histogram,
+    HyperLogLog,
+    QuantileSketch,
+)
+
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+# Daily distinct aircraft counts use smaller sketches, as there is one per day
+DAILY_HLL_PRECISION = 12
+
+ALTITUDE_EDGES = list(range(-500, 15001, 500))
+
+# Histogram edges for each profiled distribution
+DISTRIBUTION_EDGES = {
+    "baroaltitude": ALTITUDE_EDGES,
+    "geoaltitude": ALTITUDE_EDGES,
+    # Seconds between an aircraft's consecutive reports
+    "gap_seconds": [0, 1, 2, 5, 10, 15, 30, 45, 60, 90, 120, 300, 600, 1800, 3600],
+    # Consecutive reports missing a barometric altitude
+    "nan_run_length": [1, 2, 3, 5, 10, 20, 50, 100, 300, 1000],
+    # Barometric altitude change between reports with one (in metres/sec)
+    "vertical_rate": [-100, -50, -30, -20, -15, -10, -5, 0, 5, 10, 15, 20, 30, 50, 100],
+}
+
+CARRY_COLUMNS = ["time", "alt", "alt_time", "nan_run"]
+
+
+def iter_input_chunks(input_path: Path, chunksize: int = DEFAULT_CSV_CHUNKSIZE):
+    """Reads an input file a chunk at a time.
+
+    CSVs (plain, gzipped or in a tar archive) and table-format HDFs are streamed. Fixed-format HDFs can't be read in parts, so are loaded whole.
+
+    Parameters
+    ----------
+    input_path : Path
+        Path to a HDF, CSV or tar file
+    chunksize : int, optional
+        Number of rows per chunk, by default DEFAULT_CSV_CHUNKSIZE
+
+    Yields
+    ------
+    pd.DataFrame
+        Chunks of position reports
+    """
+    input_format = detect_input_format(input_path)
+    if input_format == "tar":
+        with tarfile.open(input_path, "r:*") as archive:
+            for member in archive.getmembers():
+                if (
+                    not member.isfile()
+                    or detect_input_format(Path(member.name)) != "csv"
+                ):
+                    continue
+                stream = archive.extractfile(member)
+                if member.name.lower().endswith(".gz"):
+                    stream = gzip.GzipFile(fileobj=stream)
+                yield from iter_state_vector_chunks(stream, chunksize)
+    elif input_format == "csv":
+        if str(input_path).lower().endswith(".gz"):
+            with gzip.open(input_path, "rb") as f:
+                yield from iter_state_vector_chunks(f, chunksize)
+        else:
+            yield from iter_state_vector_chunks(input_path, chunksize)
+    else:
+        with pd.HDFStore(input_path, mode="r") as store:
+            keys = store.keys()
+            if len(keys) == 1 and store.get_storer(keys[0]).is_table:
+                yield from store.select(keys[0], chunksize=chunksize)
+                return
+        yield pd.read_hdf(input_path)
+
+
+def previous_values(values: np.ndarray, starts: np.ndarray, carried: np.ndarray):
+    """Shifts values along by one, taking the value before the start of each aircraft's reports from carried.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Values, grouped by aircraft
+    starts : np.ndarray
+        Whether each value is its aircraft's first
+    carried : np.ndarray
+        The value before each aircraft's first, in order of aircraft (NaN if none)
+
+    Returns
+    -------
+    np.ndarray
+        The value before each value
+    """
+    previous = np.empty(len(values))
+    previous[1:] = values[:-1]
+    previous[starts] = carried
+    return previous
+
+
+def sequence_statistics(input_df: pd.DataFrame, carry: pd.DataFrame) -> tuple:
+    """Works out gaps, vertical rates and missing altitude runs between each aircraft's consecutive reports.
+
+    The last report of each aircraft (and any run of missing altitudes it ends on) is carried over to the next chunk, so sequences spanning chunks are measured correctly. Reports are assumed to arrive in time order for each aircraft, as in OpenSky dumps.
+
+    Parameters
+    ----------
+    input_df : pd.DataFrame
+        A chunk of position reports
+    carry : pd.DataFrame
+        State carried from earlier chunks, indexed by icao24, with CARRY_COLUMNS
+
+    Returns
+    -------
+    tuple
+        Gaps (in seconds), vertical rates (in metres/sec), completed missing altitude run lengths, and the carry for the next chunk
+    """
+    input_df = input_df.sort_values(["icao24", "time"], kind="mergesort")
+    icao = input_df["icao24"].values
+    times = input_df["time"].values.astype(np.float64)
+    altitudes = input_df["baroaltitude"].values.astype(np.float64)
+    missing = np.isnan(altitudes)
+
+    starts = np.r_[True, icao[1:] != icao[:-1]]
+    ends = np.r_[starts[1:], True]
+    group = np.cumsum(starts) - 1
+    names = icao[starts]
+    previous = carry.reindex(names)
+
+    gaps = times - previous_values(times, starts, previous["time"].values)
+
+    # Vertical rates, between reports with an altitude
+    present_times = times[~missing]
+    present_altitudes = altitudes[~missing]
+    present_group = group[~missing]
+    present_starts = np.r_[True, present_group[1:] != present_group[:-1]][
+        : len(present_group)
+    ]
+    carried_groups = present_group[present_starts]
+    elapsed = present_times - previous_values(
+        present_times, present_starts, previous["alt_time"].values[carried_groups]
+    )
+    climbed = present_altitudes - previous_values(
+        present_altitudes, present_starts, previous["alt"].values[carried_groups]
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rates = np.where(elapsed > 0, climbed / elapsed, np.nan)
+
+    # Runs of missing altitudes, adding on any run carried from the last chunk
+    run_starts = starts | np.r_[True, missing[1:] != missing[:-1]]
+    run_ends = np.r_[run_starts[1:], True]
+    lengths = np.bincount(np.cumsum(run_starts) - 1).astype(np.float64)
+    run_missing = missing[run_starts]
+    first_runs = starts[run_starts]
+    last_runs = ends[run_ends]
+    carried_runs = previous["nan_run"].fillna(0).values
+    lengths[first_runs & run_missing] += carried_runs[run_missing[first_runs]]
+    nan_runs = np.r_[
+        lengths[run_missing & ~last_runs],
+        # Carried runs ended by the aircraft's first report in this chunk
+        carried_runs[~run_missing[first_runs] & (carried_runs > 0)],
+    ]
+
+    alt = previous["alt"].values.copy()
+    alt_time = previous["alt_time"].values.copy()
+    present_ends = np.r_[present_starts[1:], True][: len(present_group)]
+    alt[present_group[present_ends]] = present_altitudes[present_ends]
+    alt_time[present_group[present_ends]] = present_times[present_ends]
+    update = pd.DataFrame(
+        {
+            "time": times[ends],
+            "alt": alt,
+            "alt_time": alt_time,
+            "nan_run": np.where(run_missing[last_runs], lengths[last_runs], 0),
+        },
+        index=names,
+    )
+    carry = pd.concat([carry[~carry.index.isin(names)], update])
+    return gaps, rates, nan_runs, carry
+
+
+def merge_bound(current, value, function):
+    """Combines a running minimum or maximum with a new value, either of which may be None."""
+    if current is None:
+        return value
+    if value is None:
+        return current
+    return function(current, value)
+
+
+def empty_carry() -> pd.DataFrame:
+    """Carry for the start of a file."""
+    return pd.DataFrame(
+        {i: pd.Series(dtype=np.float64) for i in CARRY_COLUMNS},
+        index=pd.Index([], dtype=object),
+    )
+
+
+class Profile:
+    """Mergeable profile of a set of position reports.
+
+    Parameters
+    ----------
+    relative_accuracy : float, optional
+        Relative accuracy of quantile estimates, by default DEFAULT_RELATIVE_ACCURACY
+    hll_precision : int, optional
+        Precision of the distinct aircraft sketch, by default DEFAULT_HLL_PRECISION
+    """
+
+    def __init__(
+        self,
+        relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+        hll_precision: int = DEFAULT_HLL_PRECISION,
+    ):
+        self.files = 0
+        self.failed_files = []
+        self.rows = 0
+        self.null_counts = {}
+        self.time_min = None
+        self.time_max = None
+        self.quantiles = {
+            i: QuantileSketch(relative_accuracy) for i in DISTRIBUTION_EDGES
+        }
+        self.histograms = {i: Histogram(j) for i, j in DISTRIBUTION_EDGES.items()}
+        self.aircraft = HyperLogLog(hll_precision)
+        self.daily_aircraft = {}
+
+    def update_distribution(self, name: str, values: np.ndarray):
+        """Adds values to one of the profiled distributions."""
+        self.quantiles[name].update(values)
+        self.histograms[name].update(values)
+
+    def update(self, input_df: pd.DataFrame, carry: pd.DataFrame) -> pd.DataFrame:
+        """Adds a chunk of position reports to the profile.
+
+        Parameters
+        ----------
+        input_df : pd.DataFrame
+            A chunk of position reports
+        carry : pd.DataFrame
+            State carried from the file's earlier chunks, as from sequence_statistics
+
+        Returns
+        -------
+        pd.DataFrame
+            Carry for the next chunk
+        """
+        input_df = input_df[input_df["icao24"].notna() & input_df["time"].notna()]
+        if input_df.shape[0] == 0:
+            return carry
+        self.rows += input_df.shape[0]
+        for column, count in input_df.isna().sum().items():
+            if column in STATE_VECTOR_COLUMNS:
+                self.null_counts[column] = self.null_counts.get(column, 0) + int(count)
+
+        times = input_df["time"].astype(np.float64)
+        self.time_min = merge_bound(self.time_min, float(times.min()), min)
+        self.time_max = merge_bound(self.time_max, float(times.max()), max)
+
+        for column in ["baroaltitude", "geoaltitude"]:
+            if column in input_df:
+                self.update_distribution(column, input_df[column].values)
+
+        self.aircraft.update(input_df["icao24"])
+        days = (times // 86400).astype(np.int64)
+        for day, icao24 in input_df["icao24"].groupby(days.values):
+            date = pd.Timestamp(day * 86400, unit="s").strftime("%Y-%m-%d")
+            if date not in self.daily_aircraft:
+                self.daily_aircraft[date] = HyperLogLog(DAILY_HLL_PRECISION)
+            self.daily_aircraft[date].update(icao24)
+
+        gaps, rates, nan_runs, carry = sequence_statistics(input_df, carry)
+        self.update_distribution("gap_seconds", gaps)
+        self.update_distribution("vertical_rate", rates)
+        self.update_distribution("nan_run_length", nan_runs)
+        return carry
+
+    def finish_file(self, carry: pd.DataFrame):
+        """Counts the runs of missing altitudes a file's aircraft end on."""
+        runs = carry["nan_run"].values
+        self.update_distribution("nan_run_length", runs[runs > 0])
+        self.files += 1
+
+    def merge(self, other: "Profile"):
+        """Adds another profile (e.g. of other files) to this one."""
+        self.files += other.files
+        self.failed_files += other.failed_files
+        self.rows += other.rows
+        for column, count in other.null_counts.items():
+            self.null_counts[column] = self.null_counts.get(column, 0) + count
+        self.time_min = merge_bound(self.time_min, other.time_min, min)
+        self.time_max = merge_bound(self.time_max, other.time_max, max)
+        for name in DISTRIBUTION_EDGES:
+            self.quantiles[name].merge(other.quantiles[name])
+            self.histograms[name].merge(other.histograms[name])
+        self.aircraft.merge(other.aircraft)
+        for date, sketch in other.daily_aircraft.items():
+            if date in self.daily_aircraft:
+                self.daily_aircraft[date].merge(sketch)
+            else:
+                self.daily_aircraft[date] = sketch
+
+    def to_dict(self) -> dict:
+        """Builds the profile's JSON report, including the sketches needed to merge it with other reports."""
+        distributions = {}
+        for name in DISTRIBUTION_EDGES:
+            sketch = self.quantiles[name]
+            distributions[name] = {
+                "count": sketch.count,
+                "min": sketch.min if sketch.count else None,
+                "max": sketch.max if sketch.count else None,
+                "mean": sketch.sum / sketch.count if sketch.count else None,
+                "quantiles": {
+                    str(q): sketch.quantile(q) if sketch.count else None
+                    for q in QUANTILES
+                },
+                "histogram": self.histograms[name].to_dict(),
+            }
+        return {
+            "files": self.files,
+            "failed_files": self.failed_files,
+            "rows": self.rows,
+            "time_min": self.time_min,
+            "time_max": self.time_max,
+            "null_counts": self.null_counts,
+            "aircraft": {
+                "distinct": round(self.aircraft.estimate()),
+                "daily": {
+                    i: round(j.estimate())
+                    for i, j in sorted(self.daily_aircraft.items())
+                },
+            },
+            "distributions": distributions,
+            "sketches": {
+                "quantiles": {i: j.to_dict() for i, j in self.quantiles.items()},
+                "aircraft": self.aircraft.to_dict(),
+                "daily_aircraft": {
+                    i: j.to_dict() for i, j in self.daily_aircraft.items()
+                },
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, report: dict) -> "Profile":
+        """Loads a profile from its JSON report."""
+        profile = cls()
+        profile.files = report["files"]
+        profile.failed_files = report["failed_files"]
+        profile.rows = report["rows"]
+        profile.time_min = report["time_min"]
+        profile.time_max = report["time_max"]
+        profile.null_counts = report["null_counts"]
+        sketches = report["sketches"]
+        profile.quantiles = {
+            i: QuantileSketch.from_dict(j) for i, j in sketches["quantiles"].items()
+        }
+        profile.histograms = {
+            i: Histogram.from_dict(j["histogram"])
+            for i, j in report["distributions"].items()
+        }
+        profile.aircraft = HyperLogLog.from_dict(sketches["aircraft"])
+        profile.daily_aircraft = {
+            i: HyperLogLog.from_dict(j) for i, j in sketches["daily_aircraft"].items()
+        }
+        return profile
+
+
+def profile_file(
+    input_path: Path,
+    chunksize: int = DEFAULT_CSV_CHUNKSIZE,
+    relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+    hll_precision: int = DEFAULT_HLL_PRECISION,
+) -> Profile:
+    """Profiles one input file, a chunk at a time.
+
+    Parameters
+    ----------
+    input_path : Path
+        Path to a HDF, CSV or tar file
+    chunksize : int, optional
+        Number of rows read at a time, by default DEFAULT_CSV_CHUNKSIZE
+    relative_accuracy : float, optional
+        Relative accuracy of quantile estimates, by default DEFAULT_RELATIVE_ACCURACY
+    hll_precision : int, optional
+        Precision of the distinct aircraft sketch, by default DEFAULT_HLL_PRECISION
+
+    Returns
+    -------
+    Profile
+        The file's profile
+    """
+    profile = Profile(relative_accuracy, hll_precision)
+    carry = empty_carry()
+    for chunk in iter_input_chunks(input_path, chunksize):
+        carry = profile.update(chunk, carry)
+    profile.finish_file(carry)
+    return profile
+
+
+def profile_files(
+    paths: list,
+    chunksize: int = DEFAULT_CSV_CHUNKSIZE,
+    workers: int = 1,
+    relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+    hll_precision: int = DEFAULT_HLL_PRECISION,
+    metrics=None,
+) -> Profile:
+    """Profiles input files, in separate processes with more than one worker, and merges their profiles.
+
+    Files which fail to be read are listed in the profile's failed_files.
+
+    Parameters
+    ----------
+    paths : list
+        Paths of the input files
+    chunksize : int, optional
+        Number of rows read at a time, by default DEFAULT_CSV_CHUNKSIZE
+    workers : int, optional
+        Number of processes to profile files in, by default 1
+    relative_accuracy : float, optional
+        Relative accuracy of quantile estimates, by default DEFAULT_RELATIVE_ACCURACY
+    hll_precision : int, optional
+        Precision of the distinct aircraft sketch, by default DEFAULT_HLL_PRECISION
+    metrics : Metrics, optional
+        Counts files processed and failed, by default None
+
+    Returns
+    -------
+    Profile
+        Merged profile of every file
+    """
+    profile = Profile(relative_accuracy, hll_precision)
+    options = [chunksize, relative_accuracy, hll_precision]
+
+    def merge(path, result):
+        try:
+            profile.merge(result())
+        except Exception:
+            profile.failed_files.append(str(path))
+            print("Error on {}".format(path))
+            traceback.print_exc()
+            if metrics is not None:
+                metrics.inc("files_failed_total")
+        if metrics is not None:
+            metrics.inc("files_processed_total")
+
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(profile_file, path, *options): path for path in paths
+            }
+            for future in as_completed(futures):
+                merge(futures[future], future.result)
+    else:
+        for path in paths:
+            print("Profiling {}".format(path))
+            merge(path, lambda: profile_file(path, *options))
+    return profile
+
+
+def print_summary(report: dict):
+    """Prints the headline figures of a report."""
+    print(
+        "{} rows from {} files, ~{} distinct aircraft".format(
+            report["rows"], report["files"], report["aircraft"]["distinct"]
+        )
+    )
+    for name, distribution in report["distributions"].items():
+        quantiles = distribution["quantiles"]
+        if distribution["count"] == 0:
+            continue
+        print(
+            "{}: median {:.1f}, 1%-99% {:.1f} to {:.1f} ({} values)".format(
+                name,
+                quantiles["0.5"],
+                quantiles["0.01"],
+                quantiles["0.99"],
+                distribution["count"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Profiles raw OpenSky inputs in a single streaming pass, reporting altitude, report gap, missing altitude run and vertical rate distributions and distinct aircraft counts as JSON.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "command",
+        choices=["profile", "merge"],
+        help="profile reads input files or directories, merge combines earlier reports.",
+    )
+    parser.add_argument(
+        "input_paths",
+        type=str,
+        nargs="+",
+        help="Input files or directories to profile, or reports to merge.",
+    )
+    parser.add_argument(
+        "--output_path",
+        type=str,
+        help="JSON file to save the report to.",
+        required=True,
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        help="Number of rows read at a time.",
+        default=DEFAULT_CSV_CHUNKSIZE,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of processes to profile files in.",
+        default=1,
+    )
+    parser.add_argument(
+        "--relative_accuracy",
+        type=float,
+        help="Relative accuracy of quantile estimates.",
+        default=DEFAULT_RELATIVE_ACCURACY,
+    )
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    if args.command == "profile":
+        metrics = metrics_from_args(args)
+        paths = []
+        for input_path in map(Path, args.input_paths):
+            paths += (
+                sorted(input_path.iterdir()) if input_path.is_dir() else [input_path]
+            )
+        metrics.expect("files_processed_total", len(paths))
+        profile = profile_files(
+            paths, args.chunksize, args.workers, args.relative_accuracy, metrics=metrics
+        )
+        metrics.close()
+    else:
+        profile = None
+        for path in args.input_paths:
+            with open(path) as f:
+                report = Profile.from_dict(json.load(f))
+            if profile is None:
+                profile = report
+            else:
+                profile.merge(report)
+
+    report = profile.to_dict()
+    with open(args.output_path, "w") as f:
+        json.dump(report, f)
+    print_summary(report)
@@ -0,0 +1,489 @@
+"""
+do385_tables.py
+
+A reader for the DO-385 .dat tables (the state estimation entry distributions and the origami equiv_class/minblocks cost tables), and a cache of them as memory-mappable NumPy arrays.
+
+The .dat format is decoded as in code/parameter_loading_helpers.jl - a 1634 magic number, file type, auxiliary data (cut counts, dimension names and cuts), then the index and data arrays as uint8/uint32/half/double. The cost table file holds several of these back to back.
+
+The cache holds each table's cuts, index and data as .npy files, plus an index.json with the remaining metadata and the size, modification time and SHA-256 of each source file. It is versioned, so a layout change never reads stale files. Tables can be loaded from it instantly for offline analysis, and the simulator loads them from it at startup when PARAMS_TABLE_CACHE_DIR is set in code/do385_params.jl.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+from pathlib import Path
+from collections import namedtuple
+
+import numpy as np
+
+DAT_MAGIC_NUMBER = 1634
+
+# Bump when the cache layout changes - code/parameter_loading_helpers.jl
+# checks the same version
+TABLE_CACHE_VERSION = 1
+
+DAT_TYPES = {
+    "uint8": np.dtype("u1"),
+    "uint32": np.dtype("<u4"),
+    "half": np.dtype("<f2"),
+    "double": np.dtype("<f8"),
+}
+
+DEFAULT_PARAMS_FILENAME = "DO-385_parameter_file.txt"
+
+DatTable = namedtuple(
+    "DatTable",
+    [
+        "names",
+        "cut_counts",
+        "cuts",
+        "index",
+        "data",
+        "file_type",
+        "index_type",
+        "data_type",
+        "count_included",
+        "maximum_block_elements",
+    ],
+)
+
+# Arrays stored as .npy files, rather than in index.json
+ARRAY_FIELDS = ["cuts", "index", "data"]
+
+
+class Reader:
+    """Reads little-endian fields from a bytes buffer, tracking the offset.
+
+    Parameters
+    ----------
+    blob : bytes
+        Buffer to read from
+    offset : int, optional
+        Offset to start reading at, by default 0
+    """
+
+    def __init__(self, blob: bytes, offset: int = 0):
+        self.blob = blob
+        self.offset = offset
+
+    def uint8(self) -> int:
+        """Reads a uint8."""
+        value = self.blob[self.offset]
+        self.offset += 1
+        return value
+
+    def uint32(self) -> int:
+        """Reads a little-endian uint32."""
+        value = int(np.frombuffer(self.blob, "<u4", 1, self.offset)[0])
+        self.offset += 4
+        return value
+
+    def string(self) -> str:
+        """Reads a string prefixed with its uint8 length."""
+        length = self.uint8()
+        value = self.blob[self.offset : self.offset + length].decode("latin-1")
+        self.offset += length
+        return value
+
+    def array(self, type_name: str, count: int) -> np.ndarray:
+        """Reads count values of a DO-385 type, without copying."""
+        if type_name not in DAT_TYPES:
+            raise ValueError("Unknown DO-385 data type {}".format(type_name))
+        dtype = DAT_TYPES[type_name]
+        if self.offset + count * dtype.itemsize > len(self.blob):
+            raise ValueError("Table is shorter than its element counts")
+        value = np.frombuffer(self.blob, dtype, count, self.offset)
+        self.offset += count * dtype.itemsize
+        return value
+
+
+def parse_table(blob: bytes, offset: int = 0, name: str = "table") -> tuple:
+    """Decodes one DO-385 table from a buffer.
+
+    Parameters
+    ----------
+    blob : bytes
+        Contents of a .dat file
+    offset : int, optional
+        Offset the table starts at, by default 0
+    name : str, optional
+        Name used in error messages, by default 'table'
+
+    Returns
+    -------
+    tuple
+        The DatTable, and the offset just past it
+
+    Raises
+    ------
+    ValueError
+        If the magic number check fails
+    """
+    reader = Reader(blob, offset)
+    if reader.uint32() != DAT_MAGIC_NUMBER:
+        raise ValueError("Magic Number check failed for {}".format(name))
+
+    file_type = reader.string()
+    auxiliary_data_size = reader.uint32()
+    aux = Reader(blob[reader.offset : reader.offset + auxiliary_data_size])
+    reader.offset += auxiliary_data_size
+
+    dimension_count = aux.uint32()
+    cut_counts = [aux.uint32() for _ in range(dimension_count)]
+    names = [aux.string() for _ in range(dimension_count)]
+    # Everything left in the auxiliary data is cuts
+    cuts = aux.array("double", (auxiliary_data_size - aux.offset) // 8)
+
+    index_type = reader.string()
+    data_type = reader.string()
+    count_included = reader.uint8()
+    if file_type != "varblockdictionary":
+        count_included = -1
+    maximum_block_elements = reader.uint8()
+    index_element_count = reader.uint32()
+    data_element_count = reader.uint32()
+
+    index = np.zeros(0, dtype=DAT_TYPES["uint32"])
+    if index_element_count > 0:
+        index = reader.array(index_type, index_element_count)
+    data = None
+    if data_element_count > 0:
+        data = reader.array(data_type, data_element_count)
+
+    table = DatTable(
+        names,
+        cut_counts,
+        cuts,
+        index,
+        data,
+        file_type,
+        index_type,
+        data_type,
+        count_included,
+        maximum_block_elements,
+    )
+    return table, reader.offset
+
+
+def read_dat_file(path: Path) -> DatTable:
+    """Reads a DO-385 .dat file holding a single table, as read_dat_file and read_minblocks_dat_file do.
+
+    Parameters
+    ----------
+    path : Path
+        Path to the .dat file
+
+    Returns
+    -------
+    DatTable
+        The decoded table
+    """
+    with open(path, "rb") as f:
+        blob = f.read()
+    return parse_table(blob, name=str(path))[0]
+
+
+def read_cost_dat_file(path: Path) -> list:
+    """Reads a DO-385 .dat file holding several tables back to back, as read_cost_dat_file does.
+
+    Parameters
+    ----------
+    path : Path
+        Path to the .dat file
+
+    Returns
+    -------
+    list
+        The decoded DatTables
+    """
+    with open(path, "rb") as f:
+        blob = f.read()
+    tables = []
+    offset = 0
+    while offset < len(blob):
+        table, offset = parse_table(blob, offset, str(path))
+        tables.append(table)
+    return tables
+
+
+def table_files(params: dict) -> dict:
+    """Lists the .dat tables load_params reads from a DO-385 parameter file.
+
+    Parameters
+    ----------
+    params : dict
+        The parsed DO-385 parameter file
+
+    Returns
+    -------
+    dict
+        Table filename (relative to the parameter directory) to whether it holds several tables
+    """
+    files = {}
+    for mode in params["modes"][:2]:
+        entry_dist = mode["state_estimation"]["tau"]["entry_dist"]
+        for key in ["vertical_table", "horizontal_table", "horizontal_active_table"]:
+            files[entry_dist[key]] = False
+    origami = params["modes"][0]["cost_estimation"]["offline"]["origami"]
+    files[origami["equiv_class_table"]] = True
+    files[origami["minblocks_table"]] = False
+    return files
+
+
+def file_sha256(path: Path) -> str:
+    """Hashes a file's contents.
+
+    Parameters
+    ----------
+    path : Path
+        File to hash
+
+    Returns
+    -------
+    str
+        Hex SHA-256 digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def version_path(cache_path: Path) -> Path:
+    """Directory holding the current cache version."""
+    return Path(cache_path) / "v{}".format(TABLE_CACHE_VERSION)
+
+
+def read_source(path: Path, multiple: bool) -> list:
+    """Decodes a .dat file into a list of tables."""
+    if multiple:
+        return read_cost_dat_file(path)
+    return [read_dat_file(path)]
+
+
+def build_cache(parameter_path: Path, cache_path: Path, params_filename: str) -> dict:
+    """Decodes every table a DO-385 parameter file uses into the cache.
+
+    Parameters
+    ----------
+    parameter_path : Path
+        Directory holding the parameter file and .dat tables
+    cache_path : Path
+        Cache directory
+    params_filename : str
+        Name of the DO-385 parameter file
+
+    Returns
+    -------
+    dict
+        The cache index, as written to index.json
+    """
+    with open(Path(parameter_path) / params_filename, "r") as f:
+        params = json.load(f)
+
+    base_path = version_path(cache_path)
+    index = {"version": TABLE_CACHE_VERSION, "sources": {}}
+    for filename, multiple in table_files(params).items():
+        source = Path(parameter_path) / filename
+        stat = source.stat()
+        entry = {
+            "multiple": multiple,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha256": file_sha256(source),
+            "tables": [],
+        }
+        for i, table in enumerate(read_source(source, multiple)):
+            table_path = base_path / filename / str(i)
+            table_path.mkdir(parents=True, exist_ok=True)
+            metadata = table._asdict()
+            metadata["files"] = {}
+            for field in ARRAY_FIELDS:
+                values = metadata.pop(field)
+                if values is None:
+                    continue
+                np.save(table_path / "{}.npy".format(field), values)
+                metadata["files"][field] = str(
+                    Path(filename, str(i), "{}.npy".format(field))
+                )
+            entry["tables"].append(metadata)
+        index["sources"][filename] = entry
+        print("Cached {} ({} tables)".format(filename, len(entry["tables"])))
+
+    # Written last, and atomically, so a partial build is never picked up
+    tmp_path = base_path / "index.json.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, base_path / "index.json")
+    return index
+
+
+def load_index(cache_path: Path) -> dict:
+    """Loads the cache index.
+
+    Parameters
+    ----------
+    cache_path : Path
+        Cache directory
+
+    Returns
+    -------
+    dict
+        The cache index
+
+    Raises
+    ------
+    FileNotFoundError
+        If there is no cache of the current version
+    """
+    with open(version_path(cache_path) / "index.json", "r") as f:
+        return json.load(f)
+
+
+def load_cached_tables(cache_path: Path, filename: str, index: dict = None) -> list:
+    """Loads a source file's tables from the cache, with their arrays memory-mapped.
+
+    Parameters
+    ----------
+    cache_path : Path
+        Cache directory
+    filename : str
+        Table filename, as named in the DO-385 parameter file
+    index : dict, optional
+        Cache index, loaded if not given, by default None
+
+    Returns
+    -------
+    list
+        The cached DatTables
+    """
+    if index is None:
+        index = load_index(cache_path)
+    base_path = version_path(cache_path)
+    tables = []
+    for metadata in index["sources"][filename]["tables"]:
+        fields = {k: v for k, v in metadata.items() if k != "files"}
+        for field in ARRAY_FIELDS:
+            fields[field] = None
+            if field in metadata["files"]:
+                fields[field] = np.load(
+                    base_path / metadata["files"][field], mmap_mode="r"
+                )
+        tables.append(DatTable(**fields))
+    return tables
+
+
+def tables_match(decoded: DatTable, cached: DatTable) -> bool:
+    """Checks two tables are identical, comparing arrays bit for bit (so NaNs match).
+
+    Parameters
+    ----------
+    decoded : DatTable
+        Table decoded from the original file
+    cached : DatTable
+        Table loaded from the cache
+
+    Returns
+    -------
+    bool
+        True if every field matches
+    """
+    for field in DatTable._fields:
+        a = getattr(decoded, field)
+        b = getattr(cached, field)
+        if field in ARRAY_FIELDS:
+            if a is None or b is None:
+                if a is not b:
+                    return False
+            elif a.dtype != b.dtype or a.tobytes() != np.asarray(b).tobytes():
+                return False
+        else:
+            # Lists come back from index.json as lists, but may be tuples here
+            if isinstance(a, tuple):
+                a = list(a)
+            if a != b:
+                return False
+    return True
+
+
+def verify_cache(parameter_path: Path, cache_path: Path) -> list:
+    """Checks the cache against the original .dat files.
+
+    Parameters
+    ----------
+    parameter_path : Path
+        Directory holding the .dat tables
+    cache_path : Path
+        Cache directory
+
+    Returns
+    -------
+    list
+        A description of each problem found - empty if the cache matches
+    """
+    index = load_index(cache_path)
+    problems = []
+    for filename, entry in index["sources"].items():
+        source = Path(parameter_path) / filename
+        if not source.exists():
+            problems.append("{}: source file missing".format(filename))
+            continue
+        if file_sha256(source) != entry["sha256"]:
+            problems.append("{}: source file has changed".format(filename))
+            continue
+        decoded = read_source(source, entry["multiple"])
+        cached = load_cached_tables(cache_path, filename, index)
+        if len(decoded) != len(cached):
+            problems.append(
+                "{}: {} tables decoded, {} cached".format(
+                    filename, len(decoded), len(cached)
+                )
+            )
+            continue
+        for i, (a, b) in enumerate(zip(decoded, cached)):
+            if not tables_match(a, b):
+                problems.append("{}: table {} differs".format(filename, i))
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Decodes the DO-385 .dat tables into a cache of memory-mappable NumPy arrays, or verifies a cache against the originals.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "command",
+        choices=["build", "verify"],
+        help="build decodes every table into the cache, verify checks the cache against the .dat files.",
+    )
+    parser.add_argument(
+        "parameter_path",
+        type=str,
+        help="Directory holding the DO-385 parameter file and .dat tables, e.g. code/do385_data/.",
+    )
+    parser.add_argument("cache_path", type=str, help="Cache directory.")
+    parser.add_argument(
+        "--params_filename",
+        type=str,
+        help="Name of the DO-385 parameter file, within parameter_path.",
+        default=DEFAULT_PARAMS_FILENAME,
+    )
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = build_cache(args.parameter_path, args.cache_path, args.params_filename)
+        print(
+            "Cached {} files to {}".format(
+                len(index["sources"]), version_path(args.cache_path)
+            )
+        )
+    else:
+        problems = verify_cache(args.parameter_path, args.cache_path)
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(1)
+        print("Cache matches the original tables")
@@ -0,0 +1,386 @@
+"""
+encounter_finder.py
+
+A tool to find natural encounters between pairs of real flights in the JSON flights exported by opensky_extraction_pipeline.py, and export them as paired encounter files with closest point of approach (CPA) metadata.
+
+Flights are sampled onto a shared time grid and hashed into (time bucket, grid cell) keys, with grid cells the size of the horizontal separation. Only flights sharing a time bucket and neighbouring cells are ever compared, so the search scales with the number of nearby flights rather than the square of the number of flights.
+"""
+
+import json
+import argparse
+from pathlib import Path
+
+import pandas as pd
+import numpy as np
+
+from flight_files import find_flight_files, flight_name, load_flight_json
+from opensky_extraction_pipeline import EARTH_RADIUS_KM, haversine_km
+
+# 5 NM and 1000 ft, in metres
+DEFAULT_HORIZONTAL_SEPARATION = 9260
+DEFAULT_VERTICAL_SEPARATION = 305
+DEFAULT_BUCKET_SECONDS = 5
+DEFAULT_PADDING_SECONDS = 60
+
+
+def load_flight(path: Path) -> dict:
+    """Loads an exported flight, pulling out the arrays needed to search for encounters.
+
+    Parameters
+    ----------
+    path : Path
+        Path to a flight JSON file, optionally compressed
+
+    Returns
+    -------
+    dict
+        The flight name, its time/lat/lon/altitude arrays (in time order) and the original JSON
+    """
+    flight_json = load_flight_json(path)
+
+    data = pd.DataFrame(flight_json["data"]).sort_values("time")
+    return {
+        "name": flight_name(path),
+        "icao24": data["icao24"].iloc[0],
+        "time": data["time"].values.astype(float),
+        "lat": data["lat"].values.astype(float),
+        "lon": data["lon"].values.astype(float),
+        "alt": data["baroaltitude"].values.astype(float),
+        "json": flight_json,
+    }
+
+
+def sample_flights(
+    flights: list, bucket_seconds: float, ref_lat: float
+) -> pd.DataFrame:
+    """Interpolates every flight onto a shared time grid, projecting positions onto a local flat plane.
+
+    Parameters
+    ----------
+    flights : list
+        Flights, as returned by load_flight
+    bucket_seconds : float
+        Spacing of the time grid, in seconds
+    ref_lat : float
+        Reference latitude for the equirectangular projection
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per flight per time bucket, with the flight index, bucket, x/y (metres) and altitude
+    """
+    radius_m = EARTH_RADIUS_KM * 1000
+    lon_scale = np.cos(np.radians(ref_lat))
+    samples = []
+    for flight_idx, flight in enumerate(flights):
+        first_bucket = np.ceil(flight["time"][0] / bucket_seconds)
+        last_bucket = np.floor(flight["time"][-1] / bucket_seconds)
+        if last_bucket < first_bucket:
+            continue
+        buckets = np.arange(first_bucket, last_bucket + 1)
+        times = buckets * bucket_seconds
+        lat = np.interp(times, flight["time"], flight["lat"])
+        lon = np.interp(times, flight["time"], flight["lon"])
+        samples.append(
+            pd.DataFrame(
+                {
+                    "flight": flight_idx,
+                    "bucket": buckets.astype(np.int64),
+                    "x": radius_m * np.radians(lon) * lon_scale,
+                    "y": radius_m * np.radians(lat),
+                    "alt": np.interp(times, flight["time"], flight["alt"]),
+                }
+            )
+        )
+    if len(samples) == 0:
+        return pd.DataFrame(columns=["flight", "bucket", "x", "y", "alt"])
+    return pd.concat(samples, ignore_index=True)
+
+
+def find_candidate_pairs(
+    samples: pd.DataFrame, horizontal_sep: float, vertical_sep: float
+) -> pd.DataFrame:
+    """Finds all pairs of flights which come within the separation thresholds at a shared time bucket.
+
+    Samples are hashed into grid cells of size horizontal_sep, so any pair within the threshold must sit in the same or a neighbouring cell. Each of the nine neighbour offsets is then a hash join on (bucket, cell).
+
+    Parameters
+    ----------
+    samples : pd.DataFrame
+        Sampled flights, as returned by sample_flights
+    horizontal_sep : float
+        Horizontal separation threshold, in metres
+    vertical_sep : float
+        Vertical separation threshold, in metres
+
+    Returns
+    -------
+    pd.DataFrame
+        Unique (flight_a, flight_b) index pairs, with flight_a < flight_b
+    """
+    cells = samples.assign(
+        cx=np.floor(samples["x"] / horizontal_sep).astype(np.int64),
+        cy=np.floor(samples["y"] / horizontal_sep).astype(np.int64),
+    )
+    pairs = []
+    for dx in [-1, 0, 1]:
+        for dy in [-1, 0, 1]:
+            shifted = cells.assign(cx=cells["cx"] + dx, cy=cells["cy"] + dy)
+            joined = cells.merge(
+                shifted, on=["bucket", "cx", "cy"], suffixes=("_a", "_b")
+            )
+            joined = joined[joined["flight_a"] < joined["flight_b"]]
+            close = (
+                np.hypot(joined["x_a"] - joined["x_b"], joined["y_a"] - joined["y_b"])
+                <= horizontal_sep
+            ) & (np.abs(joined["alt_a"] - joined["alt_b"]) <= vertical_sep)
+            pairs.append(joined.loc[close, ["flight_a", "flight_b"]])
+    return pd.concat(pairs, ignore_index=True).drop_duplicates().reset_index(drop=True)
+
+
+def closest_point_of_approach(flight_a: dict, flight_b: dict) -> dict:
+    """Finds the closest point of approach between two flights over the time they overlap.
+
+    Both flights are interpolated onto the union of their report times, and the point of minimum slant range is taken.
+
+    Parameters
+    ----------
+    flight_a : dict
+        Flight, as returned by load_flight
+    flight_b : dict
+        Flight, as returned by load_flight
+
+    Returns
+    -------
+    dict
+        CPA metadata - time, horizontal/vertical/slant separation (metres), both positions, and the overlap window. Empty if the flights do not overlap in time.
+    """
+    start = max(flight_a["time"][0], flight_b["time"][0])
+    end = min(flight_a["time"][-1], flight_b["time"][-1])
+    times = np.union1d(flight_a["time"], flight_b["time"])
+    times = times[(times >= start) & (times <= end)]
+    if len(times) == 0:
+        return {}
+
+    positions = {}
+    for label, flight in [("a", flight_a), ("b", flight_b)]:
+        for field in ["lat", "lon", "alt"]:
+            positions[f"{field}_{label}"] = np.interp(
+                times, flight["time"], flight[field]
+            )
+
+    horizontal = 1000 * haversine_km(
+        positions["lat_a"], positions["lon_a"], positions["lat_b"], positions["lon_b"]
+    )
+    vertical = np.abs(positions["alt_a"] - positions["alt_b"])
+    slant = np.hypot(horizontal, vertical)
+    idx = int(np.argmin(slant))
+
+    return {
+        "cpa_time": float(times[idx]),
+        "cpa_horizontal_sep": float(horizontal[idx]),
+        "cpa_vertical_sep": float(vertical[idx]),
+        "cpa_slant_range": float(slant[idx]),
+        "cpa_lat_a": float(positions["lat_a"][idx]),
+        "cpa_lon_a": float(positions["lon_a"][idx]),
+        "cpa_alt_a": float(positions["alt_a"][idx]),
+        "cpa_lat_b": float(positions["lat_b"][idx]),
+        "cpa_lon_b": float(positions["lon_b"][idx]),
+        "cpa_alt_b": float(positions["alt_b"][idx]),
+        "overlap_start": float(start),
+        "overlap_end": float(end),
+    }
+
+
+def clip_flight_json(flight_json: dict, start: float, end: float) -> dict:
+    """Cuts a flight down to the reports between start and end, recomputing its metadata to match.
+
+    Parameters
+    ----------
+    flight_json : dict
+        Flight JSON, as exported by the pipeline
+    start : float
+        Start time, as a UNIX timestamp
+    end : float
+        End time, as a UNIX timestamp
+
+    Returns
+    -------
+    dict
+        Flight JSON in the same layout, containing only the clipped reports
+    """
+    data = [i for i in flight_json["data"] if start <= i["time"] <= end]
+    altitudes = [i["baroaltitude"] for i in data]
+    return {
+        "metadata": {
+            "min_alt": min(altitudes),
+            "max_alt": max(altitudes),
+            "mid_alt": altitudes[len(altitudes) // 2],
+            "first_alt": altitudes[0],
+            "last_alt": altitudes[-1],
+        },
+        "data": data,
+    }
+
+
+def export_encounter(
+    flight_a: dict, flight_b: dict, cpa: dict, output_path: Path, padding: float
+) -> str:
+    """Saves a pair of flights, clipped to their overlap, as a single encounter file.
+
+    Parameters
+    ----------
+    flight_a : dict
+        Ownship flight, as returned by load_flight
+    flight_b : dict
+        Intruder flight, as returned by load_flight
+    cpa : dict
+        CPA metadata, as returned by closest_point_of_approach
+    output_path : Path
+        Directory to save the encounter to
+    padding : float
+        Seconds of context to keep either side of the overlap window
+
+    Returns
+    -------
+    str
+        The encounter name, which is also the file stem
+    """
+    name = "{}--{}".format(flight_a["name"], flight_b["name"])
+    start = cpa["overlap_start"] - padding
+    end = cpa["overlap_end"] + padding
+
+    metadata = {
+        "encounter_name": name,
+        "ownship": flight_a["name"],
+        "intruder": flight_b["name"],
+    }
+    for key in cpa:
+        if key.startswith("cpa_") or key.startswith("overlap_"):
+            metadata[key] = float(cpa[key])
+
+    output = {
+        "metadata": metadata,
+        "ownship": clip_flight_json(flight_a["json"], start, end),
+        "intruder": clip_flight_json(flight_b["json"], start, end),
+    }
+    with open(Path(output_path) / f"{name}.json", "w") as f:
+        json.dump(output, f)
+    return name
+
+
+def find_encounters(
+    flights: list,
+    horizontal_sep: float = DEFAULT_HORIZONTAL_SEPARATION,
+    vertical_sep: float = DEFAULT_VERTICAL_SEPARATION,
+    bucket_seconds: float = DEFAULT_BUCKET_SECONDS,
+) -> pd.DataFrame:
+    """Finds all pairs of flights which come within the separation thresholds of each other.
+
+    Parameters
+    ----------
+    flights : list
+        Flights, as returned by load_flight
+    horizontal_sep : float, optional
+        Horizontal separation threshold in metres, by default DEFAULT_HORIZONTAL_SEPARATION
+    vertical_sep : float, optional
+        Vertical separation threshold in metres, by default DEFAULT_VERTICAL_SEPARATION
+    bucket_seconds : float, optional
+        Spacing of the time grid flights are compared on, by default DEFAULT_BUCKET_SECONDS
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per encounter, with the flight indices, names and CPA metadata
+    """
+    if len(flights) < 2:
+        return pd.DataFrame()
+
+    ref_lat = np.mean([np.mean(i["lat"]) for i in flights])
+    samples = sample_flights(flights, bucket_seconds, ref_lat)
+    pairs = find_candidate_pairs(samples, horizontal_sep, vertical_sep)
+
+    encounters = []
+    for flight_a, flight_b in pairs.itertuples(index=False):
+        # The same airframe can't meet itself
+        if flights[flight_a]["icao24"] == flights[flight_b]["icao24"]:
+            continue
+        cpa = closest_point_of_approach(flights[flight_a], flights[flight_b])
+        if len(cpa) == 0:
+            continue
+        cpa.update(
+            {
+                "flight_a": flight_a,
+                "flight_b": flight_b,
+                "name_a": flights[flight_a]["name"],
+                "name_b": flights[flight_b]["name"],
+            }
+        )
+        encounters.append(cpa)
+
+    return pd.DataFrame(encounters)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Finds pairs of real flights which come close to each other, and exports them as paired encounter files with closest point of approach metadata.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "input_path", type=str, help="Directory of flight JSON files to search."
+    )
+    parser.add_argument(
+        "output_path", type=str, help="Directory to save encounter files to."
+    )
+    parser.add_argument(
+        "--horizontal_sep",
+        type=float,
+        help="Horizontal separation (in metres) below which two flights are considered an encounter.",
+        default=DEFAULT_HORIZONTAL_SEPARATION,
+    )
+    parser.add_argument(
+        "--vertical_sep",
+        type=float,
+        help="Vertical separation (in metres) below which two flights are considered an encounter.",
+        default=DEFAULT_VERTICAL_SEPARATION,
+    )
+    parser.add_argument(
+        "--bucket_seconds",
+        type=float,
+        help="Spacing (in seconds) of the time grid flights are compared on.",
+        default=DEFAULT_BUCKET_SECONDS,
+    )
+    parser.add_argument(
+        "--padding",
+        type=float,
+        help="Seconds of each flight to keep either side of the overlap window in exported encounters.",
+        default=DEFAULT_PADDING_SECONDS,
+    )
+
+    args = parser.parse_args()
+
+    input_path = Path(args.input_path)
+    output_path = Path(args.output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    flights = [load_flight(i) for i in find_flight_files(input_path)]
+    print("Loaded {} flights".format(len(flights)))
+
+    encounters = find_encounters(
+        flights, args.horizontal_sep, args.vertical_sep, args.bucket_seconds
+    )
+    print("Found {} encounters".format(encounters.shape[0]))
+
+    for row in encounters.itertuples(index=False):
+        export_encounter(
+            flights[row.flight_a],
+            flights[row.flight_b],
+            row._asdict(),
+            output_path,
+            args.padding,
+        )
+
+    if encounters.shape[0] > 0:
+        encounters.drop(columns=["flight_a", "flight_b"]).to_csv(
+            output_path / "encounter_index.csv", index=False
+        )
@@ -0,0 +1,314 @@
+"""
+flight_files.py
+
+Helpers for reading and writing flight JSON files, which may be plain JSON or gzip/zstd compressed.
+
+Compression is detected from each file's contents rather than its name, so readers work on any mix of files. Compressed flights are named .json.gz or .json.zst, and flight_name strips any of these suffixes to give the same trajectory name as an uncompressed file. zstd support needs the zstandard package, which is only imported when a zstd file is read or written.
+
+Flights are either saved flat in one directory, or sharded into {date}/{icao24 prefix}/ subdirectories. Sharded directories (and optionally flat ones) have a manifest.json listing every flight - see flight_manifest.py.
+"""
+
+import json
+import gzip
+from pathlib import Path
+
+# Flight file suffixes, and the compression each is written with
+FLIGHT_SUFFIXES = {".json": None, ".json.gz": "gzip", ".json.zst": "zstd"}
+COMPRESSION_SUFFIXES = {v: k for k, v in FLIGHT_SUFFIXES.items()}
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+LAYOUTS = ["flat", "sharded"]
+# Number of leading ICAO24 characters used to name shard directories
+SHARD_ICAO_PREFIX = 2
+
+# Lists every flight in a directory, in the format of a trajectory list
+MANIFEST_FILENAME = "manifest.json"
+
+# Defaults favour write speed, as exports are I/O bound rather than CPU bound
+DEFAULT_COMPRESSION_LEVELS = {"gzip": 6, "zstd": 3}
+
+
+def import_zstandard():
+    """Imports the optional zstandard package.
+
+    Returns
+    -------
+    module
+        The zstandard module
+
+    Raises
+    ------
+    ImportError
+        If zstandard is not installed
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "zstd compressed flights need the zstandard package - install it with 'pip install zstandard'"
+        )
+    return zstandard
+
+
+def is_flight_file(path: Path) -> bool:
+    """Checks whether a path is named like a (possibly compressed) flight file.
+
+    Parameters
+    ----------
+    path : Path
+        Path to check
+
+    Returns
+    -------
+    bool
+        True for .json, .json.gz and .json.zst files
+    """
+    return any(Path(path).name.endswith(i) for i in FLIGHT_SUFFIXES)
+
+
+def flight_name(path: Path) -> str:
+    """Gets a flight's name from its path, without any .json/.json.gz/.json.zst suffix.
+
+    Parameters
+    ----------
+    path : Path
+        Path to a flight file
+
+    Returns
+    -------
+    str
+        The flight name, e.g. 3c6444-20200525-004231
+    """
+    name = Path(path).name
+    for suffix in sorted(FLIGHT_SUFFIXES, key=len, reverse=True):
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+def export_flight_name(icao24: str, start) -> str:
+    """Builds the name a flight is exported under.
+
+    Parameters
+    ----------
+    icao24 : str
+        The flight's ICAO24 address
+    start : datetime.datetime
+        Time of the flight's first position report
+
+    Returns
+    -------
+    str
+        The flight name, e.g. 3c6444-20200525-004231
+    """
+    return "{}-{}".format(icao24, start.strftime("%Y%m%d-%H%M%S"))
+
+
+def has_manifest(directory: Path) -> bool:
+    """Checks if a flight directory has a manifest, which must be kept up to date as flights are added."""
+    return (Path(directory) / MANIFEST_FILENAME).exists()
+
+
+def load_manifest(directory: Path) -> dict:
+    """Loads a flight directory's manifest.
+
+    Parameters
+    ----------
+    directory : Path
+        Flight directory
+
+    Returns
+    -------
+    dict
+        The manifest, or None if the directory doesn't have one
+    """
+    path = Path(directory) / MANIFEST_FILENAME
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def find_flight_files(directory: Path) -> list:
+    """Lists the flight files in a directory, compressed or not.
+
+    Directories with a manifest are listed from it (which also finds sharded flights), otherwise the directory itself is listed.
+
+    Parameters
+    ----------
+    directory : Path
+        Directory to search
+
+    Returns
+    -------
+    list
+        Paths of flight files, sorted by name
+    """
+    manifest = load_manifest(directory)
+    if manifest is not None:
+        return [Path(directory) / i["name"] for i in manifest["trajectories"]]
+    return sorted(
+        i
+        for i in Path(directory).iterdir()
+        if i.is_file() and is_flight_file(i) and i.name != MANIFEST_FILENAME
+    )
+
+
+def flight_list_name(path: Path, directory: Path) -> str:
+    """Gets a flight's name as used in trajectory lists - its path relative to the trajectory directory.
+
+    Parameters
+    ----------
+    path : Path
+        Path to a flight file
+    directory : Path
+        The trajectory directory it is in (PARAM_TRAJECTORY_FILEPATH, for the simulator)
+
+    Returns
+    -------
+    str
+        Relative path, e.g. 3c6444-20200525-004231.json, or 20200525/3c/3c6444-20200525-004231.json if sharded
+    """
+    return Path(path).relative_to(directory).as_posix()
+
+
+def detect_compression(path: Path) -> str:
+    """Detects a file's compression from its first bytes.
+
+    Parameters
+    ----------
+    path : Path
+        Path to the file
+
+    Returns
+    -------
+    str
+        'gzip', 'zstd', or None for uncompressed files
+    """
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return None
+
+
+def read_flight_bytes(path: Path) -> bytes:
+    """Reads a flight file, decompressing it if needed.
+
+    Parameters
+    ----------
+    path : Path
+        Path to a flight file
+
+    Returns
+    -------
+    bytes
+        The uncompressed JSON
+    """
+    compression = detect_compression(path)
+    with open(path, "rb") as f:
+        if compression == "gzip":
+            return gzip.decompress(f.read())
+        if compression == "zstd":
+            reader = import_zstandard().ZstdDecompressor().stream_reader(f)
+            return reader.read()
+        return f.read()
+
+
+def load_flight_json(path: Path) -> dict:
+    """Loads a flight JSON file, decompressing it if needed.
+
+    Parameters
+    ----------
+    path : Path
+        Path to a flight file
+
+    Returns
+    -------
+    dict
+        The flight JSON
+    """
+    return json.loads(read_flight_bytes(path))
+
+
+def flight_filename(name: str, compression: str = None) -> str:
+    """Builds the filename for a flight.
+
+    Parameters
+    ----------
+    name : str
+        Flight name, without a suffix
+    compression : str, optional
+        'gzip', 'zstd' or None, by default None
+
+    Returns
+    -------
+    str
+        Filename with the matching suffix
+    """
+    return name + COMPRESSION_SUFFIXES[compression]
+
+
+def shard_directory(icao24: str, date: str) -> str:
+    """Builds the sharded layout's subdirectory for a flight.
+
+    Parameters
+    ----------
+    icao24 : str
+        The flight's ICAO24 address
+    date : str
+        The flight's start date, as YYYYmmdd
+
+    Returns
+    -------
+    str
+        Subdirectory, e.g. 20200525/3c
+    """
+    return "{}/{}".format(date, icao24[:SHARD_ICAO_PREFIX])
+
+
+def dump_flight_json(
+    flight_json: dict,
+    path: Path,
+    compression: str = None,
+    level: int = None,
+    default=None,
+):
+    """Writes a flight JSON file, optionally compressed.
+
+    Parameters
+    ----------
+    flight_json : dict
+        The flight JSON
+    path : Path
+        File to write to
+    compression : str, optional
+        'gzip', 'zstd' or None for plain JSON, by default None
+    level : int, optional
+        Compression level, by default DEFAULT_COMPRESSION_LEVELS for the chosen compression
+    default : function, optional
+        Passed to json.dumps to serialise unsupported types, by default None
+
+    Raises
+    ------
+    ValueError
+        If the compression is not recognised
+    """
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError("Unknown compression {}".format(compression))
+    if level is None and compression is not None:
+        level = DEFAULT_COMPRESSION_LEVELS[compression]
+
+    data = json.dumps(flight_json, default=default).encode("utf-8")
+    if compression == "gzip":
+        # mtime=0 keeps output identical between runs
+        data = gzip.compress(data, compresslevel=level, mtime=0)
+    elif compression == "zstd":
+        data = import_zstandard().ZstdCompressor(level=level).compress(data)
+
+    with open(path, "wb") as f:
+        f.write(data)
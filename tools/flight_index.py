@@ -0,0 +1,316 @@
+"""
+flight_index.py
+
+A persistent index of exported flights' fingerprints, so the pipeline can skip flights it has already exported - including near-duplicates from overlapping extractions, which start at slightly different times and so get different names.
+
+A flight's fingerprint is a set of hashes, one for each minute boundary (of UTC time) it spans: its ICAO24, the time, and its interpolated position and altitude at that time, quantized. Two copies of a flight built from overlapping reports share most of these, however they were cut. Only hashes divisible by SAMPLE_MODULUS are stored, which shrinks the index but still picks the same samples from every copy of a flight. Flights are duplicates when the shared samples make up at least the similarity threshold of the larger flight's samples, so a fragment of a flight (e.g. one cut at an input file boundary) doesn't duplicate the whole flight. A flight holding every sample of an indexed flight and more extends it rather than duplicating it, so whole flights are still exported after their fragments have been indexed (replacing any fragment with the same name, i.e. the same ICAO24 and start time). Otherwise a flight with the same name as an indexed one is a duplicate of it. A flight whose samples are all in an indexed flight duplicates it, so fragments of indexed flights are skipped.
+
+The index is a SQLite database, with the stored samples indexed by hash, so lookups stay fast with millions of flights indexed. Run this file directly to index an existing export directory, or to show what an index holds.
+"""
+
+import sqlite3
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from flight_files import (
+    find_flight_files,
+    flight_list_name,
+    flight_name,
+    load_flight_json,
+)
+
+DEFAULT_SIMILARITY = 0.8
+
+# Seconds between fingerprint samples - samples are taken on multiples of
+# this (in UTC), so are at the same times in every copy of a flight
+SAMPLE_INTERVAL = 60
+# Degrees of latitude/longitude and metres of altitude samples are rounded to
+POSITION_STEP = 0.01
+ALTITUDE_STEP = 100
+# One in this many samples (by hash) is stored in the index
+SAMPLE_MODULUS = 4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS flights (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    path TEXT,
+    samples INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS samples (
+    hash INTEGER NOT NULL,
+    flight INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_hash ON samples (hash);
+CREATE TABLE IF NOT EXISTS duplicates (
+    name TEXT PRIMARY KEY,
+    original TEXT NOT NULL,
+    similarity REAL NOT NULL
+);
+"""
+
+
+def flight_fingerprint(input_df: pd.DataFrame) -> np.ndarray:
+    """Fingerprints a flight from quantized samples of its trajectory.
+
+    Parameters
+    ----------
+    input_df : pd.DataFrame
+        Position reports for a single flight, with time, icao24, lat, lon and baroaltitude columns
+
+    Returns
+    -------
+    np.ndarray
+        Stored sample hashes (int64), sorted. Flights shorter than SAMPLE_INTERVAL may have none.
+    """
+    input_df = input_df.sort_values("time")
+    times = input_df["time"].values.astype(np.float64)
+    grid = np.arange(
+        np.ceil(times[0] / SAMPLE_INTERVAL) * SAMPLE_INTERVAL,
+        times[-1] + 1e-9,
+        SAMPLE_INTERVAL,
+    )
+    if len(grid) == 0:
+        return np.array([], dtype=np.int64)
+
+    samples = pd.DataFrame(
+        {
+            "icao24": input_df["icao24"].iloc[0],
+            "time": grid.astype(np.int64),
+        }
+    )
+    for column, step in [
+        ("lat", POSITION_STEP),
+        ("lon", POSITION_STEP),
+        ("baroaltitude", ALTITUDE_STEP),
+    ]:
+        values = np.interp(grid, times, input_df[column].values.astype(np.float64))
+        samples[column] = np.round(values / step).astype(np.int64)
+
+    hashes = pd.util.hash_pandas_object(samples, index=False).values
+    stored = hashes[hashes % np.uint64(SAMPLE_MODULUS) == 0]
+    if len(stored) == 0:
+        # Keep a sample of short flights, so exact copies are still caught
+        stored = hashes[:1]
+    # SQLite integers are signed
+    return np.unique(stored.view(np.int64))
+
+
+class FlightIndex:
+    """A SQLite index of exported flights and their fingerprints.
+
+    Parameters
+    ----------
+    index_path : Path
+        Database file, created if it doesn't exist
+    similarity : float, optional
+        Share of the larger flight's samples two flights must share to be duplicates, by default DEFAULT_SIMILARITY
+    """
+
+    def __init__(self, index_path: Path, similarity: float = DEFAULT_SIMILARITY):
+        self.similarity = similarity
+        self.connection = sqlite3.connect(str(index_path))
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def find(self, name: str, fingerprint: np.ndarray) -> tuple:
+        """Looks for an indexed flight which a flight duplicates.
+
+        Parameters
+        ----------
+        name : str
+            Flight name
+        fingerprint : np.ndarray
+            The flight's fingerprint, as from flight_fingerprint
+
+        Returns
+        -------
+        tuple
+            The duplicated flight's name and the similarity, or None if the flight isn't a duplicate
+        """
+        # The same name means the same aircraft and start time, so the same
+        # flight - only kept if it's longer, e.g. stitched from fragments
+        same_name = self.connection.execute(
+            "SELECT samples FROM flights WHERE name = ?", (name,)
+        ).fetchone()
+        if same_name is not None and same_name[0] >= len(fingerprint):
+            return name, 1.0
+        if len(fingerprint) == 0:
+            return None
+
+        rows = self.connection.execute(
+            "SELECT flights.name, flights.samples, COUNT(*) FROM samples"
+            " JOIN flights ON flights.id = samples.flight"
+            " WHERE samples.hash IN ({}) GROUP BY samples.flight".format(
+                ",".join("?" * len(fingerprint))
+            ),
+            fingerprint.tolist(),
+        ).fetchall()
+        best = None
+        for original, samples, shared in rows:
+            if shared == samples and len(fingerprint) > samples:
+                # The indexed flight is part of this one (e.g. a fragment this
+                # flight was stitched together from), so this one adds to it
+                continue
+            similarity = shared / max(samples, len(fingerprint))
+            # A flight wholly within an indexed one adds nothing to it
+            contained = shared == len(fingerprint)
+            if (contained or similarity >= self.similarity) and (
+                best is None or similarity > best[1]
+            ):
+                best = (original, similarity)
+        return best
+
+    def add(self, name: str, path: str, fingerprint: np.ndarray):
+        """Indexes a flight, replacing any indexed flight of the same name.
+
+        find only lets a flight share its name with an indexed one when it is longer, e.g. the flight stitched back together from a fragment cut at an input file boundary, in which case the new export overwrites the old one.
+
+        Parameters
+        ----------
+        name : str
+            Flight name
+        path : str
+            Path of the exported flight
+        fingerprint : np.ndarray
+            The flight's fingerprint, as from flight_fingerprint
+        """
+        self.connection.execute(
+            "DELETE FROM samples WHERE flight IN (SELECT id FROM flights WHERE name = ?)",
+            (name,),
+        )
+        self.connection.execute("DELETE FROM flights WHERE name = ?", (name,))
+        cursor = self.connection.execute(
+            "INSERT INTO flights (name, path, samples) VALUES (?, ?, ?)",
+            (name, path, len(fingerprint)),
+        )
+        self.connection.executemany(
+            "INSERT INTO samples (hash, flight) VALUES (?, ?)",
+            [(i, cursor.lastrowid) for i in fingerprint.tolist()],
+        )
+
+    def link(self, name: str, original: str, similarity: float):
+        """Records that a flight was skipped as a duplicate of an indexed one.
+
+        Parameters
+        ----------
+        name : str
+            Name of the duplicate flight
+        original : str
+            Name of the indexed flight it duplicates
+        similarity : float
+            Share of samples the flights share
+        """
+        self.connection.execute(
+            "INSERT OR REPLACE INTO duplicates (name, original, similarity) VALUES (?, ?, ?)",
+            (name, original, similarity),
+        )
+
+    def commit(self):
+        """Saves changes to disk."""
+        self.connection.commit()
+
+    def close(self):
+        """Saves changes and closes the database."""
+        self.connection.commit()
+        self.connection.close()
+
+    def stats(self) -> dict:
+        """Counts the flights, samples and duplicate links held."""
+        return {
+            table: self.connection.execute(
+                "SELECT COUNT(*) FROM {}".format(table)
+            ).fetchone()[0]
+            for table in ["flights", "samples", "duplicates"]
+        }
+
+    def duplicates(self) -> list:
+        """Lists recorded duplicates, as (name, original, similarity)."""
+        return self.connection.execute(
+            "SELECT name, original, similarity FROM duplicates ORDER BY name"
+        ).fetchall()
+
+
+def index_directory(index: FlightIndex, directory: Path, link: bool = False) -> tuple:
+    """Indexes the flights in an export directory, reporting any which duplicate flights already indexed.
+
+    Parameters
+    ----------
+    index : FlightIndex
+        Index to add to
+    directory : Path
+        Directory of exported flights
+    link : bool, optional
+        Record duplicates found, by default False
+
+    Returns
+    -------
+    tuple
+        Number of flights indexed, and a list of (path, original name, similarity) for each duplicate
+    """
+    added = 0
+    duplicates = []
+    for path in find_flight_files(directory):
+        input_df = pd.DataFrame(load_flight_json(path)["data"])
+        name = flight_name(path)
+        fingerprint = flight_fingerprint(input_df)
+        match = index.find(name, fingerprint)
+        if match is None:
+            index.add(name, flight_list_name(path, directory), fingerprint)
+            added += 1
+        else:
+            duplicates.append((path, *match))
+            if link and match[0] != name:
+                index.link(name, *match)
+    index.commit()
+    return added, duplicates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Builds and inspects the duplicate flight index used by opensky_extraction_pipeline.py --dedup_index.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "command",
+        choices=["add", "stats", "duplicates"],
+        help="add indexes an existing export directory, stats counts what is indexed, duplicates lists duplicates recorded with --dedup_action link.",
+    )
+    parser.add_argument("index_path", type=str, help="Index database file.")
+    parser.add_argument(
+        "input_path",
+        type=str,
+        nargs="?",
+        help="Export directory to index, for the add command.",
+        default=None,
+    )
+    parser.add_argument(
+        "--similarity",
+        type=float,
+        help="Share of the larger flight's fingerprint samples two flights must share to be duplicates.",
+        default=DEFAULT_SIMILARITY,
+    )
+    args = parser.parse_args()
+
+    index = FlightIndex(args.index_path, args.similarity)
+    if args.command == "add":
+        if args.input_path is None:
+            parser.error("add needs an input_path")
+        added, duplicates = index_directory(index, args.input_path, link=True)
+        for path, original, similarity in duplicates:
+            print("{} duplicates {} ({:.0%})".format(path, original, similarity))
+        print("Indexed {} flights, {} duplicates".format(added, len(duplicates)))
+    elif args.command == "stats":
+        print(
+            "{flights} flights, {samples} samples, {duplicates} duplicates recorded".format(
+                **index.stats()
+            )
+        )
+    else:
+        for name, original, similarity in index.duplicates():
+            print("{} -> {} ({:.0%})".format(name, original, similarity))
+    index.close()
@@ -0,0 +1,286 @@
+"""
+flight_iterator.py
+
+A Python API for streaming cleaned flights, for notebooks and drivers which would otherwise run the pipeline and re-read its JSON output, or reimplement its cleaning themselves.
+
+iter_flights lazily yields flights one at a time, either cleaned from raw inputs (HDF, CSV or tar files, run through the same stages as opensky_extraction_pipeline.py) or loaded from an existing export directory. Each flight is a Flight, holding its columns as NumPy arrays along with its name and metadata. Only one input file (or batch of exported flights) is held at a time, or a few more with prefetching, so millions of flights can be streamed in constant memory:
+
+    from flight_iterator import iter_flights
+
+    for flight in iter_flights(["input_data/hdfs/"], altitude_min=1500, prefetch=4):
+        print(flight.name, len(flight), flight["baroaltitude"].max())
+"""
+
+import argparse
+import traceback
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from flight_files import (
+    export_flight_name,
+    find_flight_files,
+    flight_name,
+    is_flight_file,
+    load_flight_json,
+)
+from metrics import Metrics
+from opensky_extraction_pipeline import (
+    add_input_arguments,
+    add_threshold_arguments,
+    build_preprocessing_stages,
+    build_threshold_stages,
+    flight_metadata,
+    run_stages,
+)
+from stage_cache import StageCache
+
+# Number of exported flights loaded per task
+EXPORT_BATCH_SIZE = 256
+
+# Columns added by the pipeline which aren't kept in Flight arrays - timestamp
+# duplicates time, and flight labels are only unique within an input file
+DROPPED_COLUMNS = ["timestamp", "flight_label"]
+
+
+class Flight:
+    """A cleaned flight, with its position reports held as NumPy arrays.
+
+    Parameters
+    ----------
+    name : str
+        Flight name, e.g. 3c6444-20200525-004231
+    metadata : dict
+        Altitude summary, as saved with exported flights
+    columns : dict
+        Column name -> array of values, in time order
+    """
+
+    __slots__ = ["name", "metadata", "columns"]
+
+    def __init__(self, name: str, metadata: dict, columns: dict):
+        self.name = name
+        self.metadata = metadata
+        self.columns = columns
+
+    def __len__(self) -> int:
+        return len(self.columns["time"])
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.columns[column]
+
+    def __repr__(self) -> str:
+        return "Flight({!r}, {} points)".format(self.name, len(self))
+
+    @property
+    def icao24(self) -> str:
+        """The flight's ICAO24 address."""
+        return self.columns["icao24"][0]
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Gets the flight's position reports as a DataFrame."""
+        return pd.DataFrame(self.columns)
+
+    @classmethod
+    def from_dataframe(cls, input_df: pd.DataFrame) -> "Flight":
+        """Builds a Flight from one flight's cleaned position reports, as output by the pipeline.
+
+        Parameters
+        ----------
+        input_df : pd.DataFrame
+            Cleaned position reports for one flight
+
+        Returns
+        -------
+        Flight
+            The flight, named as it would be exported
+        """
+        input_df = input_df.sort_values("time")
+        name = export_flight_name(
+            input_df["icao24"].iloc[0], input_df["timestamp"].iloc[0]
+        )
+        metadata = {i: float(j) for i, j in flight_metadata(input_df).items()}
+        columns = {
+            i: input_df[i].to_numpy()
+            for i in input_df.columns
+            if i not in DROPPED_COLUMNS
+        }
+        return cls(name, metadata, columns)
+
+    @classmethod
+    def from_json(cls, name: str, flight_json: dict) -> "Flight":
+        """Builds a Flight from an exported flight's JSON.
+
+        Parameters
+        ----------
+        name : str
+            Flight name
+        flight_json : dict
+            Loaded JSON, with metadata and data
+
+        Returns
+        -------
+        Flight
+            The flight
+        """
+        input_df = pd.DataFrame(flight_json["data"]).sort_values("time")
+        columns = {
+            i: input_df[i].to_numpy()
+            for i in input_df.columns
+            if i not in DROPPED_COLUMNS
+        }
+        return cls(name, flight_json["metadata"], columns)
+
+
+def pipeline_options(**options) -> argparse.Namespace:
+    """Builds the pipeline options used to clean raw inputs, starting from the command line defaults.
+
+    Parameters
+    ----------
+    **options
+        Options to override, named as on the command line - thresholds such as altitude_min or invalid_tolerance, filters such as bbox or icao_list (as parsed values, e.g. a tuple or set), chunksize, workers and cache_path
+
+    Returns
+    -------
+    argparse.Namespace
+        Options, as for build_preprocessing_stages and build_threshold_stages
+
+    Raises
+    ------
+    TypeError
+        If an option isn't a pipeline option
+    """
+    parser = argparse.ArgumentParser()
+    add_threshold_arguments(parser)
+    add_input_arguments(parser)
+    args = parser.parse_args([])
+    for name, value in options.items():
+        if not hasattr(args, name):
+            raise TypeError("Unknown pipeline option {!r}".format(name))
+        setattr(args, name, value)
+    return args
+
+
+def flight_tasks(paths: list):
+    """Splits inputs into tasks, each loading a batch of flights.
+
+    Parameters
+    ----------
+    paths : list
+        Raw input files, exported flight files, or directories of either
+
+    Yields
+    ------
+    tuple
+        ('raw', path) for an input file to clean, or ('exported', paths) for a batch of exported flights
+    """
+    if isinstance(paths, (str, Path)):
+        paths = [paths]
+    for path in map(Path, paths):
+        if path.is_dir():
+            exported = find_flight_files(path)
+            if exported:
+                for i in range(0, len(exported), EXPORT_BATCH_SIZE):
+                    yield ("exported", exported[i : i + EXPORT_BATCH_SIZE])
+            else:
+                for input_path in sorted(path.iterdir()):
+                    yield ("raw", input_path)
+        elif is_flight_file(path):
+            yield ("exported", [path])
+        else:
+            yield ("raw", path)
+
+
+def load_task(task: tuple, args: argparse.Namespace) -> list:
+    """Loads the flights of a task from flight_tasks.
+
+    Parameters
+    ----------
+    task : tuple
+        Task, as from flight_tasks
+    args : argparse.Namespace
+        Pipeline options, as from pipeline_options
+
+    Returns
+    -------
+    list
+        Flights, in order
+    """
+    kind, path = task
+    if kind == "exported":
+        return [Flight.from_json(flight_name(i), load_flight_json(i)) for i in path]
+
+    metrics = Metrics()
+    cache = None
+    if args.cache_path is not None:
+        cache = StageCache(args.cache_path, int(args.cache_max_size * 1024**2))
+    stages = build_preprocessing_stages(args, metrics) + build_threshold_stages(
+        args, metrics
+    )
+    output_df = run_stages(path, stages, metrics, cache)
+    if output_df.shape[0] == 0:
+        return []
+    return [
+        Flight.from_dataframe(flight)
+        for _, flight in output_df.groupby(["icao24", "flight_label"])
+    ]
+
+
+def iter_flights(paths, prefetch: int = 0, skip_errors: bool = False, **options):
+    """Lazily yields cleaned flights from raw inputs or exported flights.
+
+    Raw inputs are cleaned as opensky_extraction_pipeline.py would, a file at a time. Directories are treated as exports if they hold flight files (or a manifest), and as directories of raw inputs otherwise. Flights are yielded in input order.
+
+    Parameters
+    ----------
+    paths : str, Path or list
+        Raw input files, exported flight files, or directories of either
+    prefetch : int, optional
+        Number of input files (or batches of exported flights) to load ahead in worker processes, by default 0 (load as iterated, in this process)
+    skip_errors : bool, optional
+        Print and skip inputs which fail to load rather than raising, by default False
+    **options
+        Pipeline options for cleaning raw inputs, named as on the command line, e.g. altitude_min=1500 (see pipeline_options)
+
+    Yields
+    ------
+    Flight
+        Cleaned flights
+    """
+    args = pipeline_options(**options)
+    tasks = flight_tasks(paths)
+
+    def results(task, load):
+        try:
+            return load()
+        except Exception:
+            if not skip_errors:
+                raise
+            print("Error on {}".format(task[1]))
+            traceback.print_exc()
+            return []
+
+    if prefetch <= 0:
+        for task in tasks:
+            yield from results(task, lambda: load_task(task, args))
+        return
+
+    executor = ProcessPoolExecutor(max_workers=prefetch)
+    pending = deque()
+    try:
+        for task in tasks:
+            pending.append((task, executor.submit(load_task, task, args)))
+            if len(pending) > prefetch:
+                task, future = pending.popleft()
+                yield from results(task, future.result)
+        while pending:
+            task, future = pending.popleft()
+            yield from results(task, future.result)
+    finally:
+        # Don't start loading anything else if iteration stops early
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown()
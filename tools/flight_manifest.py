@@ -0,0 +1,278 @@
+"""
+flight_manifest.py
+
+Manifests for directories of exported flights, and views of sharded directories for tools which expect flights in one flat directory.
+
+A manifest is a manifest.json in the flight directory. Its "trajectories" list has the path of each flight, relative to the directory, and its size, sorted by flight name so the order doesn't depend on the layout or the filesystem. It uses the same format as trajectory lists, so the simulator reads it instead of listing PARAM_TRAJECTORY_FILEPATH, and find_flight_files reads it instead of listing the directory.
+
+Run this file directly to rebuild a manifest from the files on disk, print a flat listing, or build a directory of symlinks to sharded flights.
+"""
+
+import os
+import json
+import time
+import argparse
+from pathlib import Path
+
+from flight_files import (
+    MANIFEST_FILENAME,
+    flight_list_name,
+    flight_name,
+    is_flight_file,
+    load_manifest,
+)
+
+# How often a ManifestWriter rewrites the manifest, in seconds and new flights
+DEFAULT_MANIFEST_INTERVAL = 60
+DEFAULT_MANIFEST_BATCH = 1000
+
+
+def manifest_entry(directory: Path, name: str) -> dict:
+    """Builds the manifest entry for a flight.
+
+    Parameters
+    ----------
+    directory : Path
+        Flight directory
+    name : str
+        Path of the flight relative to directory
+
+    Returns
+    -------
+    dict
+        The flight's name and size in bytes
+    """
+    return {"name": name, "size": (Path(directory) / name).stat().st_size}
+
+
+def write_manifest(directory: Path, entries: list, layout: str):
+    """Writes a directory's manifest, replacing any existing one.
+
+    The manifest is written under a temporary name and renamed, so readers never see a partial file.
+
+    Parameters
+    ----------
+    directory : Path
+        Flight directory
+    entries : list
+        Manifest entries, as from manifest_entry
+    layout : str
+        'flat' or 'sharded'
+    """
+    entries = sorted(entries, key=lambda x: (flight_name(x["name"]), x["name"]))
+    manifest = {
+        "layout": layout,
+        "total_trajectories": len(entries),
+        "total_size": sum(i["size"] for i in entries),
+        "trajectories": entries,
+    }
+    path = Path(directory) / MANIFEST_FILENAME
+    tmp_path = path.with_suffix(".json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def update_manifest(directory: Path, names: list, layout: str):
+    """Adds newly exported flights to a directory's manifest, creating it if needed.
+
+    A new manifest lists every flight already in the directory, not just the new ones, as readers of the directory only look at the manifest once there is one.
+
+    Parameters
+    ----------
+    directory : Path
+        Flight directory
+    names : list
+        Paths of the new flights, relative to directory
+    layout : str
+        'flat' or 'sharded'
+    """
+    manifest = load_manifest(directory)
+    if manifest is not None:
+        entries = {i["name"]: i for i in manifest["trajectories"]}
+    else:
+        entries = {
+            i: manifest_entry(directory, i)
+            for i in scan_flights(directory)
+            if i not in names
+        }
+    for name in names:
+        entries[name] = manifest_entry(directory, name)
+    write_manifest(directory, list(entries.values()), layout)
+
+
+class ManifestWriter:
+    """Batches manifest updates for long running exports, which would otherwise rewrite the whole manifest for every few flights.
+
+    Parameters
+    ----------
+    directory : Path
+        Flight directory
+    layout : str
+        'flat' or 'sharded'
+    interval : float, optional
+        Most seconds new flights wait to be written to the manifest, by default DEFAULT_MANIFEST_INTERVAL
+    batch : int, optional
+        Number of new flights which triggers a write sooner, by default DEFAULT_MANIFEST_BATCH
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        layout: str,
+        interval: float = DEFAULT_MANIFEST_INTERVAL,
+        batch: int = DEFAULT_MANIFEST_BATCH,
+    ):
+        self.directory = directory
+        self.layout = layout
+        self.interval = interval
+        self.batch = batch
+        self.pending = []
+        self.last_write = time.monotonic()
+
+    def add(self, names: list):
+        """Queues newly exported flights, writing the manifest if enough flights or time have built up.
+
+        Parameters
+        ----------
+        names : list
+            Paths of the new flights, relative to directory
+        """
+        self.pending.extend(names)
+        if (
+            len(self.pending) >= self.batch
+            or time.monotonic() - self.last_write >= self.interval
+        ):
+            self.flush()
+
+    def flush(self):
+        """Writes any queued flights to the manifest."""
+        if self.pending:
+            update_manifest(self.directory, self.pending, self.layout)
+            self.pending = []
+        self.last_write = time.monotonic()
+
+
+def scan_flights(directory: Path) -> list:
+    """Finds every flight file under a directory, including in shard subdirectories.
+
+    Parameters
+    ----------
+    directory : Path
+        Flight directory
+
+    Returns
+    -------
+    list
+        Paths of the flights, relative to directory
+    """
+    names = []
+    for root, _, files in os.walk(directory):
+        for filename in files:
+            path = Path(root) / filename
+            if is_flight_file(path) and filename != MANIFEST_FILENAME:
+                names.append(flight_list_name(path, directory))
+    return names
+
+
+def rebuild_manifest(directory: Path) -> dict:
+    """Rewrites a directory's manifest from the flights on disk.
+
+    Parameters
+    ----------
+    directory : Path
+        Flight directory
+
+    Returns
+    -------
+    dict
+        The new manifest
+    """
+    names = scan_flights(directory)
+    layout = "sharded" if any("/" in i for i in names) else "flat"
+    write_manifest(directory, [manifest_entry(directory, i) for i in names], layout)
+    return load_manifest(directory)
+
+
+def link_flat_view(directory: Path, view_path: Path) -> int:
+    """Builds a flat directory of symlinks to every flight in a manifest.
+
+    Parameters
+    ----------
+    directory : Path
+        Flight directory, with a manifest
+    view_path : Path
+        Directory to create the symlinks in
+
+    Returns
+    -------
+    int
+        Number of symlinks created
+
+    Raises
+    ------
+    FileNotFoundError
+        If the directory has no manifest
+    ValueError
+        If two flights share a filename, so can't both be linked
+    """
+    manifest = load_manifest(directory)
+    if manifest is None:
+        raise FileNotFoundError("No {} in {}".format(MANIFEST_FILENAME, directory))
+    view_path = Path(view_path)
+    view_path.mkdir(parents=True, exist_ok=True)
+
+    created = 0
+    seen = set()
+    for entry in manifest["trajectories"]:
+        target = (Path(directory) / entry["name"]).resolve()
+        link = view_path / target.name
+        if target.name in seen:
+            raise ValueError("More than one flight is named {}".format(target.name))
+        seen.add(target.name)
+        if link.is_symlink() or link.exists():
+            if link.resolve() == target:
+                continue
+            link.unlink()
+        link.symlink_to(target)
+        created += 1
+    return created
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rebuilds flight directory manifests, and lists or links sharded flights for tools expecting a flat directory.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "command",
+        choices=["rebuild", "list", "link"],
+        help="rebuild rewrites manifest.json from the files on disk, list prints each flight's path (one per line), link builds a flat directory of symlinks.",
+    )
+    parser.add_argument("input_path", type=str, help="Flight directory.")
+    parser.add_argument(
+        "--view_path",
+        type=str,
+        help="Directory to create symlinks in, for the link command.",
+        default=None,
+    )
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        manifest = rebuild_manifest(args.input_path)
+        print(
+            "Listed {} flights ({} layout) in {}".format(
+                manifest["total_trajectories"], manifest["layout"], MANIFEST_FILENAME
+            )
+        )
+    elif args.command == "list":
+        manifest = load_manifest(args.input_path)
+        if manifest is None:
+            parser.error("No {} in {}".format(MANIFEST_FILENAME, args.input_path))
+        for entry in manifest["trajectories"]:
+            print(entry["name"])
+    else:
+        if args.view_path is None:
+            parser.error("link needs --view_path")
+        created = link_flat_view(args.input_path, args.view_path)
+        print("Linked {} flights into {}".format(created, args.view_path))
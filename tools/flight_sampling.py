@@ -0,0 +1,256 @@
+"""
+flight_sampling.py
+
+Reservoir sampling of validated flights, so the extraction pipeline can export a fixed size random sample of everything it processes without holding (or writing) every flight.
+
+Each flight gets a random key from a hash of the seed and its name, so the sample only depends on the seed and the set of flights - not the order files are processed in. Weighted sampling uses the Efraimidis-Spirakis method, keeping the flights with the largest log(u) / weight keys. Flights can also be split into strata (altitude bands or hour of day). Each stratum keeps a reservoir as large as the whole sample, and once every flight has been offered the sample is split equally between strata, with the share of any stratum holding too few flights going to those with flights left over.
+"""
+
+import math
+import heapq
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from flight_files import export_flight_name
+
+STRATA = ["altitude", "hour"]
+WEIGHTS = ["uniform", "points", "duration"]
+
+# Edges (in metres) of the altitude bands flights are stratified into
+DEFAULT_ALTITUDE_BANDS = [3000, 6000, 9000]
+
+
+def sample_key(seed: int, name: str, weight: float = 1) -> float:
+    """Gives a flight its random sampling key - flights with the largest keys are kept.
+
+    Parameters
+    ----------
+    seed : int
+        Sampling seed
+    name : str
+        Flight name, e.g. 3c6444-20200525-004231
+    weight : float, optional
+        Sampling weight, by default 1
+
+    Returns
+    -------
+    float
+        log(u) / weight, for a u in (0, 1) hashed from the seed and name
+    """
+    digest = hashlib.sha256("{}:{}".format(seed, name).encode("utf-8")).digest()
+    u = (int.from_bytes(digest[:8], "big") + 1) / (2**64 + 1)
+    return math.log(u) / weight
+
+
+def flight_weight(input_df: pd.DataFrame, weight: str) -> float:
+    """Works out a flight's sampling weight.
+
+    Parameters
+    ----------
+    input_df : pd.DataFrame
+        Position reports for one flight
+    weight : str
+        'uniform', 'points' (number of position reports) or 'duration' (in seconds)
+
+    Returns
+    -------
+    float
+        The flight's weight
+    """
+    if weight == "points":
+        return float(len(input_df))
+    if weight == "duration":
+        duration = input_df["time"].max() - input_df["time"].min()
+        return max(float(duration), 1.0)
+    return 1.0
+
+
+def flight_stratum(input_df: pd.DataFrame, strata: str, altitude_bands: list) -> int:
+    """Works out which stratum a flight falls in.
+
+    Parameters
+    ----------
+    input_df : pd.DataFrame
+        Position reports for one flight
+    strata : str
+        'altitude' (band of the flight's median altitude) or 'hour' (UTC hour it starts in), or None
+    altitude_bands : list
+        Edges of the altitude bands, in metres
+
+    Returns
+    -------
+    int
+        Stratum index
+    """
+    if strata == "altitude":
+        return int(np.digitize(input_df["baroaltitude"].median(), altitude_bands))
+    if strata == "hour":
+        return int(input_df["timestamp"].iloc[0].hour)
+    return 0
+
+
+def stratum_count(strata: str, altitude_bands: list) -> int:
+    """Number of strata flights can fall in."""
+    if strata == "altitude":
+        return len(altitude_bands) + 1
+    if strata == "hour":
+        return 24
+    return 1
+
+
+def stratum_label(stratum: int, strata: str, altitude_bands: list) -> str:
+    """Describes a stratum, e.g. 3000-6000m or 14:00."""
+    if strata == "altitude":
+        edges = [None] + list(altitude_bands) + [None]
+        low, high = edges[stratum], edges[stratum + 1]
+        if low is None:
+            return "<{}m".format(high)
+        if high is None:
+            return ">={}m".format(low)
+        return "{}-{}m".format(low, high)
+    if strata == "hour":
+        return "{:02d}:00".format(stratum)
+    return "all"
+
+
+class FlightReservoir:
+    """A fixed size, reproducible random sample of the flights offered to it.
+
+    Parameters
+    ----------
+    size : int
+        Number of flights to sample
+    seed : int, optional
+        Sampling seed, by default 0
+    strata : str, optional
+        'altitude' or 'hour' to split the sample equally between strata, by default None
+    altitude_bands : list, optional
+        Edges of the altitude strata, in metres, by default DEFAULT_ALTITUDE_BANDS
+    weight : str, optional
+        'uniform', 'points' or 'duration', by default 'uniform'
+    """
+
+    def __init__(
+        self,
+        size: int,
+        seed: int = 0,
+        strata: str = None,
+        altitude_bands: list = None,
+        weight: str = "uniform",
+    ):
+        self.seed = seed
+        self.strata = strata
+        self.altitude_bands = (
+            DEFAULT_ALTITUDE_BANDS if altitude_bands is None else altitude_bands
+        )
+        self.weight = weight
+
+        self.size = size
+        count = stratum_count(strata, self.altitude_bands)
+        # Each stratum can hold the whole sample, as strata with too few
+        # flights for their share leave it to the others
+        self.heaps = [[] for _ in range(count)]
+        self.seen = [0] * count
+        # Position reports of each kept flight, by name
+        self.kept = {}
+
+    def offer(self, name: str, input_df: pd.DataFrame):
+        """Offers a flight to the sample, keeping it if its key is among the largest in its stratum.
+
+        A flight with the same name as one already kept (e.g. from overlapping input files) is ignored.
+
+        Parameters
+        ----------
+        name : str
+            Flight name, e.g. 3c6444-20200525-004231
+        input_df : pd.DataFrame
+            Position reports for the flight
+        """
+        if name in self.kept:
+            return
+        stratum = flight_stratum(input_df, self.strata, self.altitude_bands)
+        self.seen[stratum] += 1
+        if self.size <= 0:
+            return
+
+        key = sample_key(self.seed, name, flight_weight(input_df, self.weight))
+        # Heaps hold the smallest kept key first, so it's the one replaced
+        heap = self.heaps[stratum]
+        if len(heap) < self.size:
+            heapq.heappush(heap, (key, name))
+        elif (key, name) > heap[0]:
+            del self.kept[heapq.heapreplace(heap, (key, name))[1]]
+        else:
+            return
+        self.kept[name] = input_df
+
+    def offer_flights(self, input_df: pd.DataFrame):
+        """Offers every flight in a DataFrame of validated position reports.
+
+        Parameters
+        ----------
+        input_df : pd.DataFrame
+            Position reports, labelled into flights
+        """
+        for _, flight in input_df.groupby(["icao24", "flight_label"]):
+            name = export_flight_name(
+                flight["icao24"].iloc[0], flight["timestamp"].iloc[0]
+            )
+            self.offer(name, flight)
+
+    def quotas(self) -> list:
+        """Splits the sample between strata, as evenly as the flights held in each allow.
+
+        Returns
+        -------
+        list
+            Number of flights sampled from each stratum, adding up to the sample size or the number of flights held, whichever is smaller
+        """
+        quotas = [0] * len(self.heaps)
+        remaining = min(self.size, sum(len(i) for i in self.heaps))
+        while remaining > 0:
+            # Strata with flights left over share what is left, earlier ones
+            # taking any remainder
+            open_strata = [i for i, j in enumerate(self.heaps) if quotas[i] < len(j)]
+            share, extra = divmod(remaining, len(open_strata))
+            for n, i in enumerate(open_strata):
+                taken = min(
+                    share + (1 if n < extra else 0), len(self.heaps[i]) - quotas[i]
+                )
+                quotas[i] += taken
+                remaining -= taken
+        return quotas
+
+    def sampled_names(self) -> list:
+        """Gets the names of the sampled flights, the ones with the largest keys in each stratum."""
+        names = []
+        for heap, quota in zip(self.heaps, self.quotas()):
+            names.extend(name for _, name in heapq.nlargest(quota, heap))
+        return names
+
+    def flights(self) -> list:
+        """Gets the sampled flights.
+
+        Flights are kept separate, as flight labels are only unique within the file a flight came from.
+
+        Returns
+        -------
+        list
+            Position reports of each sampled flight, ordered by flight name
+        """
+        return [self.kept[name] for name in sorted(self.sampled_names())]
+
+    def summary(self) -> list:
+        """Describes how many flights were seen and sampled in each stratum.
+
+        Returns
+        -------
+        list
+            (stratum label, flights seen, flights sampled) for each stratum
+        """
+        return [
+            (stratum_label(i, self.strata, self.altitude_bands), seen, quota)
+            for i, (seen, quota) in enumerate(zip(self.seen, self.quotas()))
+        ]
@@ -0,0 +1,79 @@
+"""
+flight_stitching.py
+
+Carries flights which are still open at the end of one input file over to the next, so opensky_extraction_pipeline.py --stitch can join flights which cross hourly file boundaries instead of cutting them in two.
+
+After a file's reports are labelled into flights, any flight whose last report is within the split threshold of the file's last report might continue in the next file. Those flights are held back in an OpenFlightBuffer rather than processed, and their reports are put ahead of the next file's before it is labelled. Only open flights are held, so memory is bounded by the flights in the air at a file boundary, not by the number of files.
+"""
+
+import pandas as pd
+
+# Seconds without a report after which a flight is closed - the same as
+# label_points_into_flights uses to split flights
+DEFAULT_SPLIT_THRESHOLD = 60
+
+
+class OpenFlightBuffer:
+    """Holds the reports of flights still open at the end of an input file, to be joined with the next file's.
+
+    Parameters
+    ----------
+    split_threshold : float, optional
+        Seconds without a report after which a flight can't continue, by default DEFAULT_SPLIT_THRESHOLD
+    """
+
+    def __init__(self, split_threshold: float = DEFAULT_SPLIT_THRESHOLD):
+        self.split_threshold = split_threshold
+        self.open_df = None
+        self.flights = 0
+
+    def __len__(self) -> int:
+        return 0 if self.open_df is None else len(self.open_df)
+
+    def prepend(self, input_df: pd.DataFrame) -> pd.DataFrame:
+        """Puts the held flights' reports ahead of an input file's, emptying the buffer.
+
+        Parameters
+        ----------
+        input_df : pd.DataFrame
+            The next file's cleaned, unlabelled position reports
+
+        Returns
+        -------
+        pd.DataFrame
+            Held reports followed by the file's reports
+        """
+        if len(self) == 0:
+            return input_df
+        output_df = pd.concat([self.open_df, input_df], ignore_index=True)
+        self.open_df = None
+        self.flights = 0
+        return output_df
+
+    def hold_open_flights(
+        self, input_df: pd.DataFrame, end_time: float
+    ) -> pd.DataFrame:
+        """Holds flights which might continue past the end of the file, returning the rest.
+
+        Parameters
+        ----------
+        input_df : pd.DataFrame
+            Labelled position reports
+        end_time : float
+            Time of the file's last report
+
+        Returns
+        -------
+        pd.DataFrame
+            Reports of flights which ended at least split_threshold seconds before end_time
+        """
+        flights = input_df.groupby(["icao24", "flight_label"])["time"]
+        is_open = (flights.transform("max") >= end_time - self.split_threshold).values
+        # Labels are redone once the next file's reports are added
+        self.open_df = (
+            input_df[is_open].drop(columns=["flight_label"]).reset_index(drop=True)
+        )
+        self.flights = int(
+            input_df[is_open].groupby(["icao24", "flight_label"]).ngroups
+        )
+        return input_df[~is_open].reset_index(drop=True)
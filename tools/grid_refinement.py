@@ -0,0 +1,416 @@
+"""
+grid_refinement.py
+
+A planner for adaptive attacker grids in grid mode. Rather than simulating a uniformly dense grid of attacker positions, this reads the cost grid(s) from previous gridder runs, finds the grid cells whose corner costs disagree (or are uncertain), and writes a parameter file for the next round containing only the points needed to subdivide those cells.
+
+Each round, run the gridder with the generated parameter file, then run this again with all cost grids so far. The planner keeps its cell structure in a state file between rounds, and stops adding points once every cell is within tolerance, or the point budget is spent.
+"""
+
+import re
+import json
+import argparse
+import itertools
+from pathlib import Path
+
+import numpy as np
+
+from params_file import find_param_block, replace_param_block, set_param
+
+DEFAULT_TOLERANCE = 5.0
+DEFAULT_UNCERTAINTY_WEIGHT = 2.0
+DEFAULT_MAX_NEW_POINTS = 16
+DEFAULT_MIN_CELL_SIZE = 0.005
+
+LATLON_ENTRY_PATTERN = re.compile(
+    r'"(\w+)"\s*=>\s*\{\s*"lat"\s*=>\s*([-+\d.eE]+)\s*,\s*"lon"\s*=>\s*([-+\d.eE]+)\s*\}'
+)
+
+
+def read_attacker_latlon(params_text: str) -> dict:
+    """Reads the (uncommented) attacker grid points out of a simulator parameter file.
+
+    Parameters
+    ----------
+    params_text : str
+        Contents of a Julia parameter file, e.g. user_params.jl
+
+    Returns
+    -------
+    dict
+        Maps grid id to {"lat": float, "lon": float}
+
+    Raises
+    ------
+    ValueError
+        If the file has no PARAM_ATTACKER_LATLON definition
+    """
+    block = find_param_block(params_text, "PARAM_ATTACKER_LATLON")
+    uncommented = "\n".join(
+        i for i in block.splitlines() if not i.strip().startswith("#")
+    )
+    return {
+        grid_id: {"lat": float(lat), "lon": float(lon)}
+        for grid_id, lat, lon in LATLON_ENTRY_PATTERN.findall(uncommented)
+    }
+
+
+def write_attacker_latlon(
+    params_text: str, points: dict, output_filepath: str = None
+) -> str:
+    """Swaps the attacker grid in a parameter file for a new set of points.
+
+    Parameters
+    ----------
+    params_text : str
+        Contents of a Julia parameter file, used as a template
+    points : dict
+        Maps grid id to {"lat": float, "lon": float}
+    output_filepath : str, optional
+        If set, also replaces PARAM_OUTPUT_FILEPATH, by default None
+
+    Returns
+    -------
+    str
+        The new parameter file contents
+    """
+    new_text = replace_param_block(
+        params_text,
+        "PARAM_ATTACKER_LATLON",
+        {i: points[i] for i in sorted(points)},
+    )
+    if output_filepath is not None:
+        new_text = set_param(new_text, "PARAM_OUTPUT_FILEPATH", output_filepath)
+    return new_text
+
+
+def initial_cells(points: dict) -> list:
+    """Builds the starting cells from a rectilinear grid of points.
+
+    Parameters
+    ----------
+    points : dict
+        Maps grid id to {"lat": float, "lon": float}
+
+    Returns
+    -------
+    list
+        Cells, each a list of corner grid ids [south-west, south-east, north-west, north-east]. Only cells with all four corners present are included.
+    """
+    lookup = {(i["lat"], i["lon"]): grid_id for grid_id, i in points.items()}
+    lats = sorted({i["lat"] for i in points.values()})
+    lons = sorted({i["lon"] for i in points.values()})
+
+    cells = []
+    for (lat_0, lat_1), (lon_0, lon_1) in itertools.product(
+        zip(lats[:-1], lats[1:]), zip(lons[:-1], lons[1:])
+    ):
+        corners = [(lat_0, lon_0), (lat_0, lon_1), (lat_1, lon_0), (lat_1, lon_1)]
+        if all(i in lookup for i in corners):
+            cells.append([lookup[i] for i in corners])
+    return cells
+
+
+def load_cost_grids(paths: list) -> dict:
+    """Merges the best costs from one or more gridder cost grid files.
+
+    Parameters
+    ----------
+    paths : list
+        Paths to *-cost-grid.json files, as written by log_cost_grid
+
+    Returns
+    -------
+    dict
+        Maps grid id to a list of per-trajectory best costs
+    """
+    costs = {}
+    for path in paths:
+        with open(path, "r") as f:
+            grid = json.load(f)
+        for grid_id, trajectory_costs in grid.items():
+            costs.setdefault(grid_id, []).extend(
+                float(i) for i in trajectory_costs.values()
+            )
+    return costs
+
+
+def point_statistics(costs: dict) -> dict:
+    """Summarises the costs at each grid point.
+
+    Parameters
+    ----------
+    costs : dict
+        Maps grid id to a list of per-trajectory costs
+
+    Returns
+    -------
+    dict
+        Maps grid id to {"mean", "stderr", "count"}
+    """
+    stats = {}
+    for grid_id, values in costs.items():
+        values = np.array(values, dtype=float)
+        if len(values) == 0:
+            continue
+        stderr = values.std(ddof=1) / np.sqrt(len(values)) if len(values) > 1 else 0.0
+        stats[grid_id] = {
+            "mean": float(values.mean()),
+            "stderr": float(stderr),
+            "count": int(len(values)),
+        }
+    return stats
+
+
+def cell_priority(cell: list, stats: dict, uncertainty_weight: float) -> float:
+    """Scores how much a cell would benefit from being subdivided.
+
+    The score is the spread of mean costs across the cell's corners (i.e. the cost change across the cell), plus a multiple of the largest standard error at its corners.
+
+    Parameters
+    ----------
+    cell : list
+        Corner grid ids
+    stats : dict
+        Per point statistics, as returned by point_statistics
+    uncertainty_weight : float
+        Multiplier applied to the corner standard errors
+
+    Returns
+    -------
+    float
+        Refinement priority, or NaN if any corner has not been simulated yet
+    """
+    if not all(i in stats for i in cell):
+        return float("nan")
+    means = [stats[i]["mean"] for i in cell]
+    stderrs = [stats[i]["stderr"] for i in cell]
+    return (max(means) - min(means)) + uncertainty_weight * max(stderrs)
+
+
+def split_cell(cell: list, points: dict, lookup: dict, new_points: dict, prefix: str):
+    """Splits a cell into four, creating any midpoints that don't exist yet.
+
+    Parameters
+    ----------
+    cell : list
+        Corner grid ids [south-west, south-east, north-west, north-east]
+    points : dict
+        All existing grid points, updated in place with any new ones
+    lookup : dict
+        Maps rounded (lat, lon) to grid id, updated in place
+    new_points : dict
+        Points created this round, updated in place
+    prefix : str
+        Prefix for new grid ids
+
+    Returns
+    -------
+    list
+        The four new cells
+    """
+    south_west, south_east, north_west, north_east = [points[i] for i in cell]
+    lat_0, lat_1 = south_west["lat"], north_west["lat"]
+    lon_0, lon_1 = south_west["lon"], south_east["lon"]
+    lat_mid, lon_mid = (lat_0 + lat_1) / 2, (lon_0 + lon_1) / 2
+
+    def get_or_create(lat, lon):
+        key = (round(lat, 9), round(lon, 9))
+        if key not in lookup:
+            grid_id = "{}{}".format(prefix, len(new_points))
+            points[grid_id] = {"lat": lat, "lon": lon}
+            new_points[grid_id] = points[grid_id]
+            lookup[key] = grid_id
+        return lookup[key]
+
+    south = get_or_create(lat_0, lon_mid)
+    west = get_or_create(lat_mid, lon_0)
+    centre = get_or_create(lat_mid, lon_mid)
+    east = get_or_create(lat_mid, lon_1)
+    north = get_or_create(lat_1, lon_mid)
+
+    return [
+        [cell[0], south, west, centre],
+        [south, cell[1], centre, east],
+        [west, centre, cell[2], north],
+        [centre, east, north, cell[3]],
+    ]
+
+
+def plan_refinement(
+    state: dict,
+    stats: dict,
+    tolerance: float = DEFAULT_TOLERANCE,
+    max_new_points: int = DEFAULT_MAX_NEW_POINTS,
+    min_cell_size: float = DEFAULT_MIN_CELL_SIZE,
+    uncertainty_weight: float = DEFAULT_UNCERTAINTY_WEIGHT,
+) -> dict:
+    """Plans the next round of grid points, subdividing the highest priority cells first.
+
+    Parameters
+    ----------
+    state : dict
+        Planner state with "points", "cells" and "round", updated in place. "pending_cells" is set to the number of cells over tolerance left unsplit, and "waiting_cells" to the number with a corner not simulated yet.
+    stats : dict
+        Per point statistics, as returned by point_statistics
+    tolerance : float, optional
+        Cells with a priority at or below this are left alone, by default DEFAULT_TOLERANCE
+    max_new_points : int, optional
+        Maximum number of points to add this round, by default DEFAULT_MAX_NEW_POINTS
+    min_cell_size : float, optional
+        Cells with a side smaller than this (in degrees) are not split, by default DEFAULT_MIN_CELL_SIZE
+    uncertainty_weight : float, optional
+        Multiplier applied to corner standard errors, by default DEFAULT_UNCERTAINTY_WEIGHT
+
+    Returns
+    -------
+    dict
+        Points to simulate in the next round
+    """
+    points = state["points"]
+    lookup = {(round(i["lat"], 9), round(i["lon"], 9)): k for k, i in points.items()}
+    prefix = "r{}_".format(state["round"] + 1)
+
+    candidates = []
+    waiting = 0
+    for cell in state["cells"]:
+        priority = cell_priority(cell, stats, uncertainty_weight)
+        size = min(
+            points[cell[2]]["lat"] - points[cell[0]]["lat"],
+            points[cell[1]]["lon"] - points[cell[0]]["lon"],
+        )
+        if np.isnan(priority):
+            waiting += 1
+        elif priority > tolerance and size > min_cell_size:
+            candidates.append((priority, cell))
+    candidates.sort(key=lambda x: -x[0])
+
+    new_points = {}
+    new_cells = []
+    split = set()
+    for _, cell in candidates:
+        # Each split adds at most five points
+        if len(new_points) + 5 > max_new_points:
+            break
+        new_cells.extend(split_cell(cell, points, lookup, new_points, prefix))
+        split.add(tuple(cell))
+
+    state["cells"] = [i for i in state["cells"] if tuple(i) not in split] + new_cells
+    # The round only moves on once it has points to simulate
+    if new_points:
+        state["round"] += 1
+    state["pending_cells"] = len(candidates) - len(split)
+    state["waiting_cells"] = waiting
+    return new_points
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Plans the next round of an adaptive attacker grid, adding grid points only where the cost surface changes sharply or is uncertain.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "params_file",
+        type=str,
+        help="Simulator parameter file used as a template. On the first round, its PARAM_ATTACKER_LATLON is the starting grid.",
+    )
+    parser.add_argument(
+        "output_params_file",
+        type=str,
+        help="Parameter file to write for the next round, containing only the new grid points.",
+    )
+    parser.add_argument(
+        "--cost_grids",
+        type=str,
+        nargs="+",
+        required=True,
+        help="grid-cost-grid.json files from every round so far.",
+    )
+    parser.add_argument(
+        "--state_file",
+        type=str,
+        help="Planner state file, created on the first round and updated on each round after.",
+        default="grid_refinement_state.json",
+    )
+    parser.add_argument(
+        "--output_filepath",
+        type=str,
+        help="If set, replaces PARAM_OUTPUT_FILEPATH in the new parameter file so rounds don't overwrite each other.",
+        default=None,
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        help="Cells whose corner costs (plus uncertainty) differ by less than this are not refined.",
+        default=DEFAULT_TOLERANCE,
+    )
+    parser.add_argument(
+        "--uncertainty_weight",
+        type=float,
+        help="Multiplier applied to the standard error of corner costs when scoring cells.",
+        default=DEFAULT_UNCERTAINTY_WEIGHT,
+    )
+    parser.add_argument(
+        "--max_new_points",
+        type=int,
+        help="Budget of new grid points for this round.",
+        default=DEFAULT_MAX_NEW_POINTS,
+    )
+    parser.add_argument(
+        "--min_cell_size",
+        type=float,
+        help="Smallest cell side (in degrees) that can still be split.",
+        default=DEFAULT_MIN_CELL_SIZE,
+    )
+
+    args = parser.parse_args()
+
+    with open(args.params_file, "r") as f:
+        params_text = f.read()
+
+    state_path = Path(args.state_file)
+    if state_path.exists():
+        with open(state_path, "r") as f:
+            state = json.load(f)
+    else:
+        points = read_attacker_latlon(params_text)
+        state = {"round": 0, "points": points, "cells": initial_cells(points)}
+        print(
+            "Starting from {} points and {} cells".format(
+                len(points), len(state["cells"])
+            )
+        )
+
+    stats = point_statistics(load_cost_grids(args.cost_grids))
+    new_points = plan_refinement(
+        state,
+        stats,
+        args.tolerance,
+        args.max_new_points,
+        args.min_cell_size,
+        args.uncertainty_weight,
+    )
+
+    if len(new_points) == 0 and state["pending_cells"] > 0:
+        print("No points added - max_new_points is too small to split a cell.")
+    elif len(new_points) == 0 and state["waiting_cells"] > 0:
+        print(
+            "No points added - {} cells waiting for results from round {}. Pass every round's cost grid with --cost_grids.".format(
+                state["waiting_cells"], state["round"]
+            )
+        )
+    elif len(new_points) == 0:
+        print("Converged - no cells need refining.")
+    else:
+        # Only saved when a round is planned, so rerunning with the missing
+        # results plans the same round
+        with open(state_path, "w") as f:
+            json.dump(state, f, indent=2)
+        with open(args.output_params_file, "w") as f:
+            f.write(
+                write_attacker_latlon(params_text, new_points, args.output_filepath)
+            )
+        print(
+            "Round {}: {} new points, {} cells still over tolerance".format(
+                state["round"], len(new_points), state["pending_cells"]
+            )
+        )
@@ -0,0 +1,655 @@
+"""
+grid_store.py
+
+A memory-mapped store of grid mode results, so large grid campaigns can be sliced and aggregated without loading every result.
+
+The gridder only writes its cost grid (grid id -> trajectory -> best cost) as one JSON file at the end of a run. This converts it - or, while the gridder is still running, the -costs.json file it writes for each trajectory at each grid point - into a dense tensor indexed by (grid point, trajectory, field), where the fields are the best and start costs and the numeric parameters of the best strategy. Missing results are NaN.
+
+A store is a directory holding the tensor as a .npy file, opened memory-mapped, and coords.json, which maps grid ids (with their latitude and longitude), trajectory names and fields to tensor indexes. The tensor is laid out field first on disk, so reading one field across every grid point and trajectory only touches that field's pages. Stores from separate campaigns can be merged, matching grid points by their coordinates.
+"""
+
+import os
+import json
+import time
+import argparse
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+
+from flight_files import flight_name
+from grid_refinement import read_attacker_latlon
+
+# Fields kept for each grid point and trajectory - the costs from log_costs,
+# then the numeric parameters of the best strategy
+FIELDS = [
+    "best_cost",
+    "start_cost",
+    "mode",
+    "rate",
+    "cross_point",
+    "attacker_pos",
+    "start_alt_delta",
+    "end_alt_delta",
+]
+STRATEGY_FIELDS = FIELDS[2:]
+
+TENSOR_FILENAME = "tensor.npy"
+COORDS_FILENAME = "coords.json"
+COSTS_SUFFIX = "-costs.json"
+
+DEFAULT_TRAJECTORY_CAPACITY = 1024
+DEFAULT_SETTLE_TIME = 5
+DEFAULT_INTERVAL = 30
+
+# Grid points from different campaigns are the same point if their
+# coordinates match to this many decimal places
+COORDINATE_DECIMALS = 6
+
+AGGREGATES = {
+    "mean": np.nanmean,
+    "median": np.nanmedian,
+    "min": np.nanmin,
+    "max": np.nanmax,
+    "std": np.nanstd,
+    "count": lambda values, axis: np.sum(~np.isnan(values), axis=axis),
+}
+
+
+def coordinate_key(lat: float, lon: float) -> tuple:
+    """Key matching grid points at the same coordinates."""
+    return (
+        round(float(lat), COORDINATE_DECIMALS),
+        round(float(lon), COORDINATE_DECIMALS),
+    )
+
+
+class GridStore:
+    """A memory-mapped tensor of grid results, indexed by (grid point, trajectory, field).
+
+    Open an existing store with GridStore(path), or make a new one with GridStore.create.
+
+    Parameters
+    ----------
+    path : Path
+        Store directory
+    writable : bool, optional
+        Open the tensor for writing, by default False
+    """
+
+    def __init__(self, path: Path, writable: bool = False):
+        self.path = Path(path)
+        self.writable = writable
+        with open(self.path / COORDS_FILENAME, "r") as f:
+            coords = json.load(f)
+        self.grid_ids = coords["grid_ids"]
+        self.lat = coords["lat"]
+        self.lon = coords["lon"]
+        self.trajectories = coords["trajectories"]
+        self.fields = coords["fields"]
+        # Output file name -> [size, mtime_ns] when it was ingested
+        self.ingested = coords["ingested"]
+        self.grid_lookup = {i: j for j, i in enumerate(self.grid_ids)}
+        self.coordinate_lookup = {
+            coordinate_key(i, j): k for k, (i, j) in enumerate(zip(self.lat, self.lon))
+        }
+        self.trajectory_lookup = {i: j for j, i in enumerate(self.trajectories)}
+        self.field_lookup = {i: j for j, i in enumerate(self.fields)}
+        self.open_tensor()
+
+    @classmethod
+    def create(
+        cls,
+        path: Path,
+        points: dict = None,
+        fields: list = FIELDS,
+        trajectory_capacity: int = DEFAULT_TRAJECTORY_CAPACITY,
+    ) -> "GridStore":
+        """Creates an empty store.
+
+        Parameters
+        ----------
+        path : Path
+            Store directory, created if it doesn't exist
+        points : dict, optional
+            Maps grid id to {"lat": float, "lon": float}, as from read_attacker_latlon, by default None (no grid points yet)
+        fields : list, optional
+            Fields to store, by default FIELDS
+        trajectory_capacity : int, optional
+            Trajectories space is set aside for, which grows as needed, by default DEFAULT_TRAJECTORY_CAPACITY
+
+        Returns
+        -------
+        GridStore
+            The store, open for writing
+        """
+        points = points or {}
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        tensor = open_memmap(
+            path / TENSOR_FILENAME,
+            mode="w+",
+            dtype=np.float32,
+            shape=(len(fields), max(len(points), 1), trajectory_capacity),
+        )
+        tensor[:] = np.nan
+        tensor.flush()
+        del tensor
+        grid_ids = sorted(points)
+        write_json(
+            path / COORDS_FILENAME,
+            {
+                "grid_ids": grid_ids,
+                "lat": [points[i]["lat"] for i in grid_ids],
+                "lon": [points[i]["lon"] for i in grid_ids],
+                "trajectories": [],
+                "fields": list(fields),
+                "ingested": {},
+            },
+        )
+        return cls(path, writable=True)
+
+    @classmethod
+    def open_or_create(cls, path: Path, points: dict = None) -> "GridStore":
+        """Opens a store for writing, creating it if it doesn't exist, and adds any grid points it doesn't have yet."""
+        if (Path(path) / COORDS_FILENAME).exists():
+            store = cls(path, writable=True)
+            store.add_grid_points(points or {})
+            return store
+        return cls.create(path, points)
+
+    def open_tensor(self):
+        """Memory-maps the tensor file."""
+        self.data = np.load(
+            self.path / TENSOR_FILENAME, mmap_mode="r+" if self.writable else "r"
+        )
+
+    @property
+    def shape(self) -> tuple:
+        """Number of grid points, trajectories and fields held."""
+        return (len(self.grid_ids), len(self.trajectories), len(self.fields))
+
+    @property
+    def tensor(self) -> np.ndarray:
+        """Every result, as a (grid point, trajectory, field) view of the memory-mapped tensor."""
+        grids, trajectories, _ = self.shape
+        return np.moveaxis(self.data[:, :grids, :trajectories], 0, -1)
+
+    def field(self, name: str) -> np.ndarray:
+        """One field for every grid point and trajectory, as a (grid point, trajectory) view.
+
+        Parameters
+        ----------
+        name : str
+            Field name, e.g. best_cost
+
+        Returns
+        -------
+        np.ndarray
+            Memory-mapped view of the field, NaN where there is no result
+        """
+        grids, trajectories, _ = self.shape
+        return self.data[self.field_lookup[name], :grids, :trajectories]
+
+    def reserve(self, grids: int, trajectories: int):
+        """Grows the tensor file so it can hold at least this many grid points and trajectories.
+
+        Space is doubled each time it runs out, so a store filled a few results at a time is only copied a few times.
+        """
+        fields, grid_capacity, trajectory_capacity = self.data.shape
+        if grids <= grid_capacity and trajectories <= trajectory_capacity:
+            return
+        shape = (fields, grid_capacity, trajectory_capacity)
+        if grids > grid_capacity:
+            shape = (fields, max(grids, 2 * grid_capacity), shape[2])
+        if trajectories > trajectory_capacity:
+            shape = (fields, shape[1], max(trajectories, 2 * trajectory_capacity))
+        temporary_path = self.path / (TENSOR_FILENAME + ".tmp")
+        tensor = open_memmap(
+            temporary_path, mode="w+", dtype=self.data.dtype, shape=shape
+        )
+        tensor[:] = np.nan
+        tensor[:, :grid_capacity, :trajectory_capacity] = self.data
+        tensor.flush()
+        del tensor
+        del self.data
+        os.replace(temporary_path, self.path / TENSOR_FILENAME)
+        self.open_tensor()
+
+    def add_grid_points(self, points: dict) -> list:
+        """Adds grid points, unless there is already one at the same coordinates.
+
+        Parameters
+        ----------
+        points : dict
+            Maps grid id to {"lat": float, "lon": float}
+
+        Returns
+        -------
+        list
+            Index of each point, in the order given
+
+        Raises
+        ------
+        ValueError
+            If a new point's grid id is already used by a point at different coordinates
+        """
+        new = {
+            i: j
+            for i, j in points.items()
+            if coordinate_key(j["lat"], j["lon"]) not in self.coordinate_lookup
+        }
+        self.reserve(len(self.grid_ids) + len(new), len(self.trajectories))
+        indexes = []
+        for grid_id, point in points.items():
+            key = coordinate_key(point["lat"], point["lon"])
+            if key in self.coordinate_lookup:
+                indexes.append(self.coordinate_lookup[key])
+                continue
+            if grid_id in self.grid_lookup:
+                raise ValueError(
+                    "Grid id {} is already used at {}, {}".format(
+                        grid_id,
+                        self.lat[self.grid_lookup[grid_id]],
+                        self.lon[self.grid_lookup[grid_id]],
+                    )
+                )
+            self.grid_lookup[grid_id] = self.coordinate_lookup[key] = len(self.grid_ids)
+            self.grid_ids.append(grid_id)
+            self.lat.append(float(point["lat"]))
+            self.lon.append(float(point["lon"]))
+            indexes.append(self.grid_lookup[grid_id])
+        return indexes
+
+    def add_trajectories(self, names: list) -> np.ndarray:
+        """Adds trajectories which aren't in the store yet.
+
+        Parameters
+        ----------
+        names : list
+            Trajectory names
+
+        Returns
+        -------
+        np.ndarray
+            Index of each trajectory, in the order given
+        """
+        new = [i for i in dict.fromkeys(names) if i not in self.trajectory_lookup]
+        if new:
+            self.reserve(len(self.grid_ids), len(self.trajectories) + len(new))
+            for name in new:
+                self.trajectory_lookup[name] = len(self.trajectories)
+                self.trajectories.append(name)
+        return np.array([self.trajectory_lookup[i] for i in names], dtype=np.int64)
+
+    def set_values(self, grid_ids: list, trajectories: list, field: str, values):
+        """Stores results, adding any new trajectories.
+
+        Parameters
+        ----------
+        grid_ids : list
+            Grid id of each result, each already in the store
+        trajectories : list
+            Trajectory name of each result
+        field : str
+            Field the results are for
+        values : array-like
+            The results
+        """
+        grid_indexes = np.array([self.grid_lookup[i] for i in grid_ids], dtype=np.int64)
+        trajectory_indexes = self.add_trajectories(trajectories)
+        self.data[self.field_lookup[field], grid_indexes, trajectory_indexes] = values
+
+    def nearest_grid_point(self, lat: float, lon: float) -> str:
+        """Finds the grid id of the grid point closest to a position (in degrees, ignoring the Earth's curvature)."""
+        distances = (np.asarray(self.lat) - lat) ** 2 + (
+            np.asarray(self.lon) - lon
+        ) ** 2
+        return self.grid_ids[int(np.argmin(distances))]
+
+    def grid_point(self, grid_id: str) -> pd.DataFrame:
+        """Every field of every trajectory's result at one grid point.
+
+        Returns
+        -------
+        pd.DataFrame
+            One row per trajectory, one column per field
+        """
+        _, trajectories, _ = self.shape
+        return pd.DataFrame(
+            self.data[:, self.grid_lookup[grid_id], :trajectories].T,
+            index=pd.Index(self.trajectories, name="trajectory"),
+            columns=self.fields,
+        )
+
+    def trajectory(self, name: str) -> pd.DataFrame:
+        """Every field of one trajectory's results at every grid point.
+
+        Returns
+        -------
+        pd.DataFrame
+            One row per grid point, with its lat and lon then one column per field
+        """
+        grids, _, _ = self.shape
+        output_df = pd.DataFrame(
+            self.data[:, :grids, self.trajectory_lookup[name]].T,
+            index=pd.Index(self.grid_ids, name="grid_id"),
+            columns=self.fields,
+        )
+        output_df.insert(0, "lat", self.lat)
+        output_df.insert(1, "lon", self.lon)
+        return output_df
+
+    def aggregate(
+        self, field: str = "best_cost", how: str = "mean", over: str = "trajectories"
+    ) -> pd.Series:
+        """Aggregates a field across trajectories (for each grid point) or across grid points (for each trajectory), ignoring missing results.
+
+        Parameters
+        ----------
+        field : str, optional
+            Field to aggregate, by default 'best_cost'
+        how : str, optional
+            One of AGGREGATES, by default 'mean'
+        over : str, optional
+            'trajectories' or 'grid_points', by default 'trajectories'
+
+        Returns
+        -------
+        pd.Series
+            Aggregate for each grid point (indexed by grid id) or trajectory (indexed by name). NaN where there are no results.
+        """
+        axis = 1 if over == "trajectories" else 0
+        with warnings.catch_warnings():
+            # All-NaN slices are left as NaN
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            values = AGGREGATES[how](self.field(field), axis=axis)
+        index = self.grid_ids if over == "trajectories" else self.trajectories
+        return pd.Series(values, index=index, name="{}_{}".format(how, field))
+
+    def merge(self, other: "GridStore") -> int:
+        """Adds another store's results, e.g. from another campaign or refinement round.
+
+        Grid points are matched by their coordinates, and trajectories by name. Where both stores have a result, the other store's is kept. Fields only in the other store are left out.
+
+        Parameters
+        ----------
+        other : GridStore
+            Store to merge in
+
+        Returns
+        -------
+        int
+            Number of results merged in
+        """
+        grid_indexes = np.array(
+            self.add_grid_points(
+                {
+                    i: {"lat": j, "lon": k}
+                    for i, j, k in zip(other.grid_ids, other.lat, other.lon)
+                }
+            ),
+            dtype=np.int64,
+        )
+        trajectory_indexes = self.add_trajectories(other.trajectories)
+        block = np.ix_(grid_indexes, trajectory_indexes)
+        merged = 0
+        for field in other.fields:
+            if field not in self.field_lookup:
+                continue
+            values = other.field(field)
+            present = ~np.isnan(values)
+            target = self.data[self.field_lookup[field]]
+            current = target[block]
+            current[present] = values[present]
+            target[block] = current
+            merged += int(present.sum())
+        return merged
+
+    def ingest_cost_grid(self, path: Path) -> int:
+        """Adds the best costs from a gridder cost grid file, as written by log_cost_grid.
+
+        Parameters
+        ----------
+        path : Path
+            A *-cost-grid.json file
+
+        Returns
+        -------
+        int
+            Number of results added. Grid ids the store has no coordinates for are skipped.
+        """
+        with open(path, "r") as f:
+            grid = json.load(f)
+        grid_ids, trajectories, values = [], [], []
+        for grid_id, trajectory_costs in grid.items():
+            if grid_id not in self.grid_lookup:
+                print("Skipping grid id {} with no coordinates".format(grid_id))
+                continue
+            for trajectory, cost in trajectory_costs.items():
+                grid_ids.append(grid_id)
+                trajectories.append(flight_name(trajectory))
+                values.append(float(cost))
+        self.set_values(grid_ids, trajectories, "best_cost", values)
+        return len(values)
+
+    def ingest_costs_file(self, path: Path) -> bool:
+        """Adds one trajectory's result at one grid point, from a -costs.json file written in grid mode.
+
+        Parameters
+        ----------
+        path : Path
+            File named {trajectory}-{grid id}-costs.json
+
+        Returns
+        -------
+        bool
+            True if it was added, False if it isn't a grid mode result for a grid point in the store
+
+        Raises
+        ------
+        json.JSONDecodeError
+            If the file is incomplete
+        """
+        trajectory, _, grid_id = Path(path).name[: -len(COSTS_SUFFIX)].rpartition("-")
+        if grid_id not in self.grid_lookup:
+            return False
+        with open(path, "r") as f:
+            metadata = json.load(f)["metadata"]
+        strategy = metadata.get("best_strategy")
+        if not isinstance(strategy, dict):
+            strategy = {}
+        values = {
+            "best_cost": metadata.get("best_cost"),
+            "start_cost": metadata.get("start_cost"),
+        }
+        values.update({i: strategy.get(i) for i in STRATEGY_FIELDS})
+
+        grid_index = self.grid_lookup[grid_id]
+        trajectory_index = self.add_trajectories([trajectory])[0]
+        for field, value in values.items():
+            if field in self.field_lookup and isinstance(value, (int, float)):
+                self.data[self.field_lookup[field], grid_index, trajectory_index] = (
+                    value
+                )
+        return True
+
+    def ingest_costs_directory(
+        self, directory: Path, settle_time: float = DEFAULT_SETTLE_TIME
+    ) -> int:
+        """Adds grid mode results from a costs/ directory which haven't been ingested yet.
+
+        Files modified in the last settle_time seconds, or which don't parse yet, are left for the next call, so this can be run repeatedly while the gridder is writing.
+
+        Parameters
+        ----------
+        directory : Path
+            Simulator costs/ directory (PARAM_COSTS_FILEPATH)
+        settle_time : float, optional
+            Seconds a file must go unmodified before it is read, by default DEFAULT_SETTLE_TIME
+
+        Returns
+        -------
+        int
+            Number of files ingested
+        """
+        now = time.time()
+        ingested = 0
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(COSTS_SUFFIX) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                signature = [stat.st_size, stat.st_mtime_ns]
+                if self.ingested.get(entry.name) == signature:
+                    continue
+                if now - stat.st_mtime < settle_time:
+                    continue
+                try:
+                    added = self.ingest_costs_file(Path(entry.path))
+                except (json.JSONDecodeError, UnicodeDecodeError, KeyError, TypeError):
+                    # Partially written - try again next time
+                    continue
+                if added:
+                    self.ingested[entry.name] = signature
+                    ingested += 1
+        return ingested
+
+    def flush(self):
+        """Writes the tensor and coordinates to disk."""
+        self.data.flush()
+        write_json(
+            self.path / COORDS_FILENAME,
+            {
+                "grid_ids": self.grid_ids,
+                "lat": self.lat,
+                "lon": self.lon,
+                "trajectories": self.trajectories,
+                "fields": self.fields,
+                "ingested": self.ingested,
+            },
+        )
+
+
+def write_json(path: Path, content: dict):
+    """Writes JSON in one step, so readers never see a partial file."""
+    temporary_path = Path(str(path) + ".tmp")
+    with open(temporary_path, "w") as f:
+        json.dump(content, f)
+    os.replace(temporary_path, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Builds, merges and summarises memory-mapped stores of grid mode results.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "command",
+        choices=["ingest", "merge", "summary"],
+        help="ingest adds cost grids and/or a costs/ directory to a store (creating it if needed), merge adds other stores to one, summary aggregates a field for each grid point.",
+    )
+    parser.add_argument("store_path", type=str, help="Store directory.")
+    parser.add_argument(
+        "--params_file",
+        type=str,
+        help="Simulator parameter file whose PARAM_ATTACKER_LATLON gives the grid points, for ingest.",
+        default=None,
+    )
+    parser.add_argument(
+        "--cost_grids",
+        type=str,
+        nargs="+",
+        help="grid-cost-grid.json files to ingest.",
+        default=[],
+    )
+    parser.add_argument(
+        "--costs_path",
+        type=str,
+        help="Simulator costs/ directory to ingest grid mode -costs.json files from.",
+        default=None,
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep ingesting new files from --costs_path every --interval seconds, until interrupted.",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        help="Seconds between polls of --costs_path, with --watch.",
+        default=DEFAULT_INTERVAL,
+    )
+    parser.add_argument(
+        "--settle_time",
+        type=float,
+        help="Seconds a -costs.json file must go unmodified before it is read.",
+        default=DEFAULT_SETTLE_TIME,
+    )
+    parser.add_argument(
+        "--stores",
+        type=str,
+        nargs="+",
+        help="Stores to merge into store_path, for merge.",
+        default=[],
+    )
+    parser.add_argument(
+        "--field", choices=FIELDS, help="Field to summarise.", default="best_cost"
+    )
+    parser.add_argument(
+        "--how",
+        choices=list(AGGREGATES),
+        help="Aggregate to summarise with.",
+        default="mean",
+    )
+    parser.add_argument(
+        "--top", type=int, help="Number of grid points listed by summary.", default=10
+    )
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        points = {}
+        if args.params_file is not None:
+            with open(args.params_file, "r") as f:
+                points = read_attacker_latlon(f.read())
+        store = GridStore.open_or_create(args.store_path, points)
+        for path in args.cost_grids:
+            print("Added {} results from {}".format(store.ingest_cost_grid(path), path))
+        store.flush()
+        if args.costs_path is not None:
+            try:
+                while True:
+                    ingested = store.ingest_costs_directory(
+                        args.costs_path, args.settle_time
+                    )
+                    store.flush()
+                    print(
+                        "Ingested {} files, store holds {} grid points x {} trajectories".format(
+                            ingested, *store.shape[:2]
+                        )
+                    )
+                    if not args.watch:
+                        break
+                    time.sleep(args.interval)
+            except KeyboardInterrupt:
+                store.flush()
+    elif args.command == "merge":
+        store = GridStore.open_or_create(args.store_path)
+        for path in args.stores:
+            print(
+                "Merged {} results from {}".format(store.merge(GridStore(path)), path)
+            )
+        store.flush()
+    else:
+        store = GridStore(args.store_path)
+        print("{} grid points x {} trajectories x {} fields".format(*store.shape))
+        summary = store.aggregate(args.field, args.how).sort_values(ascending=False)
+        for grid_id, value in summary.head(args.top).items():
+            index = store.grid_lookup[grid_id]
+            print(
+                "{}  {:.6f}, {:.6f}  {:.3f}".format(
+                    grid_id, store.lat[index], store.lon[index], value
+                )
+            )
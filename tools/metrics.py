@@ -0,0 +1,493 @@
+"""
+metrics.py
+
+A small, dependency-free metrics recorder for the data pipeline and simulation drivers.
+
+Metrics can be served over local HTTP in the Prometheus text format (so they can be scraped, or just opened in a browser), and/or appended as snapshots to a JSONL file. Counters also get a per-second rate over a sliding window and, where a total is known, an ETA, so throughput collapsing shows up while a run is still going.
+"""
+
+import json
+import time
+import threading
+import functools
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_NAMESPACE = "acasx"
+# Window (in seconds) used when working out per-second rates
+DEFAULT_RATE_WINDOW = 60
+DEFAULT_JSONL_INTERVAL = 30
+# Latency buckets (in seconds), from a single simulation up to a full HDF
+DEFAULT_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600]
+
+
+def label_key(labels: dict) -> tuple:
+    """Turns a label dict into a hashable, ordered key.
+
+    Parameters
+    ----------
+    labels : dict
+        Metric labels
+
+    Returns
+    -------
+    tuple
+        Sorted (name, value) pairs
+    """
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def format_labels(key: tuple, extra: dict = None) -> str:
+    """Formats a label key in the Prometheus text format.
+
+    Parameters
+    ----------
+    key : tuple
+        Label key, from label_key
+    extra : dict, optional
+        Additional labels, e.g. a histogram bucket's le, by default None
+
+    Returns
+    -------
+    str
+        e.g. {stage="basic_cleaning"}, or an empty string if there are no labels
+    """
+    pairs = list(key) + list((extra or {}).items())
+    if len(pairs) == 0:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+            for k, v in pairs
+        )
+        + "}"
+    )
+
+
+class Metrics:
+    """
+    Thread-safe store of counters, gauges and histograms.
+
+    Parameters
+    ----------
+    namespace : str, optional
+        Prefix added to every metric name, by default DEFAULT_NAMESPACE
+    rate_window : float, optional
+        Window (in seconds) used for per-second rates, by default DEFAULT_RATE_WINDOW
+    buckets : list, optional
+        Histogram bucket upper bounds, by default DEFAULT_BUCKETS
+    """
+
+    def __init__(
+        self,
+        namespace: str = DEFAULT_NAMESPACE,
+        rate_window: float = DEFAULT_RATE_WINDOW,
+        buckets: list = None,
+    ):
+        self.namespace = namespace
+        self.rate_window = rate_window
+        self.buckets = sorted(buckets or DEFAULT_BUCKETS)
+        self.start_time = time.time()
+
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.samples = {}
+        self.expected = {}
+
+        self.server = None
+        self.jsonl_path = None
+        self.jsonl_stop = threading.Event()
+        self.jsonl_thread = None
+
+    def name(self, name: str) -> str:
+        """Adds the namespace prefix to a metric name."""
+        return "{}_{}".format(self.namespace, name)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Increases a counter.
+
+        Parameters
+        ----------
+        name : str
+            Counter name, conventionally ending in _total
+        value : float, optional
+            Amount to add, by default 1
+        **labels
+            Metric labels
+        """
+        key = (name, label_key(labels))
+        now = time.time()
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            samples = self.samples.setdefault(key, deque([(self.start_time, 0)]))
+            samples.append((now, self.counters[key]))
+            while len(samples) > 2 and samples[1][0] < now - self.rate_window:
+                samples.popleft()
+
+    def value(self, name: str, **labels) -> float:
+        """Current value of a counter.
+
+        Parameters
+        ----------
+        name : str
+            Counter name
+        **labels
+            Metric labels
+
+        Returns
+        -------
+        float
+            The counter's value, or 0 if it hasn't been increased yet
+        """
+        with self.lock:
+            return self.counters.get((name, label_key(labels)), 0)
+
+    def set(self, name: str, value: float, **labels):
+        """Sets a gauge, e.g. a queue depth.
+
+        Parameters
+        ----------
+        name : str
+            Gauge name
+        value : float
+            New value
+        **labels
+            Metric labels
+        """
+        with self.lock:
+            self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        """Records a value in a histogram, e.g. a latency.
+
+        Parameters
+        ----------
+        name : str
+            Histogram name, conventionally ending in _seconds
+        value : float
+            Observed value
+        **labels
+            Metric labels
+        """
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def expect(self, name: str, total: float, **labels):
+        """Sets the expected final value of a counter, so an ETA can be reported for it.
+
+        Parameters
+        ----------
+        name : str
+            Counter name
+        total : float
+            Expected final value
+        **labels
+            Metric labels
+        """
+        with self.lock:
+            self.expected[(name, label_key(labels))] = total
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Context manager which records how long its body took in a histogram.
+
+        Parameters
+        ----------
+        name : str
+            Histogram name
+        **labels
+            Metric labels
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed_stage(self, stage):
+        """Wraps a pipeline stage so its latency and row counts are recorded.
+
+        Parameters
+        ----------
+        stage : function
+            A stage taking a DataFrame as its first argument and returning a DataFrame
+
+        Returns
+        -------
+        function
+            The wrapped stage, for use with DataFrame.pipe
+        """
+
+        @functools.wraps(stage)
+        def wrapper(input_df, *args, **kwargs):
+            self.inc("stage_rows_in_total", len(input_df), stage=stage.__name__)
+            with self.timer("stage_seconds", stage=stage.__name__):
+                output_df = stage(input_df, *args, **kwargs)
+            self.inc("stage_rows_out_total", len(output_df), stage=stage.__name__)
+            return output_df
+
+        return wrapper
+
+    def rate(self, key: tuple, now: float) -> float:
+        """Per-second rate of a counter over the rate window. Must be called with the lock held."""
+        samples = self.samples[key]
+        first_time, first_value = samples[0]
+        if len(samples) > 1 and samples[1][0] < now - self.rate_window:
+            first_time, first_value = samples[1]
+        elapsed = now - first_time
+        if elapsed <= 0:
+            return 0.0
+        return (self.counters[key] - first_value) / elapsed
+
+    def snapshot(self) -> dict:
+        """Takes a copy of every metric, including derived rates and ETAs.
+
+        Returns
+        -------
+        dict
+            counters, gauges and histograms, each a list of {name, labels, ...} dicts
+        """
+        now = time.time()
+        with self.lock:
+            counters = []
+            gauges = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self.gauges.items()
+            ]
+            for key, value in self.counters.items():
+                name, labels = key
+                rate = self.rate(key, now)
+                counters.append({"name": name, "labels": dict(labels), "value": value})
+                gauges.append(
+                    {
+                        "name": name.replace("_total", "") + "_per_second",
+                        "labels": dict(labels),
+                        "value": rate,
+                    }
+                )
+            for key, total in self.expected.items():
+                name, labels = key
+                done = self.counters.get(key, 0)
+                rate = self.rate(key, now) if key in self.samples else 0.0
+                eta = max(total - done, 0) / rate if rate > 0 else float("inf")
+                gauges.append(
+                    {
+                        "name": name.replace("_total", "") + "_eta_seconds",
+                        "labels": dict(labels),
+                        "value": eta if total > done else 0.0,
+                    }
+                )
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "buckets": dict(zip(self.buckets, histogram["counts"])),
+                    "sum": histogram["sum"],
+                    "count": histogram["count"],
+                }
+                for (name, labels), histogram in self.histograms.items()
+            ]
+        gauges.append(
+            {"name": "uptime_seconds", "labels": {}, "value": now - self.start_time}
+        )
+        return {
+            "time": now,
+            "counters": counters,
+            "gauges": gauges,
+            "histograms": histograms,
+        }
+
+    def render(self) -> str:
+        """Renders every metric in the Prometheus text exposition format.
+
+        Returns
+        -------
+        str
+            Metrics text, as served on /metrics
+        """
+        snapshot = self.snapshot()
+        lines = []
+        declared = set()
+
+        def declare(name, metric_type):
+            if name not in declared:
+                lines.append("# TYPE {} {}".format(name, metric_type))
+                declared.add(name)
+
+        for metric_type, entries in [
+            ("counter", snapshot["counters"]),
+            ("gauge", snapshot["gauges"]),
+        ]:
+            for entry in sorted(entries, key=lambda x: x["name"]):
+                name = self.name(entry["name"])
+                declare(name, metric_type)
+                lines.append(
+                    "{}{} {}".format(
+                        name,
+                        format_labels(label_key(entry["labels"])),
+                        repr(float(entry["value"])).replace("inf", "+Inf"),
+                    )
+                )
+
+        for entry in sorted(snapshot["histograms"], key=lambda x: x["name"]):
+            name = self.name(entry["name"])
+            key = label_key(entry["labels"])
+            declare(name, "histogram")
+            for bound, count in entry["buckets"].items():
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        name, format_labels(key, {"le": repr(float(bound))}), count
+                    )
+                )
+            lines.append(
+                "{}_bucket{} {}".format(
+                    name, format_labels(key, {"le": "+Inf"}), entry["count"]
+                )
+            )
+            lines.append("{}_sum{} {}".format(name, format_labels(key), entry["sum"]))
+            lines.append(
+                "{}_count{} {}".format(name, format_labels(key), entry["count"])
+            )
+        return "\n".join(lines) + "\n"
+
+    def write_jsonl(self, path: str = None):
+        """Appends a snapshot of every metric to a JSONL file.
+
+        Parameters
+        ----------
+        path : str, optional
+            File to append to, by default the file passed to start_jsonl
+        """
+        snapshot = self.snapshot()
+        for entry in snapshot["gauges"]:
+            # JSON has no infinity
+            if entry["value"] == float("inf"):
+                entry["value"] = None
+        for entry in snapshot["histograms"]:
+            entry["buckets"] = {str(k): v for k, v in entry["buckets"].items()}
+        with open(path or self.jsonl_path, "a") as f:
+            f.write(json.dumps(snapshot) + "\n")
+
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        """Serves the metrics at http://host:port/metrics from a background thread.
+
+        Parameters
+        ----------
+        port : int
+            Port to listen on
+        host : str, optional
+            Address to bind to, by default local connections only
+        """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ["/", "/metrics"]:
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def start_jsonl(self, path: str, interval: float = DEFAULT_JSONL_INTERVAL):
+        """Appends a snapshot to a JSONL file every interval seconds from a background thread.
+
+        Parameters
+        ----------
+        path : str
+            File to append to
+        interval : float, optional
+            Seconds between snapshots, by default DEFAULT_JSONL_INTERVAL
+        """
+        self.jsonl_path = path
+
+        def loop():
+            while not self.jsonl_stop.wait(interval):
+                self.write_jsonl()
+
+        self.jsonl_thread = threading.Thread(target=loop, daemon=True)
+        self.jsonl_thread.start()
+
+    def close(self):
+        """Stops the HTTP server and JSONL thread, writing a final snapshot."""
+        if self.jsonl_thread is not None:
+            self.jsonl_stop.set()
+            self.jsonl_thread.join()
+            self.write_jsonl()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def add_metrics_arguments(parser):
+    """Adds the standard metrics options to a tool's argument parser.
+
+    Parameters
+    ----------
+    parser : argparse.ArgumentParser
+        The parser to add to
+    """
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        help="If set, serve progress metrics in Prometheus format on this local port.",
+        default=None,
+    )
+    parser.add_argument(
+        "--metrics_file",
+        type=str,
+        help="If set, append progress metric snapshots to this JSONL file.",
+        default=None,
+    )
+    parser.add_argument(
+        "--metrics_interval",
+        type=float,
+        help="Seconds between snapshots written to --metrics_file.",
+        default=DEFAULT_JSONL_INTERVAL,
+    )
+
+
+def metrics_from_args(args) -> Metrics:
+    """Creates a Metrics instance, serving/writing it as requested on the command line.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Parsed arguments, including those from add_metrics_arguments
+
+    Returns
+    -------
+    Metrics
+        The metrics recorder. It is always returned, so tools can record metrics unconditionally.
+    """
+    metrics = Metrics()
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+        print(
+            "Serving metrics on http://127.0.0.1:{}/metrics".format(args.metrics_port)
+        )
+    if args.metrics_file is not None:
+        metrics.start_jsonl(args.metrics_file, args.metrics_interval)
+    return metrics
@@ -5,17 +5,98 @@ A tool to convert OpenSky flights into JSON 'flights' describing a continuous se
 """
 
 import math
-import json
 import datetime
 from pathlib import Path
 import os
 import argparse
+import functools
 import traceback
+import gzip
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
 
 import more_itertools
 import pandas as pd
 import numpy as np
 
+from flight_files import (
+    LAYOUTS,
+    dump_flight_json,
+    export_flight_name,
+    flight_filename,
+    has_manifest,
+    shard_directory,
+)
+from flight_index import DEFAULT_SIMILARITY, FlightIndex, flight_fingerprint
+from flight_manifest import update_manifest
+from flight_sampling import DEFAULT_ALTITUDE_BANDS, STRATA, WEIGHTS, FlightReservoir
+from flight_stitching import OpenFlightBuffer
+from metrics import Metrics, add_metrics_arguments, metrics_from_args
+from stage_cache import (
+    DEFAULT_CACHE_MAX_SIZE_MB,
+    Stage,
+    StageCache,
+    file_fingerprint,
+    run_cached_stages,
+    stage_keys,
+)
+
+# Columns present in OpenSky state vector dumps, in the order they are
+# published. HDF extractions carry the same columns.
+STATE_VECTOR_COLUMNS = [
+    "time",
+    "icao24",
+    "lat",
+    "lon",
+    "velocity",
+    "heading",
+    "vertrate",
+    "callsign",
+    "onground",
+    "alert",
+    "spi",
+    "squawk",
+    "baroaltitude",
+    "geoaltitude",
+    "lastposupdate",
+    "lastcontact",
+]
+
+# Identifier-like columns must stay as strings, otherwise ICAOs such as
+# '000001' or squawks like '0421' get mangled into numbers
+STATE_VECTOR_DTYPES = {"icao24": str, "callsign": str, "squawk": str}
+
+DEFAULT_CSV_CHUNKSIZE = 500000
+
+DESCENT_FPM = 4500
+CLIMB_FPM = 5000
+
+# need this in meters per second
+DEFAULT_INVALID_MAX_THRESHOLD = CLIMB_FPM / 3.281 / 60
+DEFAULT_INVALID_MIN_THRESHOLD = -DESCENT_FPM / 3.281 / 60
+DEFAULT_INVALID_TOLERANCE = 5
+
+DEFAULT_IMPUTE_TOLERANCE = 0.8
+
+# Columns linearly interpolated when flights are resampled (headings are
+# interpolated separately, as they wrap around)
+INTERPOLATED_COLUMNS = [
+    "lat",
+    "lon",
+    "velocity",
+    "vertrate",
+    "baroaltitude",
+    "geoaltitude",
+    "lastposupdate",
+    "lastcontact",
+]
+
+DEFAULT_ALTITUDE_MIN = 1250
+DEFAULT_ALTITUDE_MAX = 10000
+
+# Matches the Earth radius used by the simulator when placing attackers
+EARTH_RADIUS_KM = 6365.066
+
 
 def label_flights(input_df: pd.DataFrame, split_threshold: int = 60) -> pd.DataFrame:
     """
@@ -324,10 +405,40 @@ def json_serial(obj: object) -> float:
     raise TypeError(f"Type {type(obj)} not serializable")
 
 
-def save_flights_to_json(input_df: pd.DataFrame, path: Path):
+def flight_metadata(input_df: pd.DataFrame) -> dict:
+    """Summarises a flight's altitudes, for the metadata saved with it.
+
+    Parameters
+    ----------
+    input_df : pd.DataFrame
+        Cleaned flight data
+
+    Returns
+    -------
+    dict
+        Minimum, maximum, middle, first and last altitudes
+    """
+    return {
+        "min_alt": input_df["baroaltitude"].min(),
+        "max_alt": input_df["baroaltitude"].max(),
+        "mid_alt": input_df["baroaltitude"].iloc[
+            math.floor(len(input_df["baroaltitude"]) / 2)
+        ],
+        "first_alt": input_df["baroaltitude"].iloc[0],
+        "last_alt": input_df["baroaltitude"].iloc[-1],
+    }
+
+
+def save_flights_to_json(
+    input_df: pd.DataFrame,
+    path: Path,
+    compression: str = None,
+    level: int = None,
+    layout: str = "flat",
+) -> str:
     """Saves a flight to JSON
 
-    Given some input flight data, saves it to a JSON file in the directory provided in path.
+    Given some input flight data, saves it to a JSON file in the directory provided in path, optionally compressed. With the sharded layout, the file goes in a {date}/{icao24 prefix}/ subdirectory of path.
 
     Parameters
     ----------
@@ -335,39 +446,46 @@ def save_flights_to_json(input_df: pd.DataFrame, path: Path):
         Cleaned, input flight data
     path : Path
         The directory to save the flight to
+    compression : str, optional
+        'gzip' or 'zstd' to compress the file, by default None
+    level : int, optional
+        Compression level, by default None (see flight_files.DEFAULT_COMPRESSION_LEVELS)
+    layout : str, optional
+        'flat' or 'sharded', by default 'flat'
+
+    Returns
+    -------
+    str
+        Path of the saved file, relative to path
 
     Raises
     ------
     ValueError
         If NAs are found in the flight.
     """
-    time = input_df["timestamp"].iloc[0].strftime("%Y%m%d-%H%M%S")
+    icao24 = input_df.iloc[0]["icao24"]
+    name = export_flight_name(icao24, input_df["timestamp"].iloc[0])
     if input_df["baroaltitude"].notna().values.all():
         output = {}
-        # Create the metadata for the flight
-        output["metadata"] = {
-            "min_alt": input_df["baroaltitude"].min(),
-            "max_alt": input_df["baroaltitude"].max(),
-            "mid_alt": input_df["baroaltitude"].iloc[
-                math.floor(len(input_df["baroaltitude"]) / 2)
-            ],
-            "first_alt": input_df["baroaltitude"].iloc[0],
-            "last_alt": input_df["baroaltitude"].iloc[-1],
-        }
+        output["metadata"] = flight_metadata(input_df)
         output["data"] = input_df.to_dict(orient="records")
 
         # Dump to JSON
-        with open(
-            os.path.join(path, "{}-{}.json".format(input_df.iloc[0]["icao24"], time)),
-            "w",
-        ) as f:
-            json.dump(output, f, default=json_serial)
-    else:
-        raise ValueError(
-            "NAs found in exported Dataframe: {} {}".format(
-                input_df.iloc[0]["icao24"], time
-            )
+        filename = flight_filename(name, compression)
+        if layout == "sharded":
+            date = input_df["timestamp"].iloc[0].strftime("%Y%m%d")
+            filename = "{}/{}".format(shard_directory(icao24, date), filename)
+            os.makedirs(os.path.dirname(os.path.join(path, filename)), exist_ok=True)
+        dump_flight_json(
+            output,
+            os.path.join(path, filename),
+            compression,
+            level,
+            default=json_serial,
         )
+        return filename
+    else:
+        raise ValueError("NAs found in exported Dataframe: {}".format(name))
 
 
 def basic_cleaning(input_df: pd.DataFrame) -> pd.DataFrame:
@@ -390,20 +508,28 @@ def basic_cleaning(input_df: pd.DataFrame) -> pd.DataFrame:
     return input_df
 
 
-def label_points_into_flights(input_df: pd.DataFrame) -> pd.DataFrame:
+def label_points_into_flights(
+    input_df: pd.DataFrame, split_threshold: int = 60
+) -> pd.DataFrame:
     """Wrapper function for the flight labelling stage of the pipeline.
 
     Parameters
     ----------
     input_df : pd.DataFrame
         Input DataFrame, containing OpenSky position reports.
+    split_threshold : int, optional
+        The time threshold, in seconds, used to split flights, by default 60
 
     Returns
     -------
     pd.DataFrame
         A DataFrame where each flight by each ICAO is labelled. Note that labels are only unique within an ICAO, not across the whole DF.
     """
-    return input_df.groupby(["icao24"]).apply(label_flights).reset_index(drop=True)
+    return (
+        input_df.groupby(["icao24"])
+        .apply(label_flights, split_threshold)
+        .reset_index(drop=True)
+    )
 
 
 def impute_missing_flight_points(input_df: pd.DataFrame, tolerance=0.8) -> pd.DataFrame:
@@ -482,7 +608,231 @@ def remove_invalid_trajectories(
     )
 
 
-def export_flights(input_df: pd.DataFrame, output_path: Path) -> pd.DataFrame:
+def resample_flight(input_df: pd.DataFrame, interval: float) -> pd.DataFrame:
+    """Resamples a flight onto a uniform time grid, starting at its first report.
+
+    Positions, altitudes, speeds and report times are linearly interpolated, and headings are interpolated the short way round. Other columns (ICAO24, callsign, flags etc.) are taken from the latest report at or before each point.
+
+    Parameters
+    ----------
+    input_df : pd.DataFrame
+        Position reports for a single flight
+    interval : float
+        Seconds between resampled points
+
+    Returns
+    -------
+    pd.DataFrame
+        The resampled flight, with time and timestamp set to the grid
+    """
+    input_df = input_df.sort_values("time")
+    times = input_df["time"].values.astype(np.float64)
+    grid = times[0] + np.arange(int((times[-1] - times[0]) // interval) + 1) * interval
+
+    # Carry non-interpolated columns from the latest report before each point
+    previous = np.searchsorted(times, grid, side="right") - 1
+    output_df = input_df.iloc[previous].reset_index(drop=True)
+    output_df["time"] = grid.astype(input_df["time"].dtype)
+    output_df["timestamp"] = pd.to_datetime(grid, unit="s")
+
+    for column in INTERPOLATED_COLUMNS + ["heading"]:
+        if column not in input_df:
+            continue
+        values = input_df[column].values.astype(np.float64)
+        present = ~np.isnan(values)
+        if present.sum() == 0:
+            continue
+        if column == "heading":
+            unwrapped = np.degrees(np.unwrap(np.radians(values[present])))
+            output_df[column] = np.interp(grid, times[present], unwrapped) % 360
+        else:
+            output_df[column] = np.interp(grid, times[present], values[present])
+    return output_df
+
+
+def decimation_mask(
+    times: np.ndarray, altitudes: np.ndarray, tolerance: float
+) -> np.ndarray:
+    """Picks the points of an altitude profile to keep, so interpolating between them stays within a tolerance of every dropped point.
+
+    Uses the Ramer-Douglas-Peucker algorithm on (time, altitude): each segment is split at the point furthest (in altitude) from the line between its ends, until no point is further than the tolerance.
+
+    Parameters
+    ----------
+    times : np.ndarray
+        Report times, in increasing order
+    altitudes : np.ndarray
+        Altitudes at each time
+    tolerance : float
+        Largest allowed altitude error, in metres
+
+    Returns
+    -------
+    np.ndarray
+        True for each point to keep
+    """
+    keep = np.zeros(len(times), dtype=bool)
+    keep[[0, -1]] = True
+    segments = [(0, len(times) - 1)]
+    while segments:
+        start, end = segments.pop()
+        if end - start < 2:
+            continue
+        duration = times[end] - times[start]
+        fraction = (times[start + 1 : end] - times[start]) / duration if duration else 0
+        line = altitudes[start] + fraction * (altitudes[end] - altitudes[start])
+        errors = np.abs(altitudes[start + 1 : end] - line)
+        furthest = int(np.argmax(errors))
+        if errors[furthest] > tolerance:
+            split = start + 1 + furthest
+            keep[split] = True
+            segments += [(start, split), (split, end)]
+    return keep
+
+
+def decimate_flight(input_df: pd.DataFrame, tolerance: float) -> pd.DataFrame:
+    """Drops points from a flight while keeping its interpolated altitude within a tolerance of the original.
+
+    Parameters
+    ----------
+    input_df : pd.DataFrame
+        Position reports for a single flight
+    tolerance : float
+        Largest allowed altitude error, in metres
+
+    Returns
+    -------
+    pd.DataFrame
+        The flight's remaining points
+    """
+    input_df = input_df.sort_values("time")
+    keep = decimation_mask(
+        input_df["time"].values.astype(np.float64),
+        input_df["baroaltitude"].values.astype(np.float64),
+        tolerance,
+    )
+    return input_df[keep]
+
+
+def resample_flights(
+    input_df: pd.DataFrame, interval: float = None, tolerance: float = None
+) -> pd.DataFrame:
+    """Wrapper function for the resampling stage - resamples each flight to a uniform rate, then decimates it.
+
+    Parameters
+    ----------
+    input_df : pd.DataFrame
+        DataFrame containing validated flights
+    interval : float, optional
+        Seconds between resampled points, by default None (don't resample)
+    tolerance : float, optional
+        Largest altitude error (in metres) allowed when dropping points, by default None (don't decimate)
+
+    Returns
+    -------
+    pd.DataFrame
+        The resampled and/or decimated flights
+    """
+
+    def resample(flight_df):
+        if interval is not None:
+            flight_df = resample_flight(flight_df, interval)
+        if tolerance is not None:
+            flight_df = decimate_flight(flight_df, tolerance)
+        return flight_df
+
+    return (
+        input_df.groupby(["icao24", "flight_label"], group_keys=False)
+        .apply(resample)
+        .reset_index(drop=True)
+    )
+
+
+def save_unique_flight(
+    input_df: pd.DataFrame,
+    path: Path,
+    compression: str = None,
+    level: int = None,
+    layout: str = "flat",
+    index: FlightIndex = None,
+    dedup_action: str = "skip",
+) -> str:
+    """Saves a flight to JSON, unless it duplicates a flight in the index.
+
+    Parameters
+    ----------
+    input_df : pd.DataFrame
+        Cleaned, input flight data
+    path : Path
+        The directory to save the flight to
+    compression : str, optional
+        'gzip' or 'zstd' to compress the file, by default None
+    level : int, optional
+        Compression level, by default None
+    layout : str, optional
+        'flat' or 'sharded', by default 'flat'
+    index : FlightIndex, optional
+        Index of flights already exported, which the flight is added to if saved, by default None
+    dedup_action : str, optional
+        'skip' to just skip duplicates, or 'link' to also record which flight they duplicate in the index, by default 'skip'
+
+    Returns
+    -------
+    str
+        Path of the saved file, relative to path, or None if the flight is a duplicate
+    """
+    if index is None:
+        return save_flights_to_json(input_df, path, compression, level, layout)
+
+    name = export_flight_name(input_df["icao24"].iloc[0], input_df["timestamp"].iloc[0])
+    fingerprint = flight_fingerprint(input_df)
+    match = index.find(name, fingerprint)
+    if match is not None:
+        if dedup_action == "link" and match[0] != name:
+            index.link(name, *match)
+        return None
+    filename = save_flights_to_json(input_df, path, compression, level, layout)
+    index.add(name, filename, fingerprint)
+    return filename
+
+
+def drop_indexed_flights(input_df: pd.DataFrame, index: FlightIndex) -> pd.DataFrame:
+    """Removes flights which duplicate flights already in the index, without adding any to it.
+
+    Parameters
+    ----------
+    input_df : pd.DataFrame
+        DataFrame containing validated flights
+    index : FlightIndex
+        Index of flights already exported
+
+    Returns
+    -------
+    pd.DataFrame
+        Flights not found in the index
+    """
+    keep = input_df.groupby(["icao24", "flight_label"])[
+        ["icao24", "time", "timestamp", "lat", "lon", "baroaltitude"]
+    ].apply(
+        lambda x: index.find(
+            export_flight_name(x["icao24"].iloc[0], x["timestamp"].iloc[0]),
+            flight_fingerprint(x),
+        )
+        is None
+    )
+    labels = pd.MultiIndex.from_frame(input_df[["icao24", "flight_label"]])
+    return input_df[labels.isin(keep.index[keep.values])].reset_index(drop=True)
+
+
+def export_flights(
+    input_df: pd.DataFrame,
+    output_path: Path,
+    compression: str = None,
+    level: int = None,
+    layout: str = "flat",
+    index: FlightIndex = None,
+    dedup_action: str = "skip",
+) -> pd.Series:
     """Wrapper to export all flights in the input_df to JSON
 
     Parameters
@@ -491,76 +841,866 @@ def export_flights(input_df: pd.DataFrame, output_path: Path) -> pd.DataFrame:
         Flight data points to export
     output_path : Path
         Directory path to export JSON files to.
+    compression : str, optional
+        'gzip' or 'zstd' to compress exported files, by default None
+    level : int, optional
+        Compression level, by default None
+    layout : str, optional
+        'flat' or 'sharded', by default 'flat'
+    index : FlightIndex, optional
+        Index of flights already exported - duplicates of indexed flights are skipped, and exported flights are added to it, by default None
+    dedup_action : str, optional
+        'skip' or 'link', see save_unique_flight, by default 'skip'
+
+    Returns
+    -------
+    pd.Series
+        Paths of the exported files, relative to output_path
+    """
+    if index is None:
+        return input_df.groupby(["icao24", "flight_label"]).apply(
+            save_flights_to_json, output_path, compression, level, layout
+        )
+
+    paths = [
+        save_unique_flight(
+            flight, output_path, compression, level, layout, index, dedup_action
+        )
+        for _, flight in input_df.groupby(["icao24", "flight_label"])
+    ]
+    index.commit()
+    return pd.Series(paths, dtype=object).dropna()
+
+
+def parse_time_bound(value: str) -> float:
+    """Parses a time window bound given either as a UNIX timestamp or a date string.
+
+    Parameters
+    ----------
+    value : str
+        UNIX timestamp in seconds, or anything pd.Timestamp understands (e.g. '2020-05-25 14:00'). Date strings without a timezone are taken as UTC.
+
+    Returns
+    -------
+    float
+        UNIX timestamp, in seconds
+    """
+    try:
+        return float(value)
+    except ValueError:
+        timestamp = pd.Timestamp(value)
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.tz_localize("UTC")
+        return timestamp.timestamp()
+
+
+def parse_float_list(value: str, length: int) -> tuple:
+    """Parses a comma separated list of floats of a fixed length, for use as an argparse type.
+
+    Parameters
+    ----------
+    value : str
+        Comma separated values, e.g. '50.03,8.57,50'
+    length : int
+        Number of values expected
+
+    Returns
+    -------
+    tuple
+        The parsed floats
+
+    Raises
+    ------
+    argparse.ArgumentTypeError
+        If the wrong number of values is given, or they are not numbers
+    """
+    try:
+        values = tuple(float(i) for i in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Could not parse numbers from '{value}'")
+    if len(values) != length:
+        raise argparse.ArgumentTypeError(
+            f"Expected {length} comma separated values, got '{value}'"
+        )
+    return values
+
+
+def load_icao_list(value: str) -> set:
+    """Loads an ICAO allowlist, either from a file with one ICAO per line or from a comma separated string.
+
+    Parameters
+    ----------
+    value : str
+        Path to an allowlist file, or comma separated ICAOs
+
+    Returns
+    -------
+    set
+        Lower-cased ICAO24 addresses
+    """
+    if os.path.isfile(value):
+        with open(value, "r") as f:
+            icaos = [i.strip() for i in f]
+    else:
+        icaos = value.split(",")
+    return {i.strip().lower() for i in icaos if i.strip() != ""}
+
+
+def haversine_km(lat_1, lon_1, lat_2, lon_2):
+    """Vectorised Haversine distance, in km, between coordinate pairs.
+
+    Parameters
+    ----------
+    lat_1 : float or np.ndarray
+        Latitude of the first coordinate pair(s)
+    lon_1 : float or np.ndarray
+        Longitude of the first coordinate pair(s)
+    lat_2 : float or np.ndarray
+        Latitude of the second coordinate pair(s)
+    lon_2 : float or np.ndarray
+        Longitude of the second coordinate pair(s)
+
+    Returns
+    -------
+    float or np.ndarray
+        Distance between the coordinate pairs
+    """
+    phi_1 = np.radians(lat_1)
+    phi_2 = np.radians(lat_2)
+    delta_phi = np.radians(np.asarray(lat_2) - np.asarray(lat_1))
+    delta_lambda = np.radians(np.asarray(lon_2) - np.asarray(lon_1))
+
+    a = (
+        np.sin(delta_phi / 2) ** 2
+        + np.cos(phi_1) * np.cos(phi_2) * np.sin(delta_lambda / 2) ** 2
+    )
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def radius_to_bbox(lat: float, lon: float, radius_km: float) -> tuple:
+    """Finds the lat/lon box enclosing a circle, so radius queries can be pushed down as range queries.
+
+    Parameters
+    ----------
+    lat : float
+        Latitude of the centre
+    lon : float
+        Longitude of the centre
+    radius_km : float
+        Radius of the circle, in km
+
+    Returns
+    -------
+    tuple
+        (lat_min, lon_min, lat_max, lon_max)
+    """
+    delta_lat = np.degrees(radius_km / EARTH_RADIUS_KM)
+    # Longitude degrees shrink towards the poles, so widen accordingly
+    delta_lon = np.degrees(
+        radius_km / (EARTH_RADIUS_KM * max(np.cos(np.radians(lat)), 1e-6))
+    )
+    return (lat - delta_lat, lon - delta_lon, lat + delta_lat, lon + delta_lon)
+
+
+def build_filters(
+    time_window: tuple = None,
+    icaos: set = None,
+    bbox: tuple = None,
+    radius: tuple = None,
+) -> dict:
+    """Bundles up the read filters used to cut down the data before processing.
+
+    Parameters
+    ----------
+    time_window : tuple, optional
+        (start, end) UNIX timestamps, inclusive, by default None
+    icaos : set, optional
+        ICAO24 allowlist, by default None
+    bbox : tuple, optional
+        (lat_min, lon_min, lat_max, lon_max), by default None
+    radius : tuple, optional
+        (lat, lon, km), by default None
+
+    Returns
+    -------
+    dict
+        Filters, or an empty dict if none were set. A radius also sets 'radius_bbox', the box enclosing it, which is what gets pushed down into reads.
+    """
+    filters = {}
+    if time_window is not None:
+        filters["time_window"] = (float(time_window[0]), float(time_window[1]))
+    if icaos is not None:
+        filters["icaos"] = {i.lower() for i in icaos}
+    if bbox is not None:
+        filters["bbox"] = tuple(bbox)
+    if radius is not None:
+        filters["radius"] = tuple(radius)
+        filters["radius_bbox"] = radius_to_bbox(*radius)
+    return filters
+
+
+def has_region_filter(filters: dict) -> bool:
+    """Checks if any spatial filters are set.
+
+    Parameters
+    ----------
+    filters : dict
+        Filters, as created by build_filters
+
+    Returns
+    -------
+    bool
+        True if a bounding box or radius is set
+    """
+    return filters is not None and ("bbox" in filters or "radius" in filters)
+
+
+def region_mask(input_df: pd.DataFrame, filters: dict) -> np.ndarray:
+    """Finds the position reports that lie within the bounding box and/or radius.
+
+    Parameters
+    ----------
+    input_df : pd.DataFrame
+        Position reports, with lat and lon columns
+    filters : dict
+        Filters, as created by build_filters
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of reports inside the region
+    """
+    lat = input_df["lat"].values
+    lon = input_df["lon"].values
+    mask = np.ones(input_df.shape[0], dtype=bool)
+    if "bbox" in filters:
+        lat_min, lon_min, lat_max, lon_max = filters["bbox"]
+        mask &= (lat >= lat_min) & (lat <= lat_max)
+        mask &= (lon >= lon_min) & (lon <= lon_max)
+    if "radius" in filters:
+        centre_lat, centre_lon, radius_km = filters["radius"]
+        mask &= haversine_km(centre_lat, centre_lon, lat, lon) <= radius_km
+    return mask
+
+
+def apply_row_filters(input_df: pd.DataFrame, filters: dict) -> pd.DataFrame:
+    """Applies the time window and ICAO allowlist filters to position reports.
+
+    These are row-level filters, so are safe to apply to each chunk of a file as it is read.
+
+    Parameters
+    ----------
+    input_df : pd.DataFrame
+        Raw position reports
+    filters : dict
+        Filters, as created by build_filters
 
     Returns
     -------
     pd.DataFrame
-        Input Dataframe
+        Reports within the time window and from allowed ICAOs
     """
-    return input_df.groupby(["icao24", "flight_label"]).apply(
-        save_flights_to_json, output_path
+    if not filters:
+        return input_df
+    mask = np.ones(input_df.shape[0], dtype=bool)
+    if "time_window" in filters:
+        start, end = filters["time_window"]
+        mask &= (input_df["time"].values >= start) & (input_df["time"].values <= end)
+    if "icaos" in filters:
+        mask &= input_df["icao24"].isin(filters["icaos"]).values
+    if mask.all():
+        return input_df
+    return input_df[mask]
+
+
+def apply_read_filters(input_df: pd.DataFrame, filters: dict) -> pd.DataFrame:
+    """Applies all read filters to a fully loaded set of position reports.
+
+    Spatial filters keep *every* report from an ICAO seen inside the region, so flights are not clipped mid-trajectory - keep_flights_in_region later narrows this down to whole flights once they are labelled. This is the fallback for inputs where filters could not be pushed into the read, and is a no-op for anything already filtered.
+
+    Parameters
+    ----------
+    input_df : pd.DataFrame
+        Raw position reports
+    filters : dict
+        Filters, as created by build_filters
+
+    Returns
+    -------
+    pd.DataFrame
+        Filtered position reports
+    """
+    if not filters:
+        return input_df
+    output_df = apply_row_filters(input_df, filters)
+    if has_region_filter(filters):
+        icaos = output_df["icao24"][region_mask(output_df, filters)].unique()
+        output_df = output_df[output_df["icao24"].isin(icaos)]
+    return output_df
+
+
+def keep_flights_in_region(input_df: pd.DataFrame, filters: dict) -> pd.DataFrame:
+    """Drops labelled flights which never enter the filter region, keeping the rest whole.
+
+    Parameters
+    ----------
+    input_df : pd.DataFrame
+        DataFrame containing labelled flight position reports
+    filters : dict
+        Filters, as created by build_filters
+
+    Returns
+    -------
+    pd.DataFrame
+        Flights with at least one report inside the region
+    """
+    if not has_region_filter(filters) or input_df.shape[0] == 0:
+        return input_df
+    inside = pd.Series(region_mask(input_df, filters), index=input_df.index)
+    keep = inside.groupby([input_df["icao24"], input_df["flight_label"]]).transform(
+        "any"
     )
+    return input_df[keep.values].reset_index(drop=True)
 
 
-def run_pipeline(input_path: Path, output_path: Path, args: argparse.Namespace):
-    """Wrapper to run the processing pipeline and export the results.
+def read_hdf_filtered(input_path: Path, filters: dict) -> pd.DataFrame:
+    """Reads a HDF, pushing filters down into the read where the storage format allows it.
+
+    Table-format HDFs can be queried on their data columns, so the time window and bounding box are turned into 'where' queries, and ICAO allowlists (including the set of ICAOs seen in the region) are resolved to row coordinates. Fixed-format HDFs can't be queried, so are loaded whole. Either way, apply_read_filters is run afterwards to catch anything that wasn't pushed down.
 
     Parameters
     ----------
     input_path : Path
-        Path pointing to a HDF file to process.
-    output_path : Path
-        Path pointing to a directory to export JSON files to.
-    args : argparse.Namespace
-        Parsed command line arguments.
+        Path to the HDF file
+    filters : dict
+        Filters, as created by build_filters
+
+    Returns
+    -------
+    pd.DataFrame
+        Filtered position reports
     """
-    (
-        pd.read_hdf(input_path)
-        .pipe(basic_cleaning)
-        .pipe(label_points_into_flights)
-        .pipe(impute_missing_flight_points, tolerance=args.impute_tolerance)
-        .pipe(
-            threshold_flights_by_altitude_range,
-            min_alt_threshold=args.altitude_min,
-            max_alt_threshold=args.altitude_max,
-        )
-        .pipe(
-            remove_invalid_trajectories,
-            min_threshold=args.invalid_min_threshold,
-            max_threshold=args.invalid_max_threshold,
-            tolerance=args.invalid_tolerance,
+    if not filters:
+        return pd.read_hdf(input_path)
+
+    with pd.HDFStore(input_path, mode="r") as store:
+        keys = store.keys()
+        storer = store.get_storer(keys[0]) if len(keys) == 1 else None
+        if storer is None or not storer.is_table:
+            return apply_read_filters(pd.read_hdf(input_path), filters)
+
+        key = keys[0]
+        queryable = set(storer.data_columns or [])
+
+        time_terms = []
+        if "time_window" in filters and "time" in queryable:
+            time_terms = [
+                f"time >= {filters['time_window'][0]!r}",
+                f"time <= {filters['time_window'][1]!r}",
+            ]
+
+        icaos = filters.get("icaos")
+        if has_region_filter(filters) and {"lat", "lon", "icao24"} <= queryable:
+            region_terms = []
+            for bbox_key in ["bbox", "radius_bbox"]:
+                if bbox_key in filters:
+                    lat_min, lon_min, lat_max, lon_max = filters[bbox_key]
+                    region_terms += [
+                        f"lat >= {lat_min!r}",
+                        f"lat <= {lat_max!r}",
+                        f"lon >= {lon_min!r}",
+                        f"lon <= {lon_max!r}",
+                    ]
+            candidates = store.select(
+                key, where=time_terms + region_terms, columns=["icao24", "lat", "lon"]
+            )
+            region_icaos = set(
+                candidates["icao24"][region_mask(candidates, filters)].unique()
+            )
+            icaos = region_icaos if icaos is None else icaos & region_icaos
+
+        if icaos is not None and "icao24" in queryable:
+            if len(icaos) == 0:
+                return apply_read_filters(store.select(key, start=0, stop=0), filters)
+            icao_column = store.select_column(key, "icao24")
+            coordinates = np.flatnonzero(icao_column.isin(icaos).values)
+            if len(time_terms) > 0:
+                coordinates = np.intersect1d(
+                    coordinates,
+                    store.select_as_coordinates(key, where=time_terms),
+                )
+            output_df = store.select(key, where=coordinates)
+        else:
+            output_df = store.select(key, where=time_terms if time_terms else None)
+
+    return apply_read_filters(output_df, filters)
+
+
+def detect_input_format(input_path: Path) -> str:
+    """Works out which reader to use for an input file, based on its suffixes.
+
+    Parameters
+    ----------
+    input_path : Path
+        Path to an input file.
+
+    Returns
+    -------
+    str
+        One of 'tar', 'csv' or 'hdf'. Anything not recognised as a CSV or tar dump is treated as a HDF, as the pipeline always has.
+    """
+    suffixes = [i.lower() for i in Path(input_path).suffixes]
+    if suffixes[-1:] == [".tar"]:
+        return "tar"
+    if suffixes[-1:] == [".csv"] or suffixes[-2:] == [".csv", ".gz"]:
+        return "csv"
+    return "hdf"
+
+
+def iter_state_vector_chunks(
+    source, chunksize: int = DEFAULT_CSV_CHUNKSIZE, filters: dict = None
+):
+    """Parses an (uncompressed) OpenSky state vector CSV stream chunk by chunk.
+
+    Parameters
+    ----------
+    source : str, Path or file-like
+        CSV file path or an open binary stream. Compressed streams should be wrapped before being passed in.
+    chunksize : int, optional
+        Number of rows parsed per chunk, by default DEFAULT_CSV_CHUNKSIZE
+    filters : dict, optional
+        Row filters (time window, ICAO allowlist) to apply to each chunk, by default None
+
+    Yields
+    ------
+    pd.DataFrame
+        Chunks of position reports, restricted to STATE_VECTOR_COLUMNS.
+    """
+    reader = pd.read_csv(
+        source,
+        usecols=lambda c: c in STATE_VECTOR_COLUMNS,
+        dtype=STATE_VECTOR_DTYPES,
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        yield apply_row_filters(chunk, filters)
+
+
+def concat_state_vector_chunks(chunks: list) -> pd.DataFrame:
+    """Joins parsed chunks into a single frame, returning an empty, correctly labelled frame if there are none.
+
+    Parameters
+    ----------
+    chunks : list
+        A list of DataFrames of position reports
+
+    Returns
+    -------
+    pd.DataFrame
+        All position reports, in chunk order
+    """
+    chunks = [i for i in chunks if i.shape[0] > 0]
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=STATE_VECTOR_COLUMNS)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_state_vector_csv(
+    input_path: Path, chunksize: int = DEFAULT_CSV_CHUNKSIZE, filters: dict = None
+) -> pd.DataFrame:
+    """Reads a plain or gzipped OpenSky state vector CSV, decompressing as it goes.
+
+    Parameters
+    ----------
+    input_path : Path
+        Path to a .csv or .csv.gz file
+    chunksize : int, optional
+        Number of rows parsed per chunk, by default DEFAULT_CSV_CHUNKSIZE
+    filters : dict, optional
+        Row filters to apply to each chunk, by default None
+
+    Returns
+    -------
+    pd.DataFrame
+        Position reports from the file
+    """
+    if str(input_path).lower().endswith(".gz"):
+        with gzip.open(input_path, "rb") as f:
+            return concat_state_vector_chunks(
+                list(iter_state_vector_chunks(f, chunksize, filters))
+            )
+    return concat_state_vector_chunks(
+        list(iter_state_vector_chunks(input_path, chunksize, filters))
+    )
+
+
+def read_tar_member(
+    tar_path: Path,
+    member_name: str,
+    chunksize: int = DEFAULT_CSV_CHUNKSIZE,
+    filters: dict = None,
+) -> pd.DataFrame:
+    """Streams a single CSV member out of a state vector tar archive.
+
+    This opens the archive itself so that it can be run in a worker process, allowing members to be decompressed in parallel.
+
+    Parameters
+    ----------
+    tar_path : Path
+        Path to the tar archive
+    member_name : str
+        Name of the .csv or .csv.gz member to read
+    chunksize : int, optional
+        Number of rows parsed per chunk, by default DEFAULT_CSV_CHUNKSIZE
+    filters : dict, optional
+        Row filters to apply to each chunk, by default None
+
+    Returns
+    -------
+    pd.DataFrame
+        Position reports from the archive member
+    """
+    with tarfile.open(tar_path, "r:*") as archive:
+        stream = archive.extractfile(member_name)
+        if member_name.lower().endswith(".gz"):
+            stream = gzip.GzipFile(fileobj=stream)
+        return concat_state_vector_chunks(
+            list(iter_state_vector_chunks(stream, chunksize, filters))
         )
-        .pipe(export_flights, output_path=output_path)
+
+
+def read_state_vector_tar(
+    input_path: Path,
+    chunksize: int = DEFAULT_CSV_CHUNKSIZE,
+    workers: int = 1,
+    filters: dict = None,
+) -> pd.DataFrame:
+    """Reads all CSV members of an OpenSky state vector tar archive.
+
+    Non-CSV members (READMEs, checksums) are skipped. With more than one worker, members are decompressed and parsed in separate processes.
+
+    Parameters
+    ----------
+    input_path : Path
+        Path to a .tar archive
+    chunksize : int, optional
+        Number of rows parsed per chunk, by default DEFAULT_CSV_CHUNKSIZE
+    workers : int, optional
+        Number of processes used to read members, by default 1
+    filters : dict, optional
+        Row filters to apply to each chunk, by default None
+
+    Returns
+    -------
+    pd.DataFrame
+        Position reports from all members, in archive order
+    """
+    with tarfile.open(input_path, "r:*") as archive:
+        members = [
+            i.name
+            for i in archive.getmembers()
+            if i.isfile() and detect_input_format(Path(i.name)) == "csv"
+        ]
+
+    if workers > 1 and len(members) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            frames = list(
+                executor.map(
+                    read_tar_member,
+                    [input_path] * len(members),
+                    members,
+                    [chunksize] * len(members),
+                    [filters] * len(members),
+                )
+            )
+    else:
+        frames = [read_tar_member(input_path, i, chunksize, filters) for i in members]
+
+    return concat_state_vector_chunks(frames)
+
+
+def read_state_vectors(
+    input_path: Path,
+    chunksize: int = DEFAULT_CSV_CHUNKSIZE,
+    workers: int = 1,
+    filters: dict = None,
+) -> pd.DataFrame:
+    """Loads position reports from a HDF, CSV (optionally gzipped) or tar file, detecting the format from the path.
+
+    Any filters are pushed into the read where possible (see read_hdf_filtered), then applied to the loaded data.
+
+    Parameters
+    ----------
+    input_path : Path
+        Path to the input file
+    chunksize : int, optional
+        Number of rows parsed per chunk for CSV inputs, by default DEFAULT_CSV_CHUNKSIZE
+    workers : int, optional
+        Number of processes used to read tar archive members, by default 1
+    filters : dict, optional
+        Filters, as created by build_filters, by default None
+
+    Returns
+    -------
+    pd.DataFrame
+        Raw position reports, ready for basic_cleaning
+    """
+    input_format = detect_input_format(input_path)
+    if input_format == "tar":
+        input_df = read_state_vector_tar(input_path, chunksize, workers, filters)
+    elif input_format == "csv":
+        input_df = read_state_vector_csv(input_path, chunksize, filters)
+    else:
+        return read_hdf_filtered(input_path, filters)
+    return apply_read_filters(input_df, filters)
+
+
+def timed_read_state_vectors(metrics: Metrics):
+    """Wraps read_state_vectors so its latency and the rows read are recorded.
+
+    Parameters
+    ----------
+    metrics : Metrics
+        Metrics to record to
+
+    Returns
+    -------
+    function
+        The wrapped read_state_vectors
+    """
+
+    @functools.wraps(read_state_vectors)
+    def wrapper(input_path, **kwargs):
+        with metrics.timer("stage_seconds", stage="read_state_vectors"):
+            input_df = read_state_vectors(input_path, **kwargs)
+        metrics.inc("rows_read_total", input_df.shape[0])
+        return input_df
+
+    return wrapper
+
+
+def build_preprocessing_stages(args: argparse.Namespace, metrics: Metrics) -> list:
+    """Builds the stages which load position reports and label them into flights, ahead of any thresholds being applied.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Parsed command line arguments, including those from add_input_arguments
+    metrics : Metrics
+        Records stage latencies and row counts
+
+    Returns
+    -------
+    list
+        Stages, for run_stages
+    """
+    filters = build_filters(
+        time_window=args.time_window,
+        icaos=args.icao_list,
+        bbox=args.bbox,
+        radius=args.radius_around,
     )
+    return [
+        Stage(
+            timed_read_state_vectors(metrics),
+            {"filters": filters},
+            {"chunksize": args.chunksize, "workers": args.workers},
+            # A cached copy of the input would be as slow to load as the input
+            # itself, while doubling disk use and evicting later stages
+            cacheable=False,
+        ),
+        Stage(metrics.timed_stage(basic_cleaning), {}, {}),
+        Stage(metrics.timed_stage(label_points_into_flights), {}, {}),
+        Stage(metrics.timed_stage(keep_flights_in_region), {"filters": filters}, {}),
+    ]
+
+
+def build_threshold_stages(args: argparse.Namespace, metrics: Metrics) -> list:
+    """Builds the stages which impute, threshold and validate labelled flights, then resample them if asked to.
 
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Parsed command line arguments
+    metrics : Metrics
+        Records stage latencies and row counts
 
-if __name__ == "__main__":
-    # Parse args
+    Returns
+    -------
+    list
+        Stages, to run after build_preprocessing_stages
+    """
+    stages = [
+        Stage(
+            metrics.timed_stage(impute_missing_flight_points),
+            {"tolerance": args.impute_tolerance},
+            {},
+        ),
+        Stage(
+            metrics.timed_stage(threshold_flights_by_altitude_range),
+            {
+                "min_alt_threshold": args.altitude_min,
+                "max_alt_threshold": args.altitude_max,
+            },
+            {},
+        ),
+        Stage(
+            metrics.timed_stage(remove_invalid_trajectories),
+            {
+                "min_threshold": args.invalid_min_threshold,
+                "max_threshold": args.invalid_max_threshold,
+                "tolerance": args.invalid_tolerance,
+            },
+            {},
+        ),
+    ]
+    # Only added when used, so cache keys of existing runs still match
+    if args.resample_interval is not None or args.decimate_tolerance is not None:
+        stages.append(
+            Stage(
+                metrics.timed_stage(resample_flights),
+                {
+                    "interval": args.resample_interval,
+                    "tolerance": args.decimate_tolerance,
+                },
+                {},
+            )
+        )
+    return stages
 
-    DESCENT_FPM = 4500
-    CLIMB_FPM = 5000
 
-    # need this in meters per second
-    DEFAULT_INVALID_MAX_THRESHOLD = CLIMB_FPM / 3.281 / 60
-    DEFAULT_INVALID_MIN_THRESHOLD = -DESCENT_FPM / 3.281 / 60
-    DEFAULT_INVALID_TOLERANCE = 5
+def run_stages(
+    input_path: Path, stages: list, metrics: Metrics, cache: StageCache = None
+) -> pd.DataFrame:
+    """Runs pipeline stages on an input file, resuming from and updating the cache if one is given.
 
-    DEFAULT_IMPUTE_TOLERANCE = 0.8
+    Parameters
+    ----------
+    input_path : Path
+        Path pointing to a HDF, CSV or tar file to process
+    stages : list
+        Stages to run, starting with reading the file
+    metrics : Metrics
+        Records cache hits and misses
+    cache : StageCache, optional
+        Cache of intermediate stage results, by default None
 
-    DEFAULT_ALTITUDE_MIN = 1250
-    DEFAULT_ALTITUDE_MAX = 10000
+    Returns
+    -------
+    pd.DataFrame
+        Output of the last stage run
+    """
+    if cache is None:
+        return run_cached_stages(input_path, stages, [None] * len(stages))
+
+    keys = stage_keys(file_fingerprint(input_path), stages)
+    output_df = run_cached_stages(input_path, stages, keys, cache, metrics)
+    cache.evict()
+    return output_df
+
+
+def run_stitched_stages(
+    input_path: Path,
+    stages: list,
+    buffer: OpenFlightBuffer,
+    flush: bool,
+    metrics: Metrics,
+    cache: StageCache = None,
+) -> pd.DataFrame:
+    """Runs pipeline stages on one of an ordered series of input files, joining flights carried over from the file before and holding back those still open at the end of this one.
 
-    parser = argparse.ArgumentParser(
-        description="Data processing pipeline to convert HDFs containing OpenSky position reports into a series of JSON files, each containing one flight",
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    Parameters
+    ----------
+    input_path : Path
+        Path pointing to a HDF, CSV or tar file to process
+    stages : list
+        Stages to run, as from build_preprocessing_stages followed by build_threshold_stages
+    buffer : OpenFlightBuffer
+        Flights carried over between files
+    flush : bool
+        Process every flight rather than holding open ones, for the last file
+    metrics : Metrics
+        Records stage latencies and the flights carried over
+    cache : StageCache, optional
+        Cache of cleaning results, by default None
+
+    Returns
+    -------
+    pd.DataFrame
+        Output of the last stage run, for the flights which ended in this file (or were carried into it)
+    """
+    # Reading and cleaning only depend on this file, so cleaning can still be cached -
+    # everything after depends on what was carried over
+    input_df = run_stages(input_path, stages[:2], metrics, cache)
+    if input_df.shape[0] == 0 and not flush:
+        return input_df
+    end_time = input_df["time"].max() if input_df.shape[0] > 0 else math.inf
+    input_df = buffer.prepend(input_df)
+
+    stitched_stages = stages[2:]
+    if not flush:
+        # Held back straight after labelling, before flights are filtered
+        stitched_stages.insert(
+            1,
+            Stage(
+                metrics.timed_stage(buffer.hold_open_flights),
+                {"end_time": end_time},
+                {},
+            ),
+        )
+    output_df = run_cached_stages(
+        input_df, stitched_stages, [None] * len(stitched_stages)
     )
+    metrics.set("flights_carried", buffer.flights)
+    return output_df
+
 
+def add_filter_arguments(parser: argparse.ArgumentParser):
+    """Adds the options restricting which position reports and flights are processed to a parser.
+
+    Parameters
+    ----------
+    parser : argparse.ArgumentParser
+        Parser to add options to
+    """
     parser.add_argument(
-        "input_path", type=str, help="Directory or HDF file to process."
+        "--time_window",
+        type=parse_time_bound,
+        nargs=2,
+        metavar=("START", "END"),
+        help="Only process position reports between START and END, given as UNIX timestamps or UTC date strings.",
+        default=None,
     )
     parser.add_argument(
-        "output_path", type=str, help="Directory to save exported JSON files to."
+        "--icao_list",
+        type=load_icao_list,
+        help="Only process these aircraft - either a file with one ICAO24 per line, or a comma separated list.",
+        default=None,
+    )
+    parser.add_argument(
+        "--bbox",
+        type=lambda x: parse_float_list(x, 4),
+        metavar="LAT_MIN,LON_MIN,LAT_MAX,LON_MAX",
+        help="Only keep flights which enter this bounding box. Flights are kept whole, not clipped to the box.",
+        default=None,
     )
+    parser.add_argument(
+        "--radius_around",
+        type=lambda x: parse_float_list(x, 3),
+        metavar="LAT,LON,KM",
+        help="Only keep flights which come within KM kilometres of LAT,LON. Flights are kept whole, not clipped to the circle.",
+        default=None,
+    )
+
+
+def add_threshold_arguments(parser: argparse.ArgumentParser):
+    """Adds the options setting the imputation, altitude and invalid trajectory thresholds, and resampling, to a parser.
+
+    Parameters
+    ----------
+    parser : argparse.ArgumentParser
+        Parser to add options to
+    """
     parser.add_argument(
         "--impute_tolerance",
         type=float,
@@ -597,24 +1737,418 @@ if __name__ == "__main__":
         help="Upper bound of acceptable altitudes (in metres).",
         default=DEFAULT_ALTITUDE_MAX,
     )
+    parser.add_argument(
+        "--resample_interval",
+        type=float,
+        help="Resample each flight onto a uniform grid with points this many seconds apart, interpolating positions, altitudes and headings.",
+        default=None,
+    )
+    parser.add_argument(
+        "--decimate_tolerance",
+        type=float,
+        help="Drop points from each flight (after any resampling) as long as interpolating between the rest keeps altitudes within this many metres of the originals.",
+        default=None,
+    )
+
+
+def add_export_arguments(parser: argparse.ArgumentParser):
+    """Adds the options controlling how exported flights are saved to a parser.
+
+    Parameters
+    ----------
+    parser : argparse.ArgumentParser
+        Parser to add options to
+    """
+    parser.add_argument(
+        "--compression",
+        choices=["gzip", "zstd"],
+        help="Compress exported flights, saving them as .json.gz or .json.zst. zstd needs the zstandard package.",
+        default=None,
+    )
+    parser.add_argument(
+        "--compression_level",
+        type=int,
+        help="Compression level for exported flights. Defaults to 6 for gzip and 3 for zstd.",
+        default=None,
+    )
+    parser.add_argument(
+        "--layout",
+        choices=LAYOUTS,
+        help="Save flights flat in output_path, or sharded into {date}/{icao24 prefix}/ subdirectories. Sharded output always gets a manifest.",
+        default="flat",
+    )
+    parser.add_argument(
+        "--manifest",
+        action="store_true",
+        help="Write a manifest.json listing every flight in output_path at the end of the run, even with the flat layout. An existing manifest is always kept up to date.",
+    )
+
+    parser.add_argument(
+        "--dedup_index",
+        type=str,
+        help="SQLite index of exported flight fingerprints (created if missing). Flights duplicating or nearly duplicating an indexed flight aren't exported, and exported flights are added - see flight_index.py.",
+        default=None,
+    )
+    parser.add_argument(
+        "--dedup_action",
+        choices=["skip", "link"],
+        help="Just skip duplicate flights, or also record which flight each duplicates in the index.",
+        default="skip",
+    )
+    parser.add_argument(
+        "--dedup_similarity",
+        type=float,
+        help="Share of the larger flight's fingerprint samples two flights must share to be treated as duplicates.",
+        default=DEFAULT_SIMILARITY,
+    )
+
+
+def add_input_arguments(parser: argparse.ArgumentParser):
+    """Adds the options controlling how inputs are read, filtered and cached to a parser.
+
+    Parameters
+    ----------
+    parser : argparse.ArgumentParser
+        Parser to add options to
+    """
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        help="Number of rows parsed at a time when reading CSV inputs.",
+        default=DEFAULT_CSV_CHUNKSIZE,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of processes used to decompress members of tar inputs in parallel.",
+        default=1,
+    )
+    add_filter_arguments(parser)
+    parser.add_argument(
+        "--cache_path",
+        type=str,
+        help="Directory to cache intermediate stage results in. Re-runs resume from the deepest stage whose parameters are unchanged - see stage_cache.py to inspect or clear the cache.",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache_max_size",
+        type=float,
+        help="Size (in MB) the stage cache is kept under, evicting least recently used results first.",
+        default=DEFAULT_CACHE_MAX_SIZE_MB,
+    )
+
+
+def run_pipeline(
+    input_path: Path,
+    output_path: Path,
+    args: argparse.Namespace,
+    metrics: Metrics = None,
+    cache: StageCache = None,
+    reservoir: FlightReservoir = None,
+    index: FlightIndex = None,
+    profiler=None,
+    buffer: OpenFlightBuffer = None,
+    flush: bool = True,
+):
+    """Wrapper to run the processing pipeline and export the results.
+
+    With a buffer, flights still open at the end of the file are held back to be joined with the next file's reports, and flights held from the last file are joined with this one's - see run_stitched_stages. With a cache, each stage's output is cached, and the pipeline resumes from the deepest stage whose input file and parameters (including those of every earlier stage) are unchanged. With a reservoir, validated flights are offered to it instead of being exported, and export_sample saves the selected flights once every file is processed. With a profiler, each stage run is profiled under the input file's name - stages loaded from the cache aren't run, so aren't profiled.
+
+    Parameters
+    ----------
+    input_path : Path
+        Path pointing to a HDF, CSV or tar file to process.
+    output_path : Path
+        Path pointing to a directory to export JSON files to.
+    args : argparse.Namespace
+        Parsed command line arguments.
+    metrics : Metrics, optional
+        Records rows, flights and stage latencies, by default None
+    cache : StageCache, optional
+        Cache of intermediate stage results, by default None
+    reservoir : FlightReservoir, optional
+        Sample to offer validated flights to, by default None (export every flight)
+    index : FlightIndex, optional
+        Index of exported flights, used to skip duplicates, by default None
+    profiler : StageProfiler, optional
+        Profiler to run each stage under, from stage_profiler.py, by default None
+    buffer : OpenFlightBuffer, optional
+        Flights carried over between input files, which must then be processed in time order, by default None
+    flush : bool, optional
+        Process flights still open at the end of the file rather than holding them in the buffer, by default True
+
+    Returns
+    -------
+    list
+        Paths of the exported files, relative to output_path
+    """
+    if metrics is None:
+        metrics = Metrics()
+
+    def profiled(stage):
+        if profiler is None:
+            return stage
+        return profiler.wrap(stage, Path(input_path).name)
+
+    stages = build_preprocessing_stages(args, metrics) + build_threshold_stages(
+        args, metrics
+    )
+    stages = [stage._replace(function=profiled(stage.function)) for stage in stages]
+    if buffer is None:
+        output_df = run_stages(input_path, stages, metrics, cache)
+    else:
+        output_df = run_stitched_stages(
+            input_path, stages, buffer, flush, metrics, cache
+        )
+    if output_df.shape[0] == 0:
+        print("No position reports left in {} after filtering".format(input_path))
+        return []
+
+    if reservoir is not None:
+        if index is not None:
+            output_df = output_df.pipe(
+                profiled(metrics.timed_stage(drop_indexed_flights)), index=index
+            )
+        with metrics.timer("stage_seconds", stage="offer_flights"):
+            profiled(reservoir.offer_flights)(output_df)
+        return []
+
+    exported = output_df.pipe(
+        profiled(metrics.timed_stage(export_flights)),
+        output_path=output_path,
+        compression=args.compression,
+        level=args.compression_level,
+        layout=args.layout,
+        index=index,
+        dedup_action=args.dedup_action,
+    )
+    metrics.inc("flights_exported_total", len(exported))
+    if index is not None:
+        flights = output_df.groupby(["icao24", "flight_label"]).ngroups
+        metrics.inc("flights_duplicate_total", flights - len(exported))
+    return list(exported)
+
+
+def export_sample(
+    reservoir: FlightReservoir,
+    output_path: Path,
+    args: argparse.Namespace,
+    metrics: Metrics = None,
+    index: FlightIndex = None,
+) -> list:
+    """Exports the flights selected by a reservoir.
+
+    Parameters
+    ----------
+    reservoir : FlightReservoir
+        Sample of validated flights, from every input file
+    output_path : Path
+        Path pointing to a directory to export JSON files to.
+    args : argparse.Namespace
+        Parsed command line arguments.
+    metrics : Metrics, optional
+        Records flights exported, by default None
+    index : FlightIndex, optional
+        Index of exported flights, used to skip duplicates within the sample, by default None
+
+    Returns
+    -------
+    list
+        Paths of the exported files, relative to output_path
+    """
+    if metrics is None:
+        metrics = Metrics()
+
+    exported = []
+    with metrics.timer("stage_seconds", stage="export_sample"):
+        for flight in reservoir.flights():
+            exported.append(
+                save_unique_flight(
+                    flight,
+                    output_path,
+                    args.compression,
+                    args.compression_level,
+                    args.layout,
+                    index,
+                    args.dedup_action,
+                )
+            )
+    exported = [i for i in exported if i is not None]
+    if index is not None:
+        index.commit()
+    metrics.inc("flights_exported_total", len(exported))
+
+    for label, seen, sampled in reservoir.summary():
+        print("Sampled {} of {} flights ({})".format(sampled, seen, label))
+    return exported
+
+
+if __name__ == "__main__":
+    # Parse args
+    parser = argparse.ArgumentParser(
+        description="Data processing pipeline to convert HDFs or raw CSV/tar dumps containing OpenSky position reports into a series of JSON files, each containing one flight",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "input_path",
+        type=str,
+        help="Directory or file to process. HDF, .csv, .csv.gz and .tar inputs are detected from the file name.",
+    )
+    parser.add_argument(
+        "output_path", type=str, help="Directory to save exported JSON files to."
+    )
+    add_threshold_arguments(parser)
+    add_export_arguments(parser)
+    parser.add_argument(
+        "--sample",
+        type=int,
+        help="Only export a random sample of this many validated flights, drawn from every input file.",
+        default=None,
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed for --sample. The same seed and inputs always select the same flights.",
+        default=0,
+    )
+    parser.add_argument(
+        "--sample_weight",
+        choices=WEIGHTS,
+        help="Weight flights in the sample by their number of position reports or duration.",
+        default="uniform",
+    )
+    parser.add_argument(
+        "--strata",
+        choices=STRATA,
+        help="Split the sample equally between altitude bands (of each flight's median altitude) or UTC hours of day (each flight starts in).",
+        default=None,
+    )
+    parser.add_argument(
+        "--altitude_bands",
+        type=float,
+        nargs="+",
+        help="Edges of the altitude bands used by --strata altitude (in metres).",
+        default=DEFAULT_ALTITUDE_BANDS,
+    )
+    add_input_arguments(parser)
+    parser.add_argument(
+        "--stitch",
+        action="store_true",
+        help="Treat the files in input_path as consecutive (in name order), joining flights which cross from one file into the next rather than cutting them in two.",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=["deterministic", "sampling"],
+        help="Profile each stage on each input file, writing collapsed stacks (for flame graphs) and a summary of the slowest functions - see stage_profiler.py. sampling has less overhead, but needs Unix.",
+        default=None,
+    )
+    parser.add_argument(
+        "--profile_path",
+        type=str,
+        help="Directory to write --profile results to, by default {output_path}-profile next to output_path (not in it, as the simulator would treat it as a trajectory).",
+        default=None,
+    )
+    parser.add_argument(
+        "--profile_interval",
+        type=float,
+        help="Seconds of CPU time between samples, for --profile sampling.",
+        default=0.001,
+    )
+    parser.add_argument(
+        "--profile_top",
+        type=int,
+        help="Number of functions listed for each stage in the --profile summary.",
+        default=20,
+    )
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
+    metrics = metrics_from_args(args)
+    cache = None
+    if args.cache_path is not None:
+        cache = StageCache(args.cache_path, int(args.cache_max_size * 1024**2))
+    index = None
+    if args.dedup_index is not None:
+        index = FlightIndex(args.dedup_index, args.dedup_similarity)
+    reservoir = None
+    if args.sample is not None:
+        reservoir = FlightReservoir(
+            args.sample,
+            args.seed,
+            args.strata,
+            sorted(args.altitude_bands),
+            args.sample_weight,
+        )
 
     # Check input path exists
     input_path = Path(args.input_path)
     output_path = Path(args.output_path)
 
+    profiler = None
+    if args.profile is not None:
+        # Only imported when asked for, so normal runs don't load the profilers
+        from stage_profiler import StageProfiler
+
+        profile_path = args.profile_path
+        if profile_path is None:
+            resolved = output_path.resolve()
+            profile_path = resolved.with_name(resolved.name + "-profile")
+        profiler = StageProfiler(
+            profile_path,
+            args.profile,
+            args.profile_interval,
+            args.profile_top,
+        )
+
     if not output_path.exists():
         output_path.mkdir(parents=True, exist_ok=True)
 
     if input_path.exists():
         if not input_path.is_dir():
-            run_pipeline(input_path, output_path, args)
+            paths = [input_path]
         else:
-            for path in input_path.iterdir():
+            paths = sorted(input_path.iterdir())
+        buffer = OpenFlightBuffer() if args.stitch else None
+        metrics.expect("files_processed_total", len(paths))
+
+        exported = []
+        for count, path in enumerate(paths):
+            metrics.set("files_queued", len(paths) - count)
+            if input_path.is_dir():
                 print("Processing {}".format(path))
-                try:
-                    run_pipeline(path, output_path, args)
-                except:
-                    print("Error on {}".format(path))
-                    traceback.print_exc()
+            try:
+                with metrics.timer("file_seconds"):
+                    exported += run_pipeline(
+                        path,
+                        output_path,
+                        args,
+                        metrics,
+                        cache,
+                        reservoir,
+                        index,
+                        profiler,
+                        buffer,
+                        count == len(paths) - 1,
+                    )
+            except:
+                metrics.inc("files_failed_total")
+                if not input_path.is_dir():
+                    raise
+                print("Error on {}".format(path))
+                traceback.print_exc()
+            metrics.inc("files_processed_total")
+        metrics.set("files_queued", 0)
+
+        if reservoir is not None:
+            exported = export_sample(reservoir, output_path, args, metrics, index)
+
+        if args.layout == "sharded" or args.manifest or has_manifest(output_path):
+            update_manifest(output_path, exported, args.layout)
+
+    if profiler is not None:
+        profiler.save()
+        print("Profile written to {}".format(profiler.profile_path))
+    if index is not None:
+        index.close()
+    metrics.close()
@@ -0,0 +1,530 @@
+"""
+output_watcher.py
+
+Watches a simulator output directory and keeps a running aggregate of its results, so a campaign can be analysed while it is still running.
+
+The costs/, cost_map/ and logs/ directories are polled. Each new file is only ingested once it has stopped changing and parses as complete JSON, so files the simulator is part way through writing are skipped until the next poll. Each ingested file adds a row to an aggregate CSV and updates running summary statistics, and the watcher's state is saved so restarting it only reads files it hasn't seen before. A file which is rewritten after being ingested is ingested again, replacing its earlier row and contribution to the summary.
+"""
+
+import os
+import csv
+import json
+import math
+import time
+import argparse
+from pathlib import Path
+
+from metrics import add_metrics_arguments, metrics_from_args
+
+DEFAULT_INTERVAL = 30
+DEFAULT_SETTLE_TIME = 5
+DEFAULT_TOP_N = 10
+
+# Columns of each aggregate table, keyed by output subdirectory
+TABLE_COLUMNS = {
+    "costs": [
+        "file",
+        "traj_name",
+        "start_cost",
+        "best_cost",
+        "iterations",
+        "run_name",
+        "mode",
+        "rate",
+        "cross_point",
+        "attacker_pos",
+        "start_alt_delta",
+        "end_alt_delta",
+    ],
+    "cost_map": [
+        "file",
+        "traj_name",
+        "strategies",
+        "max_cost",
+        "mean_cost",
+        "best_run_name",
+    ],
+    "logs": [
+        "file",
+        "traj_name",
+        "run_name",
+        "reports",
+        "ra_reports",
+        "longest_ra_run",
+        "first_ra_time",
+    ],
+}
+# Which column summary statistics are kept for, for each table
+SUMMARY_COLUMNS = {
+    "costs": ["best_cost", "start_cost"],
+    "cost_map": ["max_cost"],
+    "logs": ["ra_reports", "longest_ra_run"],
+}
+# Files in each subdirectory to ingest
+FILE_SUFFIXES = {
+    "costs": "-costs.json",
+    "cost_map": "-costs-map.json",
+    "logs": "-TRM.json",
+}
+
+
+def costs_row(content: dict) -> dict:
+    """Summarises a -costs.json file, as written by log_costs.
+
+    Parameters
+    ----------
+    content : dict
+        Parsed file contents
+
+    Returns
+    -------
+    dict
+        One row of the costs table
+    """
+    metadata = content["metadata"]
+    strategy = metadata.get("best_strategy") or {}
+    if not isinstance(strategy, dict):
+        strategy = {}
+    row = {
+        "traj_name": metadata["traj_name"],
+        "start_cost": metadata.get("start_cost"),
+        "best_cost": metadata.get("best_cost"),
+        "iterations": len(content.get("data") or []),
+    }
+    for key in TABLE_COLUMNS["costs"][5:]:
+        row[key] = strategy.get(key)
+    return row
+
+
+def cost_map_row(content: dict) -> dict:
+    """Summarises a -costs-map.json file, as written by log_cost_map.
+
+    Parameters
+    ----------
+    content : dict
+        Parsed file contents
+
+    Returns
+    -------
+    dict
+        One row of the cost_map table
+    """
+    strategies = [
+        i for i in content["data"].values() if isinstance(i, dict) and "cost" in i
+    ]
+    costs = [i["cost"] for i in strategies]
+    best = max(strategies, key=lambda x: x["cost"]) if len(strategies) > 0 else {}
+    return {
+        "traj_name": content["metadata"]["traj_name"],
+        "strategies": len(strategies),
+        "max_cost": max(costs) if len(costs) > 0 else None,
+        "mean_cost": sum(costs) / len(costs) if len(costs) > 0 else None,
+        "best_run_name": best.get("run_name"),
+    }
+
+
+def trm_log_row(content: dict) -> dict:
+    """Summarises a -TRM.json log, as written by dump_logs.
+
+    RAs are counted the same way as calculate_run_cost, using the first designated intruder's active_ra flag.
+
+    Parameters
+    ----------
+    content : dict
+        Parsed file contents
+
+    Returns
+    -------
+    dict
+        One row of the logs table
+    """
+    ra_reports = 0
+    longest_ra_run = 0
+    current_run = 0
+    first_ra_time = None
+    for report in content["run_data"]:
+        intruders = ((report.get("trm_report") or {}).get("designation") or {}).get(
+            "intruder"
+        ) or []
+        if len(intruders) > 0 and intruders[0].get("active_ra"):
+            ra_reports += 1
+            current_run += 1
+            longest_ra_run = max(longest_ra_run, current_run)
+            if first_ra_time is None:
+                first_ra_time = report["report_time"]
+        else:
+            current_run = 0
+    return {
+        "traj_name": content["metadata"]["traj_name"],
+        "run_name": content["metadata"].get("run_name"),
+        "reports": len(content["run_data"]),
+        "ra_reports": ra_reports,
+        "longest_ra_run": longest_ra_run,
+        "first_ra_time": first_ra_time,
+    }
+
+
+ROW_BUILDERS = {"costs": costs_row, "cost_map": cost_map_row, "logs": trm_log_row}
+
+
+def csv_number(value: str):
+    """Reads a number back from an aggregate CSV.
+
+    Parameters
+    ----------
+    value : str
+        CSV field, empty if the value was missing
+
+    Returns
+    -------
+    int, float or None
+        The value, or None if it was missing
+    """
+    if value == "":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def empty_summary() -> dict:
+    """Running statistics for one column.
+
+    Returns
+    -------
+    dict
+        count, sum, sum_sq, min and max, all empty
+    """
+    return {"count": 0, "sum": 0.0, "sum_sq": 0.0, "min": None, "max": None}
+
+
+def update_summary(summary: dict, value):
+    """Adds a value to a column's running statistics.
+
+    Parameters
+    ----------
+    summary : dict
+        Running statistics, from empty_summary
+    value : float or None
+        Value to add - missing values are ignored
+    """
+    if value is None:
+        return
+    summary["count"] += 1
+    summary["sum"] += value
+    summary["sum_sq"] += value * value
+    summary["min"] = value if summary["min"] is None else min(summary["min"], value)
+    summary["max"] = value if summary["max"] is None else max(summary["max"], value)
+
+
+def finalise_summary(summary: dict) -> dict:
+    """Adds the mean and standard deviation to a column's running statistics.
+
+    Parameters
+    ----------
+    summary : dict
+        Running statistics
+
+    Returns
+    -------
+    dict
+        count, mean, std, min and max
+    """
+    if summary["count"] == 0:
+        return {"count": 0, "mean": None, "std": None, "min": None, "max": None}
+    mean = summary["sum"] / summary["count"]
+    variance = max(summary["sum_sq"] / summary["count"] - mean * mean, 0)
+    return {
+        "count": summary["count"],
+        "mean": mean,
+        "std": math.sqrt(variance),
+        "min": summary["min"],
+        "max": summary["max"],
+    }
+
+
+class OutputAggregator:
+    """
+    Incrementally ingests simulator output files into aggregate tables and summary statistics.
+
+    Parameters
+    ----------
+    output_path : Path
+        Simulator output directory (PARAM_OUTPUT_FILEPATH), containing costs/, cost_map/ and logs/
+    aggregate_path : Path
+        Directory to write the aggregate tables, summary and watcher state to
+    settle_time : float, optional
+        Seconds a file must go unmodified before it is read, by default DEFAULT_SETTLE_TIME
+    top_n : int, optional
+        Number of highest cost trajectories kept in the summary, by default DEFAULT_TOP_N
+    """
+
+    def __init__(
+        self,
+        output_path: Path,
+        aggregate_path: Path,
+        settle_time: float = DEFAULT_SETTLE_TIME,
+        top_n: int = DEFAULT_TOP_N,
+    ):
+        self.output_path = Path(output_path)
+        self.aggregate_path = Path(aggregate_path)
+        self.aggregate_path.mkdir(parents=True, exist_ok=True)
+        self.settle_time = settle_time
+        self.top_n = top_n
+        self.state_file = self.aggregate_path / "watcher_state.json"
+
+        if self.state_file.exists():
+            with open(self.state_file, "r") as f:
+                self.state = json.load(f)
+        else:
+            self.state = {
+                "ingested": {},
+                "summaries": {
+                    table: {column: empty_summary() for column in columns}
+                    for table, columns in SUMMARY_COLUMNS.items()
+                },
+                "top": [],
+            }
+        # Files found on the last poll which weren't ready to read yet
+        self.pending = {}
+
+    def table_path(self, table: str) -> Path:
+        """Path of the aggregate CSV for an output subdirectory."""
+        return self.aggregate_path / "{}.csv".format(table)
+
+    def find_ready_files(self) -> list:
+        """Lists files which are new or changed, and haven't been modified for settle_time.
+
+        Files which are still changing are added to self.pending instead.
+
+        Returns
+        -------
+        list
+            (table, path, signature) tuples, where signature is [size, mtime_ns]
+        """
+        now = time.time()
+        ready = []
+        for table, suffix in FILE_SUFFIXES.items():
+            directory = self.output_path / table
+            if not directory.exists():
+                continue
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(suffix) or not entry.is_file():
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        # Removed since the directory was listed
+                        continue
+                    signature = [stat.st_size, stat.st_mtime_ns]
+                    key = "{}/{}".format(table, entry.name)
+                    if self.state["ingested"].get(key) == signature:
+                        continue
+                    if now - stat.st_mtime >= self.settle_time:
+                        ready.append((table, Path(entry.path), signature))
+                    else:
+                        self.pending[key] = signature
+        return ready
+
+    def remove_file(self, table: str, filename: str):
+        """Drops a file's row from an aggregate table, and rebuilds the table's summary statistics (and the highest costs) from the rows left.
+
+        Parameters
+        ----------
+        table : str
+            Output subdirectory the file is in
+        filename : str
+            Name of the file, as in the table's file column
+        """
+        table_path = self.table_path(table)
+        if not table_path.exists():
+            return
+        with open(table_path, "r", newline="") as f:
+            rows = [i for i in csv.DictReader(f) if i["file"] != filename]
+        temp_path = table_path.with_name(table_path.name + ".tmp")
+        with open(temp_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=TABLE_COLUMNS[table])
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(temp_path, table_path)
+
+        summaries = {column: empty_summary() for column in SUMMARY_COLUMNS[table]}
+        for row in rows:
+            for column, summary in summaries.items():
+                update_summary(summary, csv_number(row[column]))
+        self.state["summaries"][table] = summaries
+        if table == "costs":
+            top = [
+                [csv_number(i["best_cost"]), i["traj_name"], i["file"]]
+                for i in rows
+                if i["best_cost"] != ""
+            ]
+            self.state["top"] = sorted(top, reverse=True)[: self.top_n]
+
+    def ingest(self, table: str, path: Path, signature: list) -> bool:
+        """Reads one file and adds it to the aggregate.
+
+        Parameters
+        ----------
+        table : str
+            Output subdirectory the file is in
+        path : Path
+            Path to the file
+        signature : list
+            The file's [size, mtime_ns] when it was found
+
+        Returns
+        -------
+        bool
+            True if the file was ingested, False if it isn't complete yet or has been removed
+        """
+        key = "{}/{}".format(table, path.name)
+        try:
+            with open(path, "r") as f:
+                content = json.load(f)
+            row = ROW_BUILDERS[table](content)
+        except (json.JSONDecodeError, UnicodeDecodeError, KeyError, TypeError):
+            # Partially written - try again on the next poll
+            self.pending[key] = signature
+            return False
+        except OSError:
+            # Removed or renamed since it was found
+            self.pending.pop(key, None)
+            return False
+
+        if key in self.state["ingested"]:
+            # Rewritten since it was last ingested - replace its earlier row
+            self.remove_file(table, path.name)
+        row["file"] = path.name
+        table_path = self.table_path(table)
+        write_header = not table_path.exists()
+        with open(table_path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=TABLE_COLUMNS[table])
+            if write_header:
+                writer.writeheader()
+            writer.writerow(row)
+
+        for column, summary in self.state["summaries"][table].items():
+            update_summary(summary, row.get(column))
+        if table == "costs" and row["best_cost"] is not None:
+            self.state["top"].append([row["best_cost"], row["traj_name"], path.name])
+            self.state["top"] = sorted(self.state["top"], reverse=True)[: self.top_n]
+
+        self.state["ingested"][key] = signature
+        self.pending.pop(key, None)
+        return True
+
+    def summary(self) -> dict:
+        """Builds the current summary of everything ingested so far.
+
+        Returns
+        -------
+        dict
+            Files ingested per table, statistics per summary column and the highest cost trajectories
+        """
+        files = {table: 0 for table in TABLE_COLUMNS}
+        for key in self.state["ingested"]:
+            files[key.split("/")[0]] += 1
+        return {
+            "updated": time.time(),
+            "files": files,
+            "statistics": {
+                table: {
+                    column: finalise_summary(summary)
+                    for column, summary in summaries.items()
+                }
+                for table, summaries in self.state["summaries"].items()
+            },
+            "highest_costs": [
+                {"best_cost": cost, "traj_name": name, "file": filename}
+                for cost, name, filename in self.state["top"]
+            ],
+        }
+
+    def poll(self) -> int:
+        """Ingests every file which is ready, then saves the summary and state.
+
+        Returns
+        -------
+        int
+            Number of files ingested
+        """
+        ingested = 0
+        for table, path, signature in self.find_ready_files():
+            if self.ingest(table, path, signature):
+                ingested += 1
+
+        if ingested > 0:
+            with open(self.aggregate_path / "summary.json", "w") as f:
+                json.dump(self.summary(), f, indent=2)
+            with open(self.state_file, "w") as f:
+                json.dump(self.state, f)
+        return ingested
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Watches a simulator output directory and incrementally aggregates new costs, cost map and TRM log files as they are written.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "output_path",
+        type=str,
+        help="Simulator output directory (PARAM_OUTPUT_FILEPATH) to watch.",
+    )
+    parser.add_argument(
+        "aggregate_path",
+        type=str,
+        help="Directory to save the aggregate CSVs, summary.json and watcher state to.",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        help="Seconds between polls of the output directory.",
+        default=DEFAULT_INTERVAL,
+    )
+    parser.add_argument(
+        "--settle_time",
+        type=float,
+        help="Seconds a file must go unmodified before it is read.",
+        default=DEFAULT_SETTLE_TIME,
+    )
+    parser.add_argument(
+        "--top_n",
+        type=int,
+        help="Number of highest cost trajectories listed in the summary.",
+        default=DEFAULT_TOP_N,
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Ingest whatever is ready and exit, rather than watching. Files still being written are picked up on the next run.",
+    )
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    metrics = metrics_from_args(args)
+
+    aggregator = OutputAggregator(
+        Path(args.output_path), Path(args.aggregate_path), args.settle_time, args.top_n
+    )
+
+    try:
+        while True:
+            ingested = aggregator.poll()
+            metrics.inc("files_ingested_total", ingested)
+            metrics.set("files_pending", len(aggregator.pending))
+            if ingested > 0:
+                print(
+                    "Ingested {} files ({} waiting to settle)".format(
+                        ingested, len(aggregator.pending)
+                    )
+                )
+            if args.once:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    metrics.close()
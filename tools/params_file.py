@@ -0,0 +1,142 @@
+"""
+params_file.py
+
+Helpers for reading and writing the Julia parameter files used by the simulator (e.g. code/user_params.jl), so tools can generate parameter files for follow-up runs.
+"""
+
+import re
+
+
+def to_julia(value, indent: int = 0) -> str:
+    """Converts a Python value into a Julia literal, in the style used by the parameter files.
+
+    Parameters
+    ----------
+    value : dict, list, str, bool, int or float
+        Value to convert. Dicts become Julia 0.3 style {"key" => value} literals.
+    indent : int, optional
+        Current indentation level, used for nested dicts, by default 0
+
+    Returns
+    -------
+    str
+        Julia source for the value
+    """
+    pad = "    " * (indent + 1)
+    if isinstance(value, dict):
+        if len(value) == 0:
+            return "{}"
+        entries = [
+            "{}{} => {}".format(pad, to_julia(k), to_julia(v, indent + 1))
+            for k, v in value.items()
+        ]
+        return "{\n" + ",\n".join(entries) + "\n" + "    " * indent + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(to_julia(i, indent) for i in value) + "]"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, str):
+        return '"{}"'.format(value.replace("\\", "\\\\").replace('"', '\\"'))
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def param_block_pattern(name: str):
+    """Builds a regex matching a (multi-line) constant dict definition in a parameter file.
+
+    Parameters
+    ----------
+    name : str
+        Parameter name, e.g. PARAM_ATTACKER_LATLON
+
+    Returns
+    -------
+    re.Pattern
+        Pattern matching from 'const NAME = {' to the closing brace at the start of a line. Commented out definitions are not matched.
+    """
+    return re.compile(
+        r"^const {} = \{{.*?^\}}".format(re.escape(name)), re.MULTILINE | re.DOTALL
+    )
+
+
+def find_param_block(params_text: str, name: str) -> str:
+    """Finds the source of a constant dict definition in a parameter file.
+
+    Parameters
+    ----------
+    params_text : str
+        Contents of a parameter file
+    name : str
+        Parameter name
+
+    Returns
+    -------
+    str
+        Source of the definition
+
+    Raises
+    ------
+    ValueError
+        If the parameter is not defined in the file
+    """
+    block = param_block_pattern(name).search(params_text)
+    if block is None:
+        raise ValueError("No {} found in parameter file".format(name))
+    return block.group(0)
+
+
+def replace_param_block(params_text: str, name: str, value: dict) -> str:
+    """Replaces a constant dict definition in a parameter file with a new value.
+
+    Parameters
+    ----------
+    params_text : str
+        Contents of a parameter file
+    name : str
+        Parameter name
+    value : dict
+        New value for the parameter
+
+    Returns
+    -------
+    str
+        The new parameter file contents
+
+    Raises
+    ------
+    ValueError
+        If the parameter is not defined in the file
+    """
+    find_param_block(params_text, name)
+    block = "const {} = {}".format(name, to_julia(value))
+    return param_block_pattern(name).sub(lambda _: block, params_text, count=1)
+
+
+def set_param(params_text: str, name: str, value) -> str:
+    """Sets a single-line (non-const) parameter, e.g. PARAM_OUTPUT_FILEPATH.
+
+    Parameters
+    ----------
+    params_text : str
+        Contents of a parameter file
+    name : str
+        Parameter name
+    value : str, bool, int or float
+        New value for the parameter
+
+    Returns
+    -------
+    str
+        The new parameter file contents
+
+    Raises
+    ------
+    ValueError
+        If the parameter is not defined in the file
+    """
+    pattern = re.compile(r"^{} = .*$".format(re.escape(name)), re.MULTILINE)
+    if pattern.search(params_text) is None:
+        raise ValueError("No {} found in parameter file".format(name))
+    line = "{} = {}".format(name, to_julia(value))
+    return pattern.sub(lambda _: line, params_text, count=1)
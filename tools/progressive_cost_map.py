@@ -0,0 +1,673 @@
+"""
+progressive_cost_map.py
+
+Drives the simulator through a coarse-to-fine cost map sweep, as a faster alternative to cost map mode.
+
+Each trajectory starts with a coarse (rate, cross_point) lattice, taken as every 2^k-th point of the simulator's cost map grid, so every strategy simulated is one cost map mode would have run. After every round, any cell whose corner costs differ by more than a tolerance is split, and only the new corner strategies are simulated in the next round. A trajectory stops once none of its cells need splitting, or once its simulation budget is spent. Rounds are run in defined strategy mode, and the merged results are written in the usual *-costs-map.json layout, with a resolution field on every entry.
+
+Progress is saved to a state file after every round, so a sweep can be stopped (Ctrl+C) and resumed later, and the cost maps written so far are always usable.
+"""
+
+import json
+import time
+import shlex
+import argparse
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+from cost_surrogate import (
+    PARAM_CROSS_POINT_MAX,
+    PARAM_CROSS_POINT_MIN,
+    PARAM_COST_MAP_CROSS_POINT_INTERVAL,
+    PARAM_COST_MAP_RATE_INTERVAL,
+    PARAM_RATE_MAX,
+    julia_number,
+    load_cost_maps,
+)
+from flight_files import flight_name
+from metrics import add_metrics_arguments, metrics_from_args
+from params_file import replace_param_block, set_param
+
+DEFAULT_COARSE_LEVEL = 2
+DEFAULT_TOLERANCE = 10.0
+# The number of strategies in a full cost map with the default parameters
+DEFAULT_BUDGET = 96
+DEFAULT_SIMULATOR_COMMAND = "docker-compose run simulator 2 --params_file {params_file}"
+
+
+def lattice(minimum: float, maximum: float, interval: float) -> list:
+    """The simulator's cost map grid along one axis, minimum:interval:maximum as in generate_cost_map_strategies.
+
+    Parameters
+    ----------
+    minimum : float
+        First value
+    maximum : float
+        Largest value - only included if it is a whole number of intervals from minimum
+    interval : float
+        Gap between values
+
+    Returns
+    -------
+    list
+        The values
+    """
+    return [round(float(i), 10) for i in np.arange(minimum, maximum + 1e-9, interval)]
+
+
+def coarse_lattice(grid: list, level: int) -> list:
+    """Every 2^level-th value of a grid, always keeping the last value so the whole grid is covered.
+
+    Parameters
+    ----------
+    grid : list
+        The full grid, from lattice
+    level : int
+        How many times coarser than the grid to start, as a power of two
+
+    Returns
+    -------
+    list
+        The coarse values, a subset of grid
+    """
+    values = grid[:: 2**level]
+    if values[-1] != grid[-1]:
+        values.append(grid[-1])
+    return values
+
+
+def make_strategy(rate: float, cross_point: float, attacker_pos: int) -> dict:
+    """Builds a cost map strategy, named the same way as generate_cost_map_strategies in the simulator.
+
+    Parameters
+    ----------
+    rate : float
+        Attacker vertical rate
+    cross_point : float
+        Point of the trajectory at which the attacker crosses the ownship
+    attacker_pos : int
+        0 for the end of the trajectory, 1 for the middle
+
+    Returns
+    -------
+    dict
+        The strategy, in the simulator's strategy format
+    """
+    rate = round(rate, 6)
+    rate = int(rate) if rate.is_integer() else rate
+    cross_point = round(cross_point, 10)
+    run_name = "cp{}r{}-{}".format(
+        julia_number(cross_point), julia_number(rate), ["end", "mid"][attacker_pos]
+    )
+    return {
+        "run_name": run_name,
+        "mode": 3,
+        "start_alt_delta": 0,
+        "end_alt_delta": 0,
+        "rate": rate,
+        "cross_point": cross_point,
+        "attacker_pos": attacker_pos,
+    }
+
+
+def cell_corners(cell: dict) -> list:
+    """Builds the four corner strategies of a cell.
+
+    Parameters
+    ----------
+    cell : dict
+        A cell, with attacker_pos, rate [low, high] and cross_point [low, high]
+
+    Returns
+    -------
+    list
+        Corner strategies
+    """
+    return [
+        make_strategy(rate, cross_point, cell["attacker_pos"])
+        for rate in cell["rate"]
+        for cross_point in cell["cross_point"]
+    ]
+
+
+def initial_state(
+    trajectories: list, rate_grid: list, cross_point_grid: list, coarse_level: int
+) -> dict:
+    """Sets up the coarse lattice for every trajectory.
+
+    Parameters
+    ----------
+    trajectories : list
+        Trajectory filenames
+    rate_grid : list
+        Rates of the simulator's cost map grid
+    cross_point_grid : list
+        Cross points of the simulator's cost map grid
+    coarse_level : int
+        The coarse lattice takes every 2^coarse_level-th point of the grid
+
+    Returns
+    -------
+    dict
+        Sweep state
+    """
+    rates = coarse_lattice(rate_grid, coarse_level)
+    cross_points = coarse_lattice(cross_point_grid, coarse_level)
+    cells = [
+        {
+            "attacker_pos": attacker_pos,
+            "rate": [rate_0, rate_1],
+            "cross_point": [cross_point_0, cross_point_1],
+            "settled": False,
+        }
+        for attacker_pos in [0, 1]
+        for rate_0, rate_1 in zip(rates[:-1], rates[1:])
+        for cross_point_0, cross_point_1 in zip(cross_points[:-1], cross_points[1:])
+    ]
+    pending = {i["run_name"]: i for cell in cells for i in cell_corners(cell)}
+
+    return {
+        "round": 0,
+        "trajectories": {
+            name: {
+                "points": {},
+                "cells": [dict(i) for i in cells],
+                "pending": [pending[i] for i in sorted(pending)],
+                "done": False,
+                "reason": "",
+            }
+            for name in trajectories
+        },
+    }
+
+
+def split_cell(cell: dict, rate_grid: list, cross_point_grid: list) -> list:
+    """Splits a cell at the middle grid point along each side which still has grid points inside it.
+
+    Parameters
+    ----------
+    cell : dict
+        The cell to split
+    rate_grid : list
+        Rates of the simulator's cost map grid
+    cross_point_grid : list
+        Cross points of the simulator's cost map grid
+
+    Returns
+    -------
+    list
+        Child cells, or an empty list if the cell can't be split
+    """
+    sides = {}
+    for key, grid in [("rate", rate_grid), ("cross_point", cross_point_grid)]:
+        low, high = cell[key]
+        inside = [i for i in grid if low + 1e-9 < i < high - 1e-9]
+        if len(inside) > 0:
+            middle = inside[len(inside) // 2]
+            sides[key] = [[low, middle], [middle, high]]
+        else:
+            sides[key] = [[low, high]]
+
+    if len(sides["rate"]) == 1 and len(sides["cross_point"]) == 1:
+        return []
+    return [
+        {
+            "attacker_pos": cell["attacker_pos"],
+            "rate": rate,
+            "cross_point": cross_point,
+            "settled": False,
+        }
+        for rate in sides["rate"]
+        for cross_point in sides["cross_point"]
+    ]
+
+
+def cell_disagreement(cell: dict, points: dict) -> float:
+    """The spread of the simulated costs at a cell's corners.
+
+    Parameters
+    ----------
+    cell : dict
+        The cell
+    points : dict
+        Simulated strategies with their cost, keyed by run name
+
+    Returns
+    -------
+    float
+        Largest minus smallest corner cost, or 0 if fewer than two corners were simulated successfully
+    """
+    costs = [
+        points[i["run_name"]]["cost"]
+        for i in cell_corners(cell)
+        if i["run_name"] in points
+    ]
+    if len(costs) < 2:
+        return 0.0
+    return float(max(costs) - min(costs))
+
+
+def refine_trajectory(
+    trajectory_state: dict,
+    tolerance: float,
+    budget: int,
+    rate_grid: list,
+    cross_point_grid: list,
+):
+    """Plans the next round for one trajectory, once its pending strategies have been simulated.
+
+    Cells within tolerance are settled. The rest are split worst first, for as long as the budget allows, and their new corners become the trajectory's pending strategies. Updates trajectory_state in place.
+
+    Parameters
+    ----------
+    trajectory_state : dict
+        The trajectory's entry in the sweep state
+    tolerance : float
+        Cells whose corner costs differ by no more than this are settled
+    budget : int
+        Maximum number of strategies simulated for the trajectory
+    rate_grid : list
+        Rates of the simulator's cost map grid
+    cross_point_grid : list
+        Cross points of the simulator's cost map grid
+    """
+    points = trajectory_state["points"]
+    # Failed runs count towards the budget, but have no cost
+    simulated = set(points) | set(trajectory_state.get("failed", []))
+
+    candidates = []
+    for cell in trajectory_state["cells"]:
+        if cell["settled"]:
+            continue
+        disagreement = cell_disagreement(cell, points)
+        children = split_cell(cell, rate_grid, cross_point_grid)
+        if disagreement <= tolerance or len(children) == 0:
+            cell["settled"] = True
+        else:
+            candidates.append((disagreement, cell, children))
+
+    if len(candidates) == 0:
+        trajectory_state.update(pending=[], done=True, reason="converged")
+        return
+
+    candidates.sort(key=lambda x: x[0], reverse=True)
+    pending = {}
+    split = []
+    for _, cell, children in candidates:
+        new_points = {
+            i["run_name"]: i
+            for child in children
+            for i in cell_corners(child)
+            if i["run_name"] not in simulated
+        }
+        if len(simulated) + len(set(pending) | set(new_points)) > budget:
+            continue
+        pending.update(new_points)
+        split.append((cell, children))
+
+    if len(split) == 0:
+        trajectory_state.update(pending=[], done=True, reason="budget")
+        return
+
+    for cell, children in split:
+        trajectory_state["cells"].remove(cell)
+        trajectory_state["cells"].extend(children)
+    trajectory_state["pending"] = [pending[i] for i in sorted(pending)]
+
+
+def point_resolution(trajectory_state: dict) -> dict:
+    """Finds the finest cell each simulated strategy is a corner of.
+
+    Parameters
+    ----------
+    trajectory_state : dict
+        The trajectory's entry in the sweep state
+
+    Returns
+    -------
+    dict
+        Maps run name to {"rate": side, "cross_point": side}
+    """
+    resolution = {}
+    for cell in trajectory_state["cells"]:
+        sides = {
+            "rate": cell["rate"][1] - cell["rate"][0],
+            "cross_point": round(cell["cross_point"][1] - cell["cross_point"][0], 10),
+        }
+        for corner in cell_corners(cell):
+            current = resolution.get(corner["run_name"])
+            if current is None or sides["rate"] * sides["cross_point"] < (
+                current["rate"] * current["cross_point"]
+            ):
+                resolution[corner["run_name"]] = sides
+    return resolution
+
+
+def write_cost_map(path: Path, name: str, trajectory_state: dict, rounds: int):
+    """Writes a trajectory's merged results in the *-costs-map.json layout.
+
+    Parameters
+    ----------
+    path : Path
+        Directory to write to
+    name : str
+        Trajectory filename
+    trajectory_state : dict
+        The trajectory's entry in the sweep state
+    rounds : int
+        Number of rounds run so far
+    """
+    resolution = point_resolution(trajectory_state)
+    data = {}
+    for run_name, point in trajectory_state["points"].items():
+        data[run_name] = dict(point, resolution=resolution.get(run_name))
+
+    traj_name = flight_name(name)
+    with open(path / "{}-costs-map.json".format(traj_name), "w") as f:
+        json.dump(
+            {
+                "metadata": {
+                    "traj_name": traj_name,
+                    "converged": trajectory_state["reason"] == "converged",
+                    "stop_reason": trajectory_state["reason"],
+                    "simulations": len(trajectory_state["points"])
+                    + len(trajectory_state.get("failed", [])),
+                    "rounds": rounds,
+                },
+                "data": data,
+            },
+            f,
+        )
+
+
+def group_pending(state: dict) -> list:
+    """Groups unfinished trajectories which need the same strategies simulated, so each group is one simulator run.
+
+    Parameters
+    ----------
+    state : dict
+        Sweep state
+
+    Returns
+    -------
+    list
+        (strategies, trajectory names) tuples
+    """
+    strategies = {}
+    groups = {}
+    for name, trajectory_state in state["trajectories"].items():
+        if not trajectory_state["done"] and len(trajectory_state["pending"]) > 0:
+            key = tuple(i["run_name"] for i in trajectory_state["pending"])
+            strategies[key] = trajectory_state["pending"]
+            groups.setdefault(key, []).append(name)
+    return sorted([(strategies[i], groups[i]) for i in groups], key=lambda x: x[1][0])
+
+
+def run_group(
+    params_text: str,
+    strategies: list,
+    trajectories: list,
+    round_output: str,
+    round_host_output: Path,
+    params_path: Path,
+    simulator_command: str,
+    repo_path: str,
+) -> dict:
+    """Simulates one group of trajectories and strategies in defined strategy mode.
+
+    Parameters
+    ----------
+    params_text : str
+        Template parameter file contents
+    strategies : list
+        Strategies to simulate
+    trajectories : list
+        Trajectory filenames to simulate them on
+    round_output : str
+        Output directory for this group, as seen by the simulator
+    round_host_output : Path
+        The same directory, as seen from here
+    params_path : Path
+        Where to write the group's parameter file
+    simulator_command : str
+        Command to run the simulator, with a {params_file} placeholder
+    repo_path : str
+        Directory to run the simulator command from
+
+    Returns
+    -------
+    dict
+        Simulated costs, as returned by load_cost_maps
+    """
+    round_host_output.mkdir(parents=True, exist_ok=True)
+    with open(round_host_output / "trajectories.json", "w") as f:
+        json.dump(
+            {
+                "metadata": {"source": "progressive_cost_map"},
+                "trajectories": [
+                    {"name": i, "weight": 1 / len(trajectories)} for i in trajectories
+                ],
+            },
+            f,
+            indent=2,
+        )
+
+    params_text = replace_param_block(
+        params_text, "PARAM_DEFAULT_STRATEGIES", {i["run_name"]: i for i in strategies}
+    )
+    params_text = set_param(params_text, "PARAM_OUTPUT_FILEPATH", round_output)
+    params_text = set_param(
+        params_text, "PARAM_TRAJECTORY_LIST_FILE", round_output + "trajectories.json"
+    )
+    with open(params_path, "w") as f:
+        f.write(params_text)
+
+    subprocess.run(
+        shlex.split(simulator_command.format(params_file=params_path.name)),
+        cwd=repo_path,
+        check=True,
+    )
+    return load_cost_maps(
+        sorted((round_host_output / "cost_map").glob("*-costs-map.json"))
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Runs a progressive coarse-to-fine cost map sweep, only simulating more strategies where the cost map is still changing.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "params_file",
+        type=str,
+        help="Simulator parameter file used as a template for every round.",
+    )
+    parser.add_argument(
+        "trajectory_list",
+        type=str,
+        help="Trajectory list JSON (e.g. from trajectory_clustering.py) of trajectories to map.",
+    )
+    parser.add_argument(
+        "--output_filepath",
+        type=str,
+        help="Output directory for the sweep, as seen by the simulator.",
+        default="/output_data/progressive_cost_map/",
+    )
+    parser.add_argument(
+        "--host_output_path",
+        type=str,
+        help="The same output directory, as seen from here.",
+        default="../output_data/progressive_cost_map/",
+    )
+    parser.add_argument(
+        "--params_dir",
+        type=str,
+        help="Directory to write each round's parameter files to. Must be the simulator's code directory, as the file is passed by name.",
+        default="../code/",
+    )
+    parser.add_argument(
+        "--simulator_command",
+        type=str,
+        help="Command that runs the simulator, with {params_file} in place of the parameter file.",
+        default=DEFAULT_SIMULATOR_COMMAND,
+    )
+    parser.add_argument(
+        "--repo_path",
+        type=str,
+        help="Directory to run the simulator command from.",
+        default="..",
+    )
+    parser.add_argument(
+        "--state_file",
+        type=str,
+        help="Sweep state file. If it exists, the sweep carries on from where it stopped.",
+        default="progressive_cost_map_state.json",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        help="Cells whose corner costs differ by no more than this are not refined.",
+        default=DEFAULT_TOLERANCE,
+    )
+    parser.add_argument(
+        "--budget",
+        type=int,
+        help="Maximum number of strategies simulated per trajectory.",
+        default=DEFAULT_BUDGET,
+    )
+    parser.add_argument(
+        "--max_rounds",
+        type=int,
+        help="Stop after this many rounds, even if some trajectories are not finished.",
+        default=None,
+    )
+    parser.add_argument(
+        "--coarse_level",
+        type=int,
+        help="The starting lattice takes every 2^coarse_level-th point of the cost map grid.",
+        default=DEFAULT_COARSE_LEVEL,
+    )
+    parser.add_argument(
+        "--rate_interval",
+        type=float,
+        help="Rate step of the simulator's cost map grid (PARAM_COST_MAP_RATE_INTERVAL). Cells are split down to this.",
+        default=PARAM_COST_MAP_RATE_INTERVAL,
+    )
+    parser.add_argument(
+        "--cross_point_interval",
+        type=float,
+        help="Cross point step of the simulator's cost map grid (PARAM_COST_MAP_CROSS_POINT_INTERVAL). Cells are split down to this.",
+        default=PARAM_COST_MAP_CROSS_POINT_INTERVAL,
+    )
+
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    metrics = metrics_from_args(args)
+
+    with open(args.params_file, "r") as f:
+        params_text = f.read()
+
+    rate_grid = lattice(-PARAM_RATE_MAX, PARAM_RATE_MAX, args.rate_interval)
+    cross_point_grid = lattice(
+        PARAM_CROSS_POINT_MIN, PARAM_CROSS_POINT_MAX, args.cross_point_interval
+    )
+    state_path = Path(args.state_file)
+    if state_path.exists():
+        with open(state_path, "r") as f:
+            state = json.load(f)
+        print("Resuming from round {}".format(state["round"]))
+    else:
+        with open(args.trajectory_list, "r") as f:
+            trajectories = [i["name"] for i in json.load(f)["trajectories"]]
+        state = initial_state(
+            trajectories, rate_grid, cross_point_grid, args.coarse_level
+        )
+
+    host_output = Path(args.host_output_path)
+    cost_map_path = host_output / "cost_map"
+    cost_map_path.mkdir(parents=True, exist_ok=True)
+
+    try:
+        while args.max_rounds is None or state["round"] < args.max_rounds:
+            groups = group_pending(state)
+            if len(groups) == 0:
+                break
+
+            state["round"] += 1
+            round_simulations = sum(len(i[0]) * len(i[1]) for i in groups)
+            metrics.expect(
+                "simulations_total",
+                metrics.value("simulations_total", mode=2) + round_simulations,
+                mode=2,
+            )
+            metrics.set("sweep_round", state["round"])
+            print(
+                "Round {}: {} simulator runs, {} trajectories".format(
+                    state["round"], len(groups), sum(len(i[1]) for i in groups)
+                )
+            )
+            for group, (strategies, names) in enumerate(groups):
+                group_dir = "round{}/group{}/".format(state["round"], group)
+                metrics.set("simulator_runs_queued", len(groups) - group)
+                run_start = time.perf_counter()
+                costs = run_group(
+                    params_text,
+                    strategies,
+                    names,
+                    args.output_filepath + group_dir,
+                    host_output / group_dir,
+                    Path(args.params_dir)
+                    / "progressive_round{}_group{}.jl".format(state["round"], group),
+                    args.simulator_command,
+                    args.repo_path,
+                )
+                run_time = time.perf_counter() - run_start
+                simulations = len(strategies) * len(names)
+                metrics.observe("simulator_run_seconds", run_time, mode=2)
+                metrics.observe("simulation_seconds", run_time / simulations, mode=2)
+                metrics.inc("simulations_total", simulations, mode=2)
+
+                for name in names:
+                    trajectory_state = state["trajectories"][name]
+                    results = {
+                        i["run_name"]: i for i in costs.get(flight_name(name), [])
+                    }
+                    trajectory_state["points"].update(results)
+                    trajectory_state.setdefault("failed", []).extend(
+                        i["run_name"]
+                        for i in trajectory_state["pending"]
+                        if i["run_name"] not in results
+                    )
+                    refine_trajectory(
+                        trajectory_state,
+                        args.tolerance,
+                        args.budget,
+                        rate_grid,
+                        cross_point_grid,
+                    )
+                    write_cost_map(
+                        cost_map_path, name, trajectory_state, state["round"]
+                    )
+
+                with open(state_path, "w") as f:
+                    json.dump(state, f)
+    except KeyboardInterrupt:
+        print("Stopped - rerun with the same state file to carry on.")
+    metrics.set("simulator_runs_queued", 0)
+    metrics.close()
+
+    with open(state_path, "w") as f:
+        json.dump(state, f)
+
+    reasons = [i["reason"] or "unfinished" for i in state["trajectories"].values()]
+    print(
+        "{} trajectories: {}".format(
+            len(reasons),
+            ", ".join(
+                "{} {}".format(reasons.count(i), i) for i in sorted(set(reasons))
+            ),
+        )
+    )
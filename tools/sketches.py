@@ -0,0 +1,330 @@
+"""
+sketches.py
+
+Small, mergeable summaries of streams of values, for profiling inputs too large to load at once.
+
+- QuantileSketch estimates quantiles to within a relative error, by counting values in logarithmically sized buckets (as in DDSketch).
+- Histogram counts values between fixed edges.
+- HyperLogLog estimates the number of distinct values (e.g. ICAO24 addresses).
+
+Each is updated with whole arrays at a time, can be merged with another of the same configuration (e.g. one built by each worker), and can be saved to and loaded from JSON.
+"""
+
+import math
+import base64
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+
+# HyperLogLog registers are 2 ** precision bytes, with a standard error of
+# about 1.04 / sqrt(2 ** precision)
+DEFAULT_HLL_PRECISION = 14
+
+
+class QuantileSketch:
+    """Estimates quantiles of a stream of values, each to within a relative error.
+
+    Values are counted in buckets whose bounds grow geometrically, so the number of buckets only grows with the log of the range of values, not with how many there are.
+
+    Parameters
+    ----------
+    relative_accuracy : float, optional
+        Largest relative error of a quantile estimate, by default DEFAULT_RELATIVE_ACCURACY
+    """
+
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        # Bucket index -> count, for positive and negative values separately
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add_buckets(self, store: dict, values: np.ndarray):
+        """Counts (positive) values into a store's buckets."""
+        indexes, counts = np.unique(
+            np.ceil(np.log(values) / self.log_gamma).astype(np.int64),
+            return_counts=True,
+        )
+        for index, count in zip(indexes.tolist(), counts.tolist()):
+            store[index] = store.get(index, 0) + count
+
+    def update(self, values: np.ndarray):
+        """Adds values to the sketch. NaN and infinite values are ignored.
+
+        Parameters
+        ----------
+        values : np.ndarray
+            Values to add
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.add_buckets(self.positive, values[values > 0])
+        self.add_buckets(self.negative, -values[values < 0])
+        self.zero += int((values == 0).sum())
+
+    def merge(self, other: "QuantileSketch"):
+        """Adds every value counted by another sketch with the same accuracy.
+
+        Raises
+        ------
+        ValueError
+            If the sketches have different accuracies
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Can't merge sketches with different accuracies")
+        for store, other_store in [
+            (self.positive, other.positive),
+            (self.negative, other.negative),
+        ]:
+            for index, count in other_store.items():
+                store[index] = store.get(index, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def bucket_value(self, index: int) -> float:
+        """Value representing a bucket, within the relative accuracy of everything in it."""
+        return 2 * self.gamma**index / (self.gamma + 1)
+
+    def quantile(self, q: float) -> float:
+        """Estimates a quantile.
+
+        Parameters
+        ----------
+        q : float
+            Quantile, between 0 and 1
+
+        Returns
+        -------
+        float
+            Estimated value, or NaN if the sketch is empty
+        """
+        if self.count == 0:
+            return math.nan
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+        rank = q * (self.count - 1)
+        seen = 0
+        # Negative values, most negative (largest bucket) first
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return max(-self.bucket_value(index), self.min)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return min(self.bucket_value(index), self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        """Saves the sketch as a JSON serialisable dict."""
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "positive": {str(k): v for k, v in self.positive.items()},
+            "negative": {str(k): v for k, v in self.negative.items()},
+            "zero": self.zero,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "QuantileSketch":
+        """Loads a sketch saved by to_dict."""
+        sketch = cls(data["relative_accuracy"])
+        sketch.positive = {int(k): v for k, v in data["positive"].items()}
+        sketch.negative = {int(k): v for k, v in data["negative"].items()}
+        sketch.zero = data["zero"]
+        sketch.count = data["count"]
+        sketch.sum = data["sum"]
+        if sketch.count:
+            sketch.min = data["min"]
+            sketch.max = data["max"]
+        return sketch
+
+
+class Histogram:
+    """Counts values between fixed bin edges.
+
+    Parameters
+    ----------
+    edges : list
+        Increasing bin edges. Values below the first or at or above the last edge are counted separately.
+    """
+
+    def __init__(self, edges: list):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+        self.below = 0
+        self.above = 0
+
+    def update(self, values: np.ndarray):
+        """Adds values to the histogram. NaN values are ignored.
+
+        Parameters
+        ----------
+        values : np.ndarray
+            Values to add
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        bins = np.searchsorted(self.edges, values, side="right") - 1
+        self.below += int((bins < 0).sum())
+        self.above += int((bins >= len(self.counts)).sum())
+        inside = bins[(bins >= 0) & (bins < len(self.counts))]
+        self.counts += np.bincount(inside, minlength=len(self.counts))
+
+    def merge(self, other: "Histogram"):
+        """Adds every value counted by another histogram with the same edges.
+
+        Raises
+        ------
+        ValueError
+            If the histograms have different edges
+        """
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("Can't merge histograms with different edges")
+        self.counts += other.counts
+        self.below += other.below
+        self.above += other.above
+
+    def to_dict(self) -> dict:
+        """Saves the histogram as a JSON serialisable dict."""
+        return {
+            "edges": self.edges.tolist(),
+            "counts": self.counts.tolist(),
+            "below": self.below,
+            "above": self.above,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Histogram":
+        """Loads a histogram saved by to_dict."""
+        histogram = cls(data["edges"])
+        histogram.counts = np.asarray(data["counts"], dtype=np.int64)
+        histogram.below = data["below"]
+        histogram.above = data["above"]
+        return histogram
+
+
+def leading_zeros(values: np.ndarray, bits: int) -> np.ndarray:
+    """Counts the leading zeros of the lowest bits of unsigned 64 bit integers.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        uint64 values, each less than 2 ** bits
+    bits : int
+        Width of the values
+
+    Returns
+    -------
+    np.ndarray
+        Leading zeros of each value, as a bits wide integer
+    """
+    values = values.copy()
+    length = np.zeros(len(values), dtype=np.int64)
+    for shift in [32, 16, 8, 4, 2, 1]:
+        high = values >= (np.uint64(1) << np.uint64(shift))
+        length[high] += shift
+        values[high] >>= np.uint64(shift)
+    length += (values > 0).astype(np.int64)
+    return bits - length
+
+
+class HyperLogLog:
+    """Estimates the number of distinct values in a stream.
+
+    Parameters
+    ----------
+    precision : int, optional
+        Number of hash bits used to pick a register, by default DEFAULT_HLL_PRECISION
+    """
+
+    def __init__(self, precision: int = DEFAULT_HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(2**precision, dtype=np.uint8)
+
+    def update(self, values):
+        """Adds values (e.g. a Series of ICAO24 addresses) to the sketch. Missing values are ignored.
+
+        Parameters
+        ----------
+        values : array-like
+            Values to add
+        """
+        values = pd.Series(values).dropna()
+        if len(values) == 0:
+            return
+        hashes = pd.util.hash_pandas_object(values, index=False).values
+        shift = np.uint64(64 - self.precision)
+        registers = (hashes >> shift).astype(np.int64)
+        rest = hashes & ((np.uint64(1) << shift) - np.uint64(1))
+        ranks = (leading_zeros(rest, 64 - self.precision) + 1).astype(np.uint8)
+        np.maximum.at(self.registers, registers, ranks)
+
+    def merge(self, other: "HyperLogLog"):
+        """Adds every value counted by another sketch with the same precision.
+
+        Raises
+        ------
+        ValueError
+            If the sketches have different precisions
+        """
+        if other.precision != self.precision:
+            raise ValueError("Can't merge sketches with different precisions")
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self) -> float:
+        """Estimates the number of distinct values added.
+
+        Returns
+        -------
+        float
+            Estimated count, using linear counting while many registers are still empty
+        """
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m**2 / np.sum(2.0 ** -self.registers.astype(np.float64))
+        empty = int((self.registers == 0).sum())
+        if estimate <= 2.5 * m and empty > 0:
+            return m * math.log(m / empty)
+        return float(estimate)
+
+    def to_dict(self) -> dict:
+        """Saves the sketch as a JSON serialisable dict."""
+        return {
+            "precision": self.precision,
+            "registers": base64.b64encode(self.registers.tobytes()).decode("ascii"),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "HyperLogLog":
+        """Loads a sketch saved by to_dict."""
+        sketch = cls(data["precision"])
+        sketch.registers = np.frombuffer(
+            base64.b64decode(data["registers"]), dtype=np.uint8
+        ).copy()
+        return sketch
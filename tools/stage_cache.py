@@ -0,0 +1,328 @@
+"""
+stage_cache.py
+
+An on-disk cache of intermediate pipeline results, so re-running the extraction pipeline with different thresholds only repeats the stages whose parameters changed.
+
+Each stage's output is stored as a HDF file, under a key hashed from the input file's fingerprint, the stage's parameters and the key of the stage before it - so a key is only reused when the input and every upstream parameter match. The cache is capped in size, evicting the least recently used results first.
+
+Run this file directly to show what is in a cache, shrink it or clear it.
+"""
+
+import os
+import json
+import hashlib
+import argparse
+import warnings
+from pathlib import Path
+from collections import namedtuple
+
+import pandas as pd
+
+# Bump when a stage's behaviour changes, so old cached results are not reused
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_MAX_SIZE_MB = 10240
+
+# Bytes hashed from each end of an input file when fingerprinting it
+FINGERPRINT_BLOCK_SIZE = 1024 * 1024
+
+CACHE_SUFFIX = ".h5"
+
+# A pipeline stage - params are part of its cache key, options (e.g. worker
+# counts) change how it runs but not its output, so are left out of the key.
+# Stages whose output is no cheaper to load than to rebuild (e.g. reading the
+# input file) aren't cacheable, but still feed their params into later keys.
+Stage = namedtuple(
+    "Stage", ["function", "params", "options", "cacheable"], defaults=[True]
+)
+
+
+def json_default(obj: object):
+    """Serialises values json can't handle natively when building cache keys.
+
+    Parameters
+    ----------
+    obj : object
+        Value to serialise
+
+    Returns
+    -------
+    object
+        A JSON serialisable equivalent
+    """
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    return str(obj)
+
+
+def file_fingerprint(path: Path) -> str:
+    """Fingerprints an input file from its size, modification time and the contents of its first and last blocks.
+
+    This avoids hashing whole (multi-GB) inputs, while still catching files which are replaced or appended to.
+
+    Parameters
+    ----------
+    path : Path
+        Path to the input file
+
+    Returns
+    -------
+    str
+        Hex digest fingerprint
+    """
+    stat = os.stat(path)
+    digest = hashlib.sha256()
+    digest.update("{}:{}".format(stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+    with open(path, "rb") as f:
+        digest.update(f.read(FINGERPRINT_BLOCK_SIZE))
+        if stat.st_size > FINGERPRINT_BLOCK_SIZE:
+            f.seek(max(FINGERPRINT_BLOCK_SIZE, stat.st_size - FINGERPRINT_BLOCK_SIZE))
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def stage_keys(fingerprint: str, stages: list) -> list:
+    """Builds the cache key of each stage's output.
+
+    Each key covers the stage's name and parameters, and the key of the stage before it, so changing a parameter invalidates that stage and everything downstream of it.
+
+    Parameters
+    ----------
+    fingerprint : str
+        Input file fingerprint, as from file_fingerprint
+    stages : list
+        Stages, in the order they run
+
+    Returns
+    -------
+    list
+        A hex digest key for each stage
+    """
+    keys = []
+    parent = "{}:{}".format(CACHE_VERSION, fingerprint)
+    for stage in stages:
+        description = json.dumps(
+            [parent, stage.function.__name__, stage.params],
+            sort_keys=True,
+            default=json_default,
+        )
+        parent = hashlib.sha256(description.encode("utf-8")).hexdigest()
+        keys.append(parent)
+    return keys
+
+
+class StageCache:
+    """A size capped, least recently used cache of DataFrames on disk.
+
+    Parameters
+    ----------
+    cache_path : Path
+        Directory to store cached results in
+    max_bytes : int, optional
+        Size the cache is shrunk to by evict, by default DEFAULT_CACHE_MAX_SIZE_MB
+    """
+
+    def __init__(
+        self, cache_path: Path, max_bytes: int = DEFAULT_CACHE_MAX_SIZE_MB * 1024**2
+    ):
+        self.cache_path = Path(cache_path)
+        self.max_bytes = max_bytes
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key: str) -> Path:
+        """Path of the file holding a key's result."""
+        return self.cache_path / (key + CACHE_SUFFIX)
+
+    def contains(self, key: str) -> bool:
+        """Checks whether a key has a cached result."""
+        return self.path(key).exists()
+
+    def load(self, key: str) -> pd.DataFrame:
+        """Loads a cached result, marking it as recently used.
+
+        Parameters
+        ----------
+        key : str
+            Cache key
+
+        Returns
+        -------
+        pd.DataFrame
+            The cached DataFrame, or None if the key isn't cached (or its file can't be read)
+        """
+        path = self.path(key)
+        try:
+            output_df = pd.read_hdf(path, key="df")
+        except (OSError, KeyError, ValueError):
+            return None
+        # File modification times double as the LRU order
+        os.utime(path)
+        return output_df
+
+    def store(self, key: str, input_df: pd.DataFrame):
+        """Caches a DataFrame under a key.
+
+        The file is written under a temporary name and then renamed, so an interrupted run never leaves a partial result behind.
+
+        Parameters
+        ----------
+        key : str
+            Cache key
+        input_df : pd.DataFrame
+            DataFrame to cache
+        """
+        path = self.path(key)
+        tmp_path = path.with_suffix(".tmp")
+        with warnings.catch_warnings():
+            # Object columns are pickled by the fixed format, which is fine here
+            warnings.simplefilter("ignore", pd.errors.PerformanceWarning)
+            input_df.to_hdf(tmp_path, key="df", mode="w")
+        os.replace(tmp_path, path)
+
+    def entries(self) -> list:
+        """Lists cached results, least recently used first.
+
+        Returns
+        -------
+        list
+            (path, size in bytes, last used time) for each result
+        """
+        entries = []
+        for path in self.cache_path.glob("*" + CACHE_SUFFIX):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda x: x[2])
+
+    def size(self) -> int:
+        """Total size of the cache, in bytes."""
+        return sum(i[1] for i in self.entries())
+
+    def evict(self, max_bytes: int = None) -> int:
+        """Removes the least recently used results until the cache fits within max_bytes.
+
+        Parameters
+        ----------
+        max_bytes : int, optional
+            Size to shrink the cache to, by default the cache's max_bytes
+
+        Returns
+        -------
+        int
+            Number of results removed
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = self.entries()
+        total = sum(i[1] for i in entries)
+        removed = 0
+        for path, size, _ in entries:
+            if total <= max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self) -> int:
+        """Removes every cached result, and any temporary files left by interrupted writes.
+
+        Returns
+        -------
+        int
+            Number of results removed
+        """
+        for path in self.cache_path.glob("*.tmp"):
+            path.unlink()
+        return self.evict(0)
+
+
+def run_cached_stages(
+    input_data, stages: list, keys: list, cache: StageCache = None, metrics=None
+) -> pd.DataFrame:
+    """Runs a chain of stages, resuming from the deepest one with a cached result.
+
+    Stops early if a stage leaves no rows, as later stages expect data to work on. Stages which aren't cacheable are always rerun if needed, and their results never stored.
+
+    Parameters
+    ----------
+    input_data : object
+        Input to the first stage, e.g. the path of the file being processed
+    stages : list
+        Stages, in the order they run. Each takes the previous stage's output as its first argument, and all but the first take and return a DataFrame.
+    keys : list
+        Cache key of each stage, as from stage_keys
+    cache : StageCache, optional
+        Cache to resume from and store results in, by default None (run every stage)
+    metrics : Metrics, optional
+        Counts stages loaded from and missing from the cache, by default None
+
+    Returns
+    -------
+    pd.DataFrame
+        The output of the last stage run
+    """
+    output_df = input_data
+    start = 0
+    if cache is not None:
+        for i in reversed(range(len(stages))):
+            if not stages[i].cacheable:
+                continue
+            cached_df = cache.load(keys[i]) if cache.contains(keys[i]) else None
+            if cached_df is not None:
+                output_df = cached_df
+                start = i + 1
+                break
+
+    for i, stage in enumerate(stages):
+        if metrics is not None:
+            result = "hits" if i < start else "misses"
+            metrics.inc("cache_{}_total".format(result), stage=stage.function.__name__)
+        if i < start:
+            continue
+        if i > 0 and len(output_df) == 0:
+            break
+        output_df = stage.function(output_df, **stage.params, **stage.options)
+        if cache is not None and stage.cacheable:
+            cache.store(keys[i], output_df)
+
+    return output_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Show, shrink or clear a pipeline stage cache",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "cache_path", type=str, help="Cache directory, as passed to --cache_path."
+    )
+    parser.add_argument(
+        "--max_size",
+        type=float,
+        help="Evict least recently used results until the cache is at most this many MB.",
+        default=None,
+    )
+    parser.add_argument(
+        "--clear", action="store_true", help="Remove every cached result."
+    )
+    args = parser.parse_args()
+
+    cache = StageCache(args.cache_path)
+    if args.clear:
+        print("Removed {} cached results".format(cache.clear()))
+    elif args.max_size is not None:
+        removed = cache.evict(int(args.max_size * 1024**2))
+        print("Removed {} cached results".format(removed))
+
+    entries = cache.entries()
+    print(
+        "{} cached results, {:.1f}MB".format(
+            len(entries), sum(i[1] for i in entries) / 1024**2
+        )
+    )
@@ -0,0 +1,339 @@
+"""
+stage_profiler.py
+
+Profiles each stage of the extraction pipeline on each input file, for opensky_extraction_pipeline.py --profile. Only imported when profiling is asked for.
+
+Two profilers are available:
+
+- deterministic uses cProfile, timing every function call. It has a high overhead on the many small calls made by groupby-applies, so inflates their share, but misses nothing.
+- sampling records the call stack every --profile_interval seconds of CPU time, from a SIGPROF timer (so Unix only). Its overhead is low, but functions taking less than a few intervals may not show up.
+
+Either way, the results are written as collapsed stacks ('frame;frame;frame count' lines, with counts in microseconds) which flamegraph.pl, speedscope and inferno can draw as flame graphs, with each stack rooted at the stage it ran in. A plain text summary of the functions taking the most time in each stage is written alongside.
+"""
+
+import sys
+import time
+import pstats
+import signal
+import cProfile
+import functools
+from pathlib import Path
+from collections import Counter, defaultdict
+
+DEFAULT_SAMPLE_INTERVAL = 0.001
+DEFAULT_TOP = 20
+
+# Call graph paths taking less than this share of a stage's time are cut short
+# in deterministic collapsed stacks, which would otherwise grow exponentially
+MIN_STACK_SHARE = 1e-4
+
+COLLAPSED_SUFFIX = ".collapsed"
+ALL_STACKS_FILENAME = "all_files" + COLLAPSED_SUFFIX
+HOTSPOTS_FILENAME = "hotspots.txt"
+
+
+def frame_label(filename: str, line: int, name: str) -> str:
+    """Labels a function in a collapsed stack, e.g. 'sequence_imputer (opensky_extraction_pipeline.py:212)'.
+
+    Parameters
+    ----------
+    filename : str
+        File the function is defined in, or '~' for builtins (as in cProfile)
+    line : int
+        Line the function starts on
+    name : str
+        Function name
+
+    Returns
+    -------
+    str
+        Label, without the ';' collapsed stacks use as a separator
+    """
+    if filename == "~":
+        label = name
+    else:
+        label = "{} ({}:{})".format(name, Path(filename).name, line)
+    return label.replace(";", ",")
+
+
+def collapse_profile(stats: dict) -> Counter:
+    """Turns cProfile's call graph into collapsed stacks.
+
+    cProfile only records the time spent in each function from each of its callers, not whole stacks, so a function's time is split between the stacks it was reached by in proportion to the time each caller spent in it. Recursive calls are folded into the outermost call, and calls on paths taking under MIN_STACK_SHARE of the total are counted as their caller's own time.
+
+    Parameters
+    ----------
+    stats : dict
+        Stats, as from pstats.Stats(profile).stats
+
+    Returns
+    -------
+    Counter
+        Tuple of frame labels, outermost first -> seconds spent in the innermost frame itself
+    """
+    children = defaultdict(dict)
+    for function, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            children[caller][function] = edge
+    roots = [
+        function
+        for function, (_, _, _, _, callers) in stats.items()
+        if not any(caller in stats for caller in callers)
+    ]
+    min_seconds = sum(stats[i][3] for i in roots) * MIN_STACK_SHARE
+
+    stacks = Counter()
+    # Explicit stack rather than recursion, as pandas' call graphs run deep
+    pending = [(root, (), stats[root][3]) for root in roots]
+    while pending:
+        function, stack, seconds = pending.pop()
+        _, _, own, inclusive, _ = stats[function]
+        share = seconds / inclusive if inclusive > 0 else 0.0
+        stack = stack + (function,)
+        for child, (_, _, _, child_inclusive) in children[function].items():
+            if child in stack:
+                continue
+            if child_inclusive * share >= min_seconds:
+                pending.append((child, stack, child_inclusive * share))
+            else:
+                # Counted as the caller's own time, so stage totals still add up
+                own += child_inclusive
+        stacks[tuple(frame_label(*i) for i in stack)] += own * share
+    return stacks
+
+
+class SamplingProfiler:
+    """Records the call stack below the stage being profiled at a fixed interval of CPU time.
+
+    Parameters
+    ----------
+    interval : float
+        Seconds of CPU time between samples
+    """
+
+    def __init__(self, interval: float):
+        if not hasattr(signal, "setitimer"):
+            raise ValueError("Sampling profiling needs SIGPROF, which isn't available")
+        self.interval = interval
+        self.stacks = Counter()
+        self.root = None
+        self.previous_handler = None
+        self.last_sample = 0.0
+
+    def sample(self, signum, frame):
+        """SIGPROF handler, counting the stack the signal interrupted."""
+        # Timers are only as fine as the kernel's clock tick, and signals
+        # arriving together are merged, so weight by the CPU time actually used
+        now = time.process_time()
+        seconds = now - self.last_sample
+        self.last_sample = now
+        stack = []
+        while frame is not None and frame.f_code is not self.root:
+            code = frame.f_code
+            stack.append(
+                frame_label(code.co_filename, code.co_firstlineno, code.co_name)
+            )
+            frame = frame.f_back
+        # Samples from outside the stage (e.g. just before the timer stops)
+        if frame is not None:
+            self.stacks[tuple(reversed(stack))] += seconds
+
+    def run(self, function, *args, **kwargs) -> tuple:
+        """Calls a function, sampling its stack.
+
+        Returns
+        -------
+        tuple
+            The function's result, a Counter of sampled stacks -> seconds of CPU time, and the wall clock seconds it took
+        """
+        self.stacks = Counter()
+        self.root = sys._getframe().f_code
+        self.previous_handler = signal.signal(signal.SIGPROF, self.sample)
+        self.last_sample = time.process_time()
+        start = time.perf_counter()
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self.previous_handler)
+        return result, self.stacks, time.perf_counter() - start
+
+
+class DeterministicProfiler:
+    """Times every function call made by the stage being profiled, with cProfile."""
+
+    def run(self, function, *args, **kwargs) -> tuple:
+        """Calls a function under cProfile.
+
+        Returns
+        -------
+        tuple
+            The function's result, a Counter of collapsed stacks -> seconds, and the wall clock seconds it took
+        """
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            profile.disable()
+        seconds = time.perf_counter() - start
+        stats = pstats.Stats(profile).stats
+        # Drop the call which stopped the profiler
+        stats = {i: j for i, j in stats.items() if "_lsprof.Profiler" not in i[2]}
+        return result, collapse_profile(stats), seconds
+
+
+class StageProfiler:
+    """Profiles pipeline stages separately for each input file, and writes out the results.
+
+    Parameters
+    ----------
+    profile_path : Path
+        Directory to write collapsed stacks and the hotspot summary to
+    mode : str, optional
+        'deterministic' or 'sampling', by default 'deterministic'
+    interval : float, optional
+        Seconds of CPU time between samples, for sampling, by default DEFAULT_SAMPLE_INTERVAL
+    top : int, optional
+        Number of functions listed for each stage in the hotspot summary, by default DEFAULT_TOP
+    """
+
+    def __init__(
+        self,
+        profile_path: Path,
+        mode: str = "deterministic",
+        interval: float = DEFAULT_SAMPLE_INTERVAL,
+        top: int = DEFAULT_TOP,
+    ):
+        self.profile_path = Path(profile_path)
+        self.mode = mode
+        self.top = top
+        if mode == "sampling":
+            self.profiler = SamplingProfiler(interval)
+        else:
+            self.profiler = DeterministicProfiler()
+        # Input file name -> stage -> Counter of stacks -> seconds
+        self.stacks = defaultdict(lambda: defaultdict(Counter))
+        # Input file name -> stage -> wall clock seconds
+        self.wall_seconds = defaultdict(Counter)
+
+    def wrap(self, stage, input_name: str):
+        """Wraps a stage so each call is profiled under the input file's name.
+
+        Parameters
+        ----------
+        stage : function
+            Stage to profile, recorded under its __name__
+        input_name : str
+            Name of the input file being processed
+
+        Returns
+        -------
+        function
+            The wrapped stage, with the same name (so stage cache keys are unchanged)
+        """
+
+        @functools.wraps(stage)
+        def wrapper(*args, **kwargs):
+            result, stacks, seconds = self.profiler.run(stage, *args, **kwargs)
+            self.wall_seconds[input_name][stage.__name__] += seconds
+            self.stacks[input_name][stage.__name__].update(stacks)
+            return result
+
+        return wrapper
+
+    def write_collapsed(self, path: Path, stacks: Counter):
+        """Writes stacks in the collapsed format, with counts in microseconds."""
+        with open(path, "w") as f:
+            for stack, seconds in sorted(stacks.items()):
+                microseconds = int(round(seconds * 1e6))
+                if microseconds > 0:
+                    f.write("{} {}\n".format(";".join(stack), microseconds))
+
+    def hotspots(self, stacks: Counter) -> list:
+        """Finds the functions taking the most time.
+
+        Parameters
+        ----------
+        stacks : Counter
+            Stacks (not rooted at a stage) -> seconds
+
+        Returns
+        -------
+        list
+            (function, self seconds, total seconds) for the top functions by self time
+        """
+        own = Counter()
+        total = Counter()
+        for stack, seconds in stacks.items():
+            if not stack:
+                continue
+            own[stack[-1]] += seconds
+            for label in set(stack):
+                total[label] += seconds
+        return [(i, j, total[i]) for i, j in own.most_common(self.top)]
+
+    def summary(self) -> str:
+        """Builds the hotspot summary, covering every input file profiled so far.
+
+        Returns
+        -------
+        str
+            Time spent in each stage, the top functions in each, and each file's time by stage
+        """
+        stages = defaultdict(Counter)
+        wall_seconds = Counter()
+        for input_name, input_stacks in self.stacks.items():
+            for stage, stacks in input_stacks.items():
+                stages[stage].update(stacks)
+                wall_seconds[stage] += self.wall_seconds[input_name][stage]
+
+        lines = [
+            "{} profile of {} input files".format(
+                self.mode.capitalize(), len(self.stacks)
+            ),
+            "",
+        ]
+        for stage, seconds in wall_seconds.most_common():
+            lines.append(
+                "{}: {:.3f} s wall clock, {:.3f} s profiled".format(
+                    stage, seconds, sum(stages[stage].values())
+                )
+            )
+            lines.append("{:>10} {:>10}  {}".format("self s", "total s", "function"))
+            for label, own, total in self.hotspots(stages[stage]):
+                lines.append("{:10.3f} {:10.3f}  {}".format(own, total, label))
+            lines.append("")
+
+        lines.append("Wall clock seconds by input file")
+        for input_name in sorted(self.wall_seconds):
+            lines.append(
+                "{:10.3f}  {}: {}".format(
+                    sum(self.wall_seconds[input_name].values()),
+                    input_name,
+                    ", ".join(
+                        "{} {:.3f}".format(i, j)
+                        for i, j in self.wall_seconds[input_name].most_common()
+                    ),
+                )
+            )
+        return "\n".join(lines) + "\n"
+
+    def save(self):
+        """Writes collapsed stacks for each input file and for them all together, and the hotspot summary."""
+        self.profile_path.mkdir(parents=True, exist_ok=True)
+        all_stacks = Counter()
+        for input_name, input_stacks in self.stacks.items():
+            stacks = Counter()
+            for stage, stage_stacks in input_stacks.items():
+                for stack, seconds in stage_stacks.items():
+                    stacks[(stage,) + stack] += seconds
+            self.write_collapsed(
+                self.profile_path / (input_name + COLLAPSED_SUFFIX), stacks
+            )
+            all_stacks.update(stacks)
+        self.write_collapsed(self.profile_path / ALL_STACKS_FILENAME, all_stacks)
+        with open(self.profile_path / HOTSPOTS_FILENAME, "w") as f:
+            f.write(self.summary())
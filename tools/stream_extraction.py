@@ -0,0 +1,611 @@
+"""
+stream_extraction.py
+
+An online version of opensky_extraction_pipeline.py, which extracts flights from a live feed of state vectors (a TCP socket, or a CSV file being appended to) as they complete, rather than after a whole file is processed.
+
+Reports are buffered per aircraft, and an aircraft's flight is closed once it has gone --split_threshold seconds of event time without a report. Closed flights go through the pipeline's labelling, region, imputation, altitude and invalid trajectory stages and are exported straight away.
+
+Event time is tracked by a watermark - the latest report time seen, less --allowed_lateness - so reports arriving slightly out of order still make it into their flight. Reports older than the watermark, for aircraft without an open flight, are dropped. While the feed is idle the watermark advances with the wall clock, so the last flights still close. If more than --max_open_flights aircraft have open flights, the ones which reported least recently are closed early, bounding memory.
+"""
+
+import io
+import time
+import socket
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from flight_files import has_manifest
+from flight_index import FlightIndex
+from flight_manifest import (
+    DEFAULT_MANIFEST_BATCH,
+    DEFAULT_MANIFEST_INTERVAL,
+    ManifestWriter,
+)
+from metrics import add_metrics_arguments, metrics_from_args
+from opensky_extraction_pipeline import (
+    STATE_VECTOR_COLUMNS,
+    STATE_VECTOR_DTYPES,
+    add_export_arguments,
+    add_filter_arguments,
+    add_threshold_arguments,
+    apply_row_filters,
+    basic_cleaning,
+    build_filters,
+    build_threshold_stages,
+    export_flights,
+    keep_flights_in_region,
+    label_points_into_flights,
+)
+from stage_cache import Stage, run_cached_stages
+
+DEFAULT_SPLIT_THRESHOLD = 60
+DEFAULT_ALLOWED_LATENESS = 10
+DEFAULT_MAX_OPEN_FLIGHTS = 20000
+DEFAULT_POLL_INTERVAL = 0.5
+
+# Bytes read from the feed at a time
+READ_SIZE = 4 * 1024 * 1024
+
+
+class TailSource:
+    """Reads lines as they are appended to a file, like tail -f.
+
+    Parameters
+    ----------
+    path : Path
+        File to read
+    follow : bool, optional
+        Wait for more lines at the end of the file, rather than stopping, by default True
+    poll_interval : float, optional
+        Seconds to wait before checking for more lines, by default DEFAULT_POLL_INTERVAL
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        follow: bool = True,
+        poll_interval: float = DEFAULT_POLL_INTERVAL,
+    ):
+        self.file = open(path, "rb")
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self.partial = b""
+        self.closed = False
+
+    def read_lines(self) -> list:
+        """Reads the complete lines available, waiting up to poll_interval if there are none.
+
+        Returns
+        -------
+        list
+            Lines read, without line endings
+        """
+        data = self.file.read(READ_SIZE)
+        if not data:
+            if not self.follow:
+                self.closed = True
+                self.file.close()
+                return split_lines(self.partial, b"")[0] if self.partial else []
+            time.sleep(self.poll_interval)
+            return []
+        lines, self.partial = split_lines(self.partial, data)
+        return lines
+
+
+class SocketSource:
+    """Reads lines from a TCP connection.
+
+    Parameters
+    ----------
+    host : str
+        Host to connect to
+    port : int
+        Port to connect to
+    poll_interval : float, optional
+        Seconds to wait for data before returning no lines, by default DEFAULT_POLL_INTERVAL
+    """
+
+    def __init__(
+        self, host: str, port: int, poll_interval: float = DEFAULT_POLL_INTERVAL
+    ):
+        self.socket = socket.create_connection((host, port))
+        self.socket.settimeout(poll_interval)
+        self.partial = b""
+        self.closed = False
+
+    def read_lines(self) -> list:
+        """Reads the complete lines available, waiting up to poll_interval if there are none.
+
+        Returns
+        -------
+        list
+            Lines read, without line endings
+        """
+        try:
+            data = self.socket.recv(READ_SIZE)
+        except socket.timeout:
+            return []
+        if not data:
+            self.closed = True
+            self.socket.close()
+            return split_lines(self.partial, b"")[0] if self.partial else []
+        lines, self.partial = split_lines(self.partial, data)
+        return lines
+
+
+def split_lines(partial: bytes, data: bytes) -> tuple:
+    """Splits newly read data into complete lines, keeping any incomplete last line.
+
+    Parameters
+    ----------
+    partial : bytes
+        Incomplete line left from the last read
+    data : bytes
+        Newly read data, or b"" to complete the partial line at the end of the feed
+
+    Returns
+    -------
+    tuple
+        Complete lines (as str), and the new incomplete line
+    """
+    lines = (partial + data).split(b"\n")
+    partial = lines.pop() if data else b""
+    return [i.decode("utf-8", errors="replace").rstrip("\r") for i in lines], partial
+
+
+def open_source(source: str, follow: bool, poll_interval: float):
+    """Opens a feed from its description.
+
+    Parameters
+    ----------
+    source : str
+        tcp://HOST:PORT, or the path of a CSV file
+    follow : bool
+        For files, wait for more lines at the end of the file
+    poll_interval : float
+        Seconds to wait for more data at a time
+
+    Returns
+    -------
+    TailSource or SocketSource
+        The opened feed
+    """
+    if source.startswith("tcp://"):
+        host, port = source[len("tcp://") :].rsplit(":", 1)
+        return SocketSource(host, int(port), poll_interval)
+    return TailSource(source, follow, poll_interval)
+
+
+class ReportParser:
+    """Parses lines of OpenSky state vector CSV into position reports.
+
+    Lines are expected in STATE_VECTOR_COLUMNS order, unless the feed sends a header line (starting with 'time,'), in which case its column order is used from then on.
+
+    Parameters
+    ----------
+    filters : dict, optional
+        Row filters (time window, ICAO allowlist) to apply, by default None
+    """
+
+    def __init__(self, filters: dict = None):
+        self.columns = STATE_VECTOR_COLUMNS
+        self.filters = filters
+
+    def parse(self, lines: list) -> pd.DataFrame:
+        """Parses lines, dropping any which are malformed or missing a time or ICAO24.
+
+        Parameters
+        ----------
+        lines : list
+            Lines read from the feed
+
+        Returns
+        -------
+        pd.DataFrame
+            Position reports
+        """
+        rows = []
+        for line in lines:
+            if line.startswith("time,"):
+                self.columns = line.split(",")
+            elif line.strip():
+                rows.append(line)
+        if len(rows) == 0:
+            return pd.DataFrame(columns=STATE_VECTOR_COLUMNS)
+
+        input_df = pd.read_csv(
+            io.StringIO("\n".join(rows)),
+            names=self.columns,
+            usecols=lambda c: c in STATE_VECTOR_COLUMNS,
+            dtype=STATE_VECTOR_DTYPES,
+            on_bad_lines="skip",
+        )
+        for column in input_df.columns:
+            if column not in STATE_VECTOR_DTYPES and input_df[column].dtype == object:
+                input_df[column] = pd.to_numeric(input_df[column], errors="coerce")
+        input_df = input_df[input_df["time"].notna() & input_df["icao24"].notna()]
+        return apply_row_filters(input_df, self.filters)
+
+
+class OpenFlight:
+    """Reports buffered for an aircraft whose flight hasn't closed yet.
+
+    Reports are kept as chunks of column arrays, one per batch they arrived in. Each chunk is copied out of its batch, so a long flight doesn't keep whole batches (and the reports of flights already closed) in memory.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.rows = 0
+        self.last_time = -np.inf
+        self.last_arrival = None
+
+
+class FlightStream:
+    """Buffers reports per aircraft, closing flights once they go quiet.
+
+    Parameters
+    ----------
+    split_threshold : float, optional
+        Seconds of event time without a report after which a flight closes, by default DEFAULT_SPLIT_THRESHOLD
+    allowed_lateness : float, optional
+        Seconds behind the latest report time a report can arrive and still be used, by default DEFAULT_ALLOWED_LATENESS
+    max_open_flights : int, optional
+        Most flights held open at once, by default DEFAULT_MAX_OPEN_FLIGHTS
+    metrics : Metrics, optional
+        Records reports received and dropped, and flights closed and evicted, by default None
+    """
+
+    def __init__(
+        self,
+        split_threshold: float = DEFAULT_SPLIT_THRESHOLD,
+        allowed_lateness: float = DEFAULT_ALLOWED_LATENESS,
+        max_open_flights: int = DEFAULT_MAX_OPEN_FLIGHTS,
+        metrics=None,
+    ):
+        self.split_threshold = split_threshold
+        self.allowed_lateness = allowed_lateness
+        self.max_open_flights = max_open_flights
+        self.metrics = metrics
+        self.flights = {}
+        self.event_time = None
+        self.last_arrival = None
+
+    def watermark(self, now: float) -> float:
+        """Event time before which reports are treated as late.
+
+        Parameters
+        ----------
+        now : float
+            Current wall clock time
+
+        Returns
+        -------
+        float
+            The latest report time, plus the wall clock time since it arrived, less the allowed lateness
+        """
+        if self.event_time is None:
+            return -np.inf
+        return self.event_time + (now - self.last_arrival) - self.allowed_lateness
+
+    def add(self, input_df: pd.DataFrame, now: float):
+        """Adds newly received reports to their aircraft's open flights.
+
+        Parameters
+        ----------
+        input_df : pd.DataFrame
+            Position reports
+        now : float
+            Wall clock time they arrived
+        """
+        if input_df.shape[0] == 0:
+            return
+        times = input_df["time"].values.astype(np.float64)
+        late = (times < self.watermark(now)) & ~input_df["icao24"].isin(
+            self.flights
+        ).values
+        if self.metrics is not None:
+            self.metrics.inc("reports_received_total", input_df.shape[0])
+            self.metrics.inc("reports_late_total", int(late.sum()))
+        input_df = input_df[~late].sort_values("icao24", kind="mergesort")
+        if input_df.shape[0] == 0:
+            return
+
+        columns = {i: input_df[i].values for i in input_df.columns}
+        icao = columns["icao24"]
+        times = columns["time"].astype(np.float64)
+        starts = np.r_[0, np.flatnonzero(icao[1:] != icao[:-1]) + 1]
+        stops = np.r_[starts[1:], len(icao)]
+        last_times = np.maximum.reduceat(times, starts)
+        for start, stop, last_time in zip(starts, stops, last_times):
+            flight = self.flights.get(icao[start])
+            if flight is None:
+                flight = self.flights[icao[start]] = OpenFlight()
+            flight.chunks.append({i: j[start:stop].copy() for i, j in columns.items()})
+            flight.rows += stop - start
+            flight.last_time = max(flight.last_time, last_time)
+            flight.last_arrival = now
+
+        self.event_time = max(self.event_time or -np.inf, float(times.max()))
+        self.last_arrival = now
+
+    def close_flights(self, now: float, flush: bool = False) -> tuple:
+        """Closes the flights which have gone quiet, and any evicted to stay within max_open_flights.
+
+        Parameters
+        ----------
+        now : float
+            Current wall clock time
+        flush : bool, optional
+            Close every open flight, e.g. at the end of the feed, by default False
+
+        Returns
+        -------
+        tuple
+            Position reports of the closed flights, and the wall clock time each closed flight's last report arrived
+        """
+        if flush:
+            closing = list(self.flights)
+        else:
+            cutoff = self.watermark(now) - self.split_threshold
+            closing = [i for i, j in self.flights.items() if j.last_time < cutoff]
+            excess = len(self.flights) - len(closing) - self.max_open_flights
+            if excess > 0:
+                closing_set = set(closing)
+                stale = sorted(
+                    (j.last_time, i)
+                    for i, j in self.flights.items()
+                    if i not in closing_set
+                )
+                closing += [i for _, i in stale[:excess]]
+                if self.metrics is not None:
+                    self.metrics.inc("flights_evicted_total", excess)
+
+        flights = [self.flights.pop(i) for i in closing]
+        if self.metrics is not None:
+            self.metrics.inc("flights_closed_total", len(flights))
+            self.metrics.set("open_flights", len(self.flights))
+            self.metrics.set(
+                "open_flight_reports", sum(i.rows for i in self.flights.values())
+            )
+        if len(flights) == 0:
+            return pd.DataFrame(columns=STATE_VECTOR_COLUMNS), []
+
+        chunks = [chunk for flight in flights for chunk in flight.chunks]
+        output_df = pd.DataFrame(
+            {
+                column: np.concatenate([i[column] for i in chunks])
+                for column in chunks[0]
+            }
+        )
+        return output_df, [i.last_arrival for i in flights]
+
+
+def build_stream_stages(args: argparse.Namespace, metrics) -> list:
+    """Builds the stages closed flights are run through - those of the batch pipeline, after reading.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Parsed command line arguments
+    metrics : Metrics
+        Records stage latencies and row counts
+
+    Returns
+    -------
+    list
+        Stages, for run_cached_stages
+    """
+    filters = build_filters(
+        time_window=args.time_window,
+        icaos=args.icao_list,
+        bbox=args.bbox,
+        radius=args.radius_around,
+    )
+    return [
+        Stage(metrics.timed_stage(basic_cleaning), {}, {}),
+        Stage(
+            metrics.timed_stage(label_points_into_flights),
+            {"split_threshold": args.split_threshold},
+            {},
+        ),
+        Stage(metrics.timed_stage(keep_flights_in_region), {"filters": filters}, {}),
+    ] + build_threshold_stages(args, metrics)
+
+
+def export_closed_flights(
+    input_df: pd.DataFrame,
+    arrivals: list,
+    stages: list,
+    output_path: Path,
+    args: argparse.Namespace,
+    metrics,
+    index: FlightIndex = None,
+    manifest: ManifestWriter = None,
+) -> list:
+    """Runs closed flights through the pipeline stages and exports those which pass.
+
+    Parameters
+    ----------
+    input_df : pd.DataFrame
+        Position reports of the closed flights
+    arrivals : list
+        Wall clock time each closed flight's last report arrived
+    stages : list
+        Stages, as from build_stream_stages
+    output_path : Path
+        Directory to export JSON files to
+    args : argparse.Namespace
+        Parsed command line arguments
+    metrics : Metrics
+        Records flights exported and their latency
+    index : FlightIndex, optional
+        Index of flights already exported, to skip duplicates, by default None
+    manifest : ManifestWriter, optional
+        Writer to queue exported flights with for the manifest, by default None (no manifest)
+
+    Returns
+    -------
+    list
+        Paths of the exported files, relative to output_path
+    """
+    output_df = run_cached_stages(input_df, stages, [None] * len(stages))
+    exported = []
+    if output_df.shape[0] > 0:
+        exported = list(
+            output_df.pipe(
+                metrics.timed_stage(export_flights),
+                output_path=output_path,
+                compression=args.compression,
+                level=args.compression_level,
+                layout=args.layout,
+                index=index,
+                dedup_action=args.dedup_action,
+            )
+        )
+        if index is not None:
+            flights = output_df.groupby(["icao24", "flight_label"]).ngroups
+            metrics.inc("flights_duplicate_total", flights - len(exported))
+        if manifest is not None:
+            manifest.add(exported)
+    metrics.inc("flights_exported_total", len(exported))
+
+    now = time.time()
+    for arrival in arrivals:
+        metrics.observe("flight_latency_seconds", now - arrival)
+    return exported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Extracts flights from a live OpenSky state vector feed as they complete, exporting each as JSON, as opensky_extraction_pipeline.py does for whole files.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "source",
+        type=str,
+        help="tcp://HOST:PORT to read CSV lines from a socket, or a CSV file to follow as it is appended to.",
+    )
+    parser.add_argument(
+        "output_path", type=str, help="Directory to save exported JSON files to."
+    )
+    parser.add_argument(
+        "--split_threshold",
+        type=float,
+        help="Seconds (of event time) without a report after which an aircraft's flight is closed and exported.",
+        default=DEFAULT_SPLIT_THRESHOLD,
+    )
+    parser.add_argument(
+        "--allowed_lateness",
+        type=float,
+        help="Seconds behind the latest report a report can arrive and still be added to its flight.",
+        default=DEFAULT_ALLOWED_LATENESS,
+    )
+    parser.add_argument(
+        "--max_open_flights",
+        type=int,
+        help="Most flights buffered at once. Beyond this, the flights which reported least recently are closed early.",
+        default=DEFAULT_MAX_OPEN_FLIGHTS,
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=float,
+        help="Seconds to wait for new data at a time.",
+        default=DEFAULT_POLL_INTERVAL,
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Stop at the end of a CSV file rather than waiting for more lines, e.g. to replay a recorded feed.",
+    )
+    parser.add_argument(
+        "--manifest_interval",
+        type=float,
+        help="Most seconds between manifest updates. Flights exported in between are written to the manifest together, and at exit.",
+        default=DEFAULT_MANIFEST_INTERVAL,
+    )
+    parser.add_argument(
+        "--manifest_batch",
+        type=int,
+        help="Number of newly exported flights which triggers a manifest update before --manifest_interval is up.",
+        default=DEFAULT_MANIFEST_BATCH,
+    )
+    add_filter_arguments(parser)
+    add_threshold_arguments(parser)
+    add_export_arguments(parser)
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    metrics = metrics_from_args(args)
+
+    output_path = Path(args.output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    source = open_source(args.source, not args.once, args.poll_interval)
+    report_parser = ReportParser(
+        build_filters(time_window=args.time_window, icaos=args.icao_list)
+    )
+    stream = FlightStream(
+        args.split_threshold, args.allowed_lateness, args.max_open_flights, metrics
+    )
+    stages = build_stream_stages(args, metrics)
+    index = None
+    if args.dedup_index is not None:
+        index = FlightIndex(args.dedup_index, args.dedup_similarity)
+    manifest = None
+    if args.layout == "sharded" or args.manifest or has_manifest(output_path):
+        manifest = ManifestWriter(
+            output_path, args.layout, args.manifest_interval, args.manifest_batch
+        )
+
+    exported = 0
+    try:
+        while not source.closed:
+            lines = source.read_lines()
+            now = time.time()
+            if lines:
+                stream.add(report_parser.parse(lines), now)
+            input_df, arrivals = stream.close_flights(now, flush=source.closed)
+            if arrivals:
+                paths = export_closed_flights(
+                    input_df,
+                    arrivals,
+                    stages,
+                    output_path,
+                    args,
+                    metrics,
+                    index,
+                    manifest,
+                )
+                exported += len(paths)
+                print(
+                    "Closed {} flights, exported {} ({} still open)".format(
+                        len(arrivals), len(paths), len(stream.flights)
+                    )
+                )
+    except KeyboardInterrupt:
+        input_df, arrivals = stream.close_flights(time.time(), flush=True)
+        if arrivals:
+            exported += len(
+                export_closed_flights(
+                    input_df,
+                    arrivals,
+                    stages,
+                    output_path,
+                    args,
+                    metrics,
+                    index,
+                    manifest,
+                )
+            )
+    finally:
+        # Flights already written are listed, whatever stopped the stream
+        if manifest is not None:
+            manifest.flush()
+
+    print("Exported {} flights to {}".format(exported, output_path))
+    if index is not None:
+        index.close()
+    metrics.close()
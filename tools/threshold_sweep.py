@@ -0,0 +1,416 @@
+"""
+threshold_sweep.py
+
+A tool to compare many opensky_extraction_pipeline.py threshold configurations (--impute_tolerance, the altitude bounds and the invalid trajectory thresholds) in a single pass over the data.
+
+Each flight is imputed and smoothed once, and reduced to the statistics the thresholds are tested against - the share of altitudes present, its altitude range, and its largest climb and descent between points after spike smoothing. Every configuration is then checked against these statistics at once, so a grid of hundreds of configurations costs about the same as one pipeline run. Spike smoothing depends on the climb/descent thresholds, so flights are smoothed once per distinct pair of them.
+"""
+
+import argparse
+import itertools
+import traceback
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from metrics import add_metrics_arguments, metrics_from_args
+from opensky_extraction_pipeline import (
+    DEFAULT_ALTITUDE_MAX,
+    DEFAULT_ALTITUDE_MIN,
+    DEFAULT_IMPUTE_TOLERANCE,
+    DEFAULT_INVALID_MAX_THRESHOLD,
+    DEFAULT_INVALID_MIN_THRESHOLD,
+    DEFAULT_INVALID_TOLERANCE,
+    add_input_arguments,
+    build_preprocessing_stages,
+    export_flights,
+    invalid_trajectory_checker,
+    run_stages,
+    sequence_imputer,
+    spike_smoother,
+)
+from stage_cache import StageCache
+
+THRESHOLD_COLUMNS = [
+    "impute_tolerance",
+    "altitude_min",
+    "altitude_max",
+    "invalid_min_threshold",
+    "invalid_max_threshold",
+    "invalid_tolerance",
+]
+SMOOTHING_COLUMNS = ["invalid_min_threshold", "invalid_max_threshold"]
+
+# Outcome of a flight under a configuration, in the order the pipeline checks them
+KEPT = 0
+REJECTED_IMPUTATION = 1
+REJECTED_ALTITUDE = 2
+REJECTED_INVALID = 3
+REJECTION_NAMES = {
+    REJECTED_IMPUTATION: "rejected_imputation",
+    REJECTED_ALTITUDE: "rejected_altitude",
+    REJECTED_INVALID: "rejected_invalid",
+}
+
+
+def configuration_grid(**values) -> pd.DataFrame:
+    """Builds every combination of threshold values.
+
+    Parameters
+    ----------
+    **values : list
+        Candidate values for each of THRESHOLD_COLUMNS
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per configuration
+    """
+    return pd.DataFrame(
+        list(itertools.product(*[values[i] for i in THRESHOLD_COLUMNS])),
+        columns=THRESHOLD_COLUMNS,
+    )
+
+
+def smoothing_pairs(configs: pd.DataFrame) -> tuple:
+    """Finds the distinct (descent, climb) threshold pairs flights need smoothing with.
+
+    Parameters
+    ----------
+    configs : pd.DataFrame
+        Configurations, as from configuration_grid
+
+    Returns
+    -------
+    tuple
+        List of (invalid_min_threshold, invalid_max_threshold) pairs, and the index of each configuration's pair
+    """
+    pairs = list(
+        dict.fromkeys(configs[SMOOTHING_COLUMNS].itertuples(index=False, name=None))
+    )
+    pair_index = [
+        pairs.index(i)
+        for i in configs[SMOOTHING_COLUMNS].itertuples(index=False, name=None)
+    ]
+    return pairs, np.array(pair_index, dtype=int)
+
+
+def flight_statistics(
+    input_df: pd.DataFrame, pairs: list, keep_flights: bool = False
+) -> tuple:
+    """Imputes and smooths each flight, reducing it to the statistics the pipeline thresholds are tested against.
+
+    Parameters
+    ----------
+    input_df : pd.DataFrame
+        Labelled position reports, as output by build_preprocessing_stages
+    pairs : list
+        (invalid_min_threshold, invalid_max_threshold) pairs to smooth flights with
+    keep_flights : bool, optional
+        Whether to return the imputed flights as well, by default False
+
+    Returns
+    -------
+    tuple
+        A DataFrame with a row of statistics per flight, and a list of imputed flights (empty unless keep_flights is set)
+    """
+    rows = []
+    flights = []
+    for (icao24, flight_label), flight in input_df.groupby(["icao24", "flight_label"]):
+        ratio = flight["baroaltitude"].notna().mean()
+        if ratio > 0:
+            # A zero tolerance always imputes - tolerances are applied later
+            imputed = sequence_imputer(flight, 0)
+        else:
+            imputed = flight.iloc[:0]
+        altitudes = imputed["baroaltitude"].tolist()
+
+        row = {
+            "icao24": icao24,
+            "flight_label": flight_label,
+            "presence_ratio": ratio,
+            "points_raw": len(flight),
+            "points": len(altitudes),
+            "altitude_min": min(altitudes, default=np.nan),
+            "altitude_max": max(altitudes, default=np.nan),
+        }
+        for k, (min_thresh, max_thresh) in enumerate(pairs):
+            diffs = np.diff(spike_smoother(list(altitudes), min_thresh, max_thresh))
+            row["max_climb_{}".format(k)] = diffs.max() if len(diffs) else np.nan
+            row["max_descent_{}".format(k)] = diffs.min() if len(diffs) else np.nan
+        rows.append(row)
+        if keep_flights:
+            flights.append(imputed)
+
+    return pd.DataFrame(rows), flights
+
+
+def flight_outcomes(
+    stats: pd.DataFrame, configs: pd.DataFrame, pair_index: np.ndarray
+) -> np.ndarray:
+    """Works out whether each flight is kept under each configuration, or which stage rejects it.
+
+    Parameters
+    ----------
+    stats : pd.DataFrame
+        Flight statistics, as from flight_statistics
+    configs : pd.DataFrame
+        Configurations, as from configuration_grid
+    pair_index : np.ndarray
+        Index of each configuration's smoothing pair, as from smoothing_pairs
+
+    Returns
+    -------
+    np.ndarray
+        (configurations, flights) array of KEPT or REJECTED_* codes
+    """
+
+    def column(name):
+        return configs[name].values[:, None]
+
+    pair_count = pair_index.max() + 1
+    climbs = stats[["max_climb_{}".format(k) for k in range(pair_count)]].values
+    descents = stats[["max_descent_{}".format(k) for k in range(pair_count)]].values
+
+    imputed = stats["presence_ratio"].values[None, :] >= column("impute_tolerance")
+    in_range = (stats["altitude_min"].values[None, :] > column("altitude_min")) & (
+        stats["altitude_max"].values[None, :] < column("altitude_max")
+    )
+    # Comparisons with NaN (flights with fewer than two points) are False, so
+    # these are rejected just as check_trajectory_altitude does
+    valid = (
+        climbs[:, pair_index].T
+        <= column("invalid_max_threshold") + column("invalid_tolerance")
+    ) & (
+        descents[:, pair_index].T
+        >= column("invalid_min_threshold") - column("invalid_tolerance")
+    )
+
+    return np.select(
+        [~imputed, ~in_range, ~valid],
+        [REJECTED_IMPUTATION, REJECTED_ALTITUDE, REJECTED_INVALID],
+        KEPT,
+    )
+
+
+def evaluate_configurations(stats: pd.DataFrame, configs: pd.DataFrame) -> pd.DataFrame:
+    """Summarises the flights and points each configuration keeps, and why flights are rejected.
+
+    Parameters
+    ----------
+    stats : pd.DataFrame
+        Flight statistics for every flight, as from flight_statistics
+    configs : pd.DataFrame
+        Configurations, as from configuration_grid
+
+    Returns
+    -------
+    pd.DataFrame
+        The configurations, with yield and rejection counts added
+    """
+    _, pair_index = smoothing_pairs(configs)
+    report = configs.copy()
+    report.index.name = "config"
+    if stats.shape[0] == 0:
+        outcomes = np.zeros((configs.shape[0], 0), dtype=int)
+    else:
+        outcomes = flight_outcomes(stats, configs, pair_index)
+    kept = outcomes == KEPT
+
+    report["flights_kept"] = kept.sum(axis=1)
+    report["flight_yield"] = report["flights_kept"] / max(stats.shape[0], 1)
+    for code, name in REJECTION_NAMES.items():
+        report[name] = (outcomes == code).sum(axis=1)
+    points = stats["points"].values if stats.shape[0] else np.zeros(0)
+    report["points_kept"] = (kept * points[None, :]).sum(axis=1)
+    report["points_retained"] = report["points_kept"] / max(
+        stats["points_raw"].sum() if stats.shape[0] else 0, 1
+    )
+    return report
+
+
+def export_configuration(
+    stats: pd.DataFrame, flights: list, configs: pd.DataFrame, config: int, output_path
+):
+    """Exports the flights one configuration keeps, smoothed as the pipeline would.
+
+    Parameters
+    ----------
+    stats : pd.DataFrame
+        Flight statistics, as from flight_statistics
+    flights : list
+        Imputed flights matching the rows of stats
+    configs : pd.DataFrame
+        Configurations, as from configuration_grid
+    config : int
+        Index of the configuration to export
+    output_path : Path
+        Directory to export JSON files to
+
+    Returns
+    -------
+    int
+        Number of flights exported
+    """
+    _, pair_index = smoothing_pairs(configs)
+    outcomes = flight_outcomes(stats, configs.iloc[[config]], pair_index[[config]])[0]
+    settings = configs.iloc[config]
+    kept = [
+        invalid_trajectory_checker(
+            flights[i],
+            settings["invalid_min_threshold"],
+            settings["invalid_max_threshold"],
+            settings["invalid_tolerance"],
+        )
+        for i in np.flatnonzero(outcomes == KEPT)
+    ]
+    if kept:
+        exported = pd.concat(kept)
+        # The pipeline's groupby stages upcast integer columns (time,
+        # flight_label) to float, so match it
+        integers = exported.select_dtypes("integer").columns
+        exported[integers] = exported[integers].astype(np.float64)
+        export_flights(exported, output_path)
+    return len(kept)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Evaluates a grid of pipeline threshold configurations in a single pass, reporting the flight yield, points retained and rejection breakdown of each.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "input_path",
+        type=str,
+        help="Directory or file to process, as for opensky_extraction_pipeline.py.",
+    )
+    parser.add_argument(
+        "output_path", type=str, help="CSV file to save the sweep report to."
+    )
+    parser.add_argument(
+        "--impute_tolerance",
+        type=float,
+        nargs="+",
+        help="Imputation tolerances to try.",
+        default=[DEFAULT_IMPUTE_TOLERANCE],
+    )
+    parser.add_argument(
+        "--invalid_max_threshold",
+        type=float,
+        nargs="+",
+        help="Maximum climb thresholds (in metres/sec) to try.",
+        default=[DEFAULT_INVALID_MAX_THRESHOLD],
+    )
+    parser.add_argument(
+        "--invalid_min_threshold",
+        type=float,
+        nargs="+",
+        help="Maximum descent thresholds (in metres/sec) to try.",
+        default=[DEFAULT_INVALID_MIN_THRESHOLD],
+    )
+    parser.add_argument(
+        "--invalid_tolerance",
+        type=float,
+        nargs="+",
+        help="Invalid trajectory tolerances to try.",
+        default=[DEFAULT_INVALID_TOLERANCE],
+    )
+    parser.add_argument(
+        "--altitude_min",
+        type=float,
+        nargs="+",
+        help="Lower altitude bounds (in metres) to try.",
+        default=[DEFAULT_ALTITUDE_MIN],
+    )
+    parser.add_argument(
+        "--altitude_max",
+        type=float,
+        nargs="+",
+        help="Upper altitude bounds (in metres) to try.",
+        default=[DEFAULT_ALTITUDE_MAX],
+    )
+    parser.add_argument(
+        "--export_config",
+        type=int,
+        help="Index (the report's config column) of a configuration to export the flights of, as the pipeline would with those thresholds.",
+        default=None,
+    )
+    parser.add_argument(
+        "--export_path",
+        type=str,
+        help="Directory to export the flights of --export_config to.",
+        default=None,
+    )
+    add_input_arguments(parser)
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    metrics = metrics_from_args(args)
+    cache = None
+    if args.cache_path is not None:
+        cache = StageCache(args.cache_path, int(args.cache_max_size * 1024**2))
+
+    configs = configuration_grid(**{i: getattr(args, i) for i in THRESHOLD_COLUMNS})
+    pairs, _ = smoothing_pairs(configs)
+    print(
+        "Evaluating {} configurations ({} smoothing threshold pairs)".format(
+            configs.shape[0], len(pairs)
+        )
+    )
+
+    export = args.export_config is not None
+    if export:
+        if args.export_path is None:
+            parser.error("--export_config needs --export_path")
+        if not 0 <= args.export_config < configs.shape[0]:
+            parser.error("--export_config must be below {}".format(configs.shape[0]))
+        Path(args.export_path).mkdir(parents=True, exist_ok=True)
+
+    input_path = Path(args.input_path)
+    if input_path.is_dir():
+        paths = sorted(input_path.iterdir())
+    else:
+        paths = [input_path]
+    metrics.expect("files_processed_total", len(paths))
+
+    stats = []
+    exported = 0
+    for path in paths:
+        if input_path.is_dir():
+            print("Processing {}".format(path))
+        try:
+            input_df = run_stages(
+                path, build_preprocessing_stages(args, metrics), metrics, cache
+            )
+            if input_df.shape[0] > 0:
+                file_stats, flights = flight_statistics(input_df, pairs, export)
+                stats.append(file_stats)
+                if export:
+                    exported += export_configuration(
+                        file_stats,
+                        flights,
+                        configs,
+                        args.export_config,
+                        args.export_path,
+                    )
+        except:
+            metrics.inc("files_failed_total")
+            if not input_path.is_dir():
+                raise
+            print("Error on {}".format(path))
+            traceback.print_exc()
+        metrics.inc("files_processed_total")
+
+    stats = pd.concat(stats, ignore_index=True) if stats else pd.DataFrame()
+    report = evaluate_configurations(stats, configs)
+    report.to_csv(args.output_path)
+    print(
+        "Evaluated {} configurations against {} flights".format(
+            configs.shape[0], stats.shape[0]
+        )
+    )
+    if export:
+        print("Exported {} flights to {}".format(exported, args.export_path))
+
+    metrics.close()
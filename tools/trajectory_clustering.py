@@ -0,0 +1,484 @@
+"""
+trajectory_clustering.py
+
+A tool to pick a small, weighted set of representative trajectories from a directory of exported flights, so simulation campaigns don't spend most of their time on near-identical flights.
+
+Each flight's altitude and vertical rate profiles are resampled to a fixed length feature vector, the vectors are clustered with mini-batch k-means, and the flight closest to each cluster centre is picked to represent it, weighted by the size of its cluster. The output list can be passed to the simulator using PARAM_TRAJECTORY_LIST_FILE.
+
+The simulator doesn't know about the weights, so run the estimate command on the campaign's costs/ directory afterwards to get cost estimates for the whole set of flights.
+"""
+
+import json
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from flight_files import (
+    find_flight_files,
+    flight_list_name,
+    flight_name,
+    load_flight_json,
+)
+
+DEFAULT_PROFILE_POINTS = 32
+DEFAULT_CLUSTERS = 100
+DEFAULT_BATCH_SIZE = 1024
+DEFAULT_ITERATIONS = 200
+# Matches PARAM_RUN_SELECTION_SEED in the simulator parameters
+DEFAULT_SEED = 5431
+
+COSTS_SUFFIX = "-costs.json"
+COST_FIELDS = ["best_cost", "start_cost"]
+
+
+def flight_profile(
+    flight_json: dict, points: int = DEFAULT_PROFILE_POINTS
+) -> np.ndarray:
+    """Resamples a flight's altitude and vertical rate onto a fixed number of evenly spaced points.
+
+    Profiles are resampled against the fraction of the flight completed, so flights of different lengths and report rates can be compared directly.
+
+    Parameters
+    ----------
+    flight_json : dict
+        Flight JSON, as exported by the pipeline
+    points : int, optional
+        Number of points to resample each profile to, by default DEFAULT_PROFILE_POINTS
+
+    Returns
+    -------
+    np.ndarray
+        Altitude profile (metres) followed by vertical rate profile (metres/sec), length 2 * points
+    """
+    time = np.array([i["time"] for i in flight_json["data"]], dtype=float)
+    alt = np.array([i["baroaltitude"] for i in flight_json["data"]], dtype=float)
+    order = np.argsort(time, kind="stable")
+    time = time[order]
+    alt = alt[order]
+
+    if len(time) > 1 and time[-1] > time[0]:
+        progress = (time - time[0]) / (time[-1] - time[0])
+        vertical_rate = np.gradient(alt, time)
+    else:
+        progress = np.zeros(len(time))
+        vertical_rate = np.zeros(len(time))
+
+    grid = np.linspace(0, 1, points)
+    return np.concatenate(
+        [np.interp(grid, progress, alt), np.interp(grid, progress, vertical_rate)]
+    )
+
+
+def build_feature_matrix(
+    paths: list, points: int = DEFAULT_PROFILE_POINTS, base_path: Path = None
+) -> tuple:
+    """Builds the profile feature matrix for a list of flight files.
+
+    Files which can't be read or have no points are skipped, with a warning.
+
+    Parameters
+    ----------
+    paths : list
+        Paths to flight JSON files
+    points : int, optional
+        Number of points to resample each profile to, by default DEFAULT_PROFILE_POINTS
+    base_path : Path, optional
+        Directory the flights are in - if given, names are paths relative to it (as needed for sharded directories), otherwise filenames, by default None
+
+    Returns
+    -------
+    (list, np.ndarray)
+        The names of the flights used, and their feature vectors (one row per flight)
+    """
+    names = []
+    features = []
+    for path in paths:
+        try:
+            flight_json = load_flight_json(path)
+            if len(flight_json["data"]) == 0:
+                raise ValueError("No points in flight")
+            features.append(flight_profile(flight_json, points))
+            if base_path is None:
+                names.append(Path(path).name)
+            else:
+                names.append(flight_list_name(path, base_path))
+        except Exception as err:
+            print("Skipping {}: {}".format(path, err))
+    return names, np.array(features).reshape(len(features), 2 * points)
+
+
+def standardise_features(features: np.ndarray, points: int) -> np.ndarray:
+    """Scales the altitude and vertical rate halves of the feature matrix to unit variance.
+
+    Each half is scaled as a block, rather than per column, so the shape of a profile is kept and neither quantity dominates the distance just because of its units.
+
+    Parameters
+    ----------
+    features : np.ndarray
+        Feature matrix, as built by build_feature_matrix
+    points : int
+        Number of points per profile
+
+    Returns
+    -------
+    np.ndarray
+        Standardised feature matrix
+    """
+    scaled = features.astype(float).copy()
+    for block in [slice(0, points), slice(points, 2 * points)]:
+        values = scaled[:, block]
+        std = values.std()
+        scaled[:, block] = (values - values.mean()) / (std if std > 0 else 1)
+    return scaled
+
+
+def nearest_centres(features: np.ndarray, centres: np.ndarray) -> tuple:
+    """Finds the nearest centre to each row of the feature matrix.
+
+    Parameters
+    ----------
+    features : np.ndarray
+        Feature matrix
+    centres : np.ndarray
+        Cluster centres
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray)
+        Index of the nearest centre and squared distance to it, for each row
+    """
+    distances = (
+        (features**2).sum(axis=1)[:, None]
+        - 2 * features @ centres.T
+        + (centres**2).sum(axis=1)[None, :]
+    )
+    labels = distances.argmin(axis=1)
+    return labels, np.maximum(distances[np.arange(len(labels)), labels], 0)
+
+
+def kmeans_plus_plus(features: np.ndarray, clusters: int, rng) -> np.ndarray:
+    """Picks initial cluster centres with k-means++ seeding.
+
+    Parameters
+    ----------
+    features : np.ndarray
+        Feature matrix
+    clusters : int
+        Number of centres to pick
+    rng : np.random.Generator
+        Seeded random number generator
+
+    Returns
+    -------
+    np.ndarray
+        Initial cluster centres
+    """
+    centres = [features[rng.integers(len(features))]]
+    closest = ((features - centres[0]) ** 2).sum(axis=1)
+    for _ in range(1, clusters):
+        total = closest.sum()
+        if total == 0:
+            idx = rng.integers(len(features))
+        else:
+            idx = rng.choice(len(features), p=closest / total)
+        centres.append(features[idx])
+        closest = np.minimum(closest, ((features - features[idx]) ** 2).sum(axis=1))
+    return np.array(centres)
+
+
+def mini_batch_kmeans(
+    features: np.ndarray,
+    clusters: int,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    iterations: int = DEFAULT_ITERATIONS,
+    seed: int = DEFAULT_SEED,
+) -> np.ndarray:
+    """Clusters the feature matrix with mini-batch k-means.
+
+    Each iteration assigns a random batch of rows to their nearest centre, then moves each centre towards its assigned rows with a per-centre learning rate of 1/count, so memory and time per iteration are independent of the number of flights.
+
+    Parameters
+    ----------
+    features : np.ndarray
+        Feature matrix
+    clusters : int
+        Number of clusters
+    batch_size : int, optional
+        Rows sampled per iteration, by default DEFAULT_BATCH_SIZE
+    iterations : int, optional
+        Number of iterations, by default DEFAULT_ITERATIONS
+    seed : int, optional
+        Random seed, by default DEFAULT_SEED
+
+    Returns
+    -------
+    np.ndarray
+        Cluster centres
+    """
+    rng = np.random.default_rng(seed)
+    clusters = min(clusters, len(features))
+
+    # Seeding on a sample keeps k-means++ cheap for very large inputs
+    seed_sample = features[
+        rng.choice(len(features), min(len(features), 10 * batch_size), replace=False)
+    ]
+    centres = kmeans_plus_plus(seed_sample, clusters, rng)
+    counts = np.zeros(clusters)
+
+    for _ in range(iterations):
+        batch = features[rng.integers(len(features), size=batch_size)]
+        labels, _ = nearest_centres(batch, centres)
+        for row, label in zip(batch, labels):
+            counts[label] += 1
+            centres[label] += (row - centres[label]) / counts[label]
+
+    return centres
+
+
+def select_representatives(
+    names: list, features: np.ndarray, centres: np.ndarray
+) -> list:
+    """Picks the flight closest to each cluster centre, weighted by the share of flights in its cluster.
+
+    Parameters
+    ----------
+    names : list
+        Flight names, in feature matrix order
+    features : np.ndarray
+        Feature matrix
+    centres : np.ndarray
+        Cluster centres
+
+    Returns
+    -------
+    list
+        One dict per non-empty cluster, with the representative's name, weight, cluster id and cluster size
+    """
+    labels, distances = nearest_centres(features, centres)
+    representatives = []
+    for cluster in range(len(centres)):
+        members = np.flatnonzero(labels == cluster)
+        if len(members) == 0:
+            continue
+        closest = members[np.argmin(distances[members])]
+        representatives.append(
+            {
+                "name": names[closest],
+                "weight": len(members) / len(names),
+                "cluster": cluster,
+                "cluster_size": int(len(members)),
+            }
+        )
+    return representatives
+
+
+def load_costs(costs_path: Path, field: str = "best_cost") -> dict:
+    """Reads one cost from each -costs.json file in a simulator costs/ directory.
+
+    Parameters
+    ----------
+    costs_path : Path
+        Directory of -costs.json files, as written by log_costs
+    field : str, optional
+        'best_cost' or 'start_cost', by default 'best_cost'
+
+    Returns
+    -------
+    dict
+        Maps each file's traj_name to its cost, skipping files without a numeric cost
+    """
+    costs = {}
+    for path in sorted(Path(costs_path).glob("*" + COSTS_SUFFIX)):
+        with open(path, "r") as f:
+            metadata = json.load(f)["metadata"]
+        cost = metadata.get(field)
+        if isinstance(cost, (int, float)):
+            costs[metadata["traj_name"]] = float(cost)
+    return costs
+
+
+def trajectory_weights(trajectory_list: dict) -> dict:
+    """Maps each representative's trajectory name (as the simulator names its results) to its weight."""
+    return {
+        flight_name(i["name"]): i["weight"] for i in trajectory_list["trajectories"]
+    }
+
+
+def weighted_cost_estimate(costs: dict, trajectory_list: dict) -> float:
+    """Estimates the mean cost over all flights from the costs of the representatives.
+
+    Parameters
+    ----------
+    costs : dict
+        Maps trajectory name to its cost, as from load_costs
+    trajectory_list : dict
+        A trajectory list, as written by this tool
+
+    Returns
+    -------
+    float
+        Weighted mean cost, renormalised over the representatives present in costs
+    """
+    weights = trajectory_weights(trajectory_list)
+    total_weight = sum(weights[i] for i in costs if i in weights)
+    if total_weight == 0:
+        return float("nan")
+    return sum(costs[i] * weights[i] for i in costs if i in weights) / total_weight
+
+
+def grid_cost_estimates(costs: dict, trajectory_list: dict) -> dict:
+    """Estimates the mean cost over all flights at each grid point, from grid mode results.
+
+    Grid mode names each result {trajectory}-{grid id}.
+
+    Parameters
+    ----------
+    costs : dict
+        Maps result name to its cost, as from load_costs
+    trajectory_list : dict
+        A trajectory list, as written by this tool
+
+    Returns
+    -------
+    dict
+        Maps grid id to its weighted mean cost, as from weighted_cost_estimate
+    """
+    weights = trajectory_weights(trajectory_list)
+    grid_costs = {}
+    for name, cost in costs.items():
+        trajectory, _, grid_id = name.rpartition("-")
+        if name not in weights and trajectory in weights:
+            grid_costs.setdefault(grid_id, {})[trajectory] = cost
+    return {
+        i: weighted_cost_estimate(j, trajectory_list)
+        for i, j in sorted(grid_costs.items())
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Picks a weighted list of representative trajectories for the simulator, and estimates costs over every flight from the representatives' results.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    select_parser = subparsers.add_parser(
+        "select",
+        help="Cluster flight altitude and vertical rate profiles and write a weighted list of representatives.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    select_parser.add_argument(
+        "input_path", type=str, help="Directory of flight JSON files to cluster."
+    )
+    select_parser.add_argument(
+        "output_file", type=str, help="File to save the trajectory list JSON to."
+    )
+    select_parser.add_argument(
+        "--clusters",
+        type=int,
+        help="Number of clusters, i.e. the maximum number of representative trajectories.",
+        default=DEFAULT_CLUSTERS,
+    )
+    select_parser.add_argument(
+        "--profile_points",
+        type=int,
+        help="Number of points each altitude and vertical rate profile is resampled to.",
+        default=DEFAULT_PROFILE_POINTS,
+    )
+    select_parser.add_argument(
+        "--batch_size",
+        type=int,
+        help="Number of flights sampled per mini-batch k-means iteration.",
+        default=DEFAULT_BATCH_SIZE,
+    )
+    select_parser.add_argument(
+        "--iterations",
+        type=int,
+        help="Number of mini-batch k-means iterations.",
+        default=DEFAULT_ITERATIONS,
+    )
+    select_parser.add_argument(
+        "--seed", type=int, help="Random seed for clustering.", default=DEFAULT_SEED
+    )
+
+    estimate_parser = subparsers.add_parser(
+        "estimate",
+        help="Weight the costs of a campaign run on the representatives, to estimate the mean cost over every flight.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    estimate_parser.add_argument(
+        "trajectory_list", type=str, help="Trajectory list written by select."
+    )
+    estimate_parser.add_argument(
+        "costs_path",
+        type=str,
+        help="The campaign's costs/ directory of -costs.json files.",
+    )
+    estimate_parser.add_argument(
+        "--field",
+        type=str,
+        choices=COST_FIELDS,
+        help="Cost to estimate.",
+        default="best_cost",
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "estimate":
+        with open(args.trajectory_list, "r") as f:
+            trajectory_list = json.load(f)
+        weights = trajectory_weights(trajectory_list)
+        costs = load_costs(args.costs_path, args.field)
+        matched = [i for i in costs if i in weights]
+        grid_estimates = grid_cost_estimates(costs, trajectory_list)
+        if matched:
+            print(
+                "Weighted mean {}: {:.4f} from {} of {} representatives, covering {:.1%} of flights (unweighted mean {:.4f})".format(
+                    args.field,
+                    weighted_cost_estimate(costs, trajectory_list),
+                    len(matched),
+                    len(weights),
+                    sum(weights[i] for i in matched),
+                    np.mean([costs[i] for i in matched]),
+                )
+            )
+        for grid_id, estimate in grid_estimates.items():
+            print(
+                "Grid point {}: weighted mean {} {:.4f}".format(
+                    grid_id, args.field, estimate
+                )
+            )
+        if not matched and not grid_estimates:
+            print(
+                "No results for the listed trajectories in {}".format(args.costs_path)
+            )
+    else:
+        paths = find_flight_files(args.input_path)
+        names, features = build_feature_matrix(
+            paths, args.profile_points, args.input_path
+        )
+        print("Loaded {} flights".format(len(names)))
+        if len(names) == 0:
+            raise ValueError("No flights found in {}".format(args.input_path))
+
+        scaled = standardise_features(features, args.profile_points)
+        centres = mini_batch_kmeans(
+            scaled, args.clusters, args.batch_size, args.iterations, args.seed
+        )
+        representatives = select_representatives(names, scaled, centres)
+        print("Selected {} representative trajectories".format(len(representatives)))
+
+        output = {
+            "metadata": {
+                "source": str(args.input_path),
+                "total_trajectories": len(names),
+                "clusters": args.clusters,
+                "profile_points": args.profile_points,
+                "seed": args.seed,
+            },
+            "trajectories": representatives,
+        }
+        with open(args.output_file, "w") as f:
+            json.dump(output, f, indent=2)
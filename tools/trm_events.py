@@ -0,0 +1,604 @@
+"""
+trm_events.py
+
+Extracts an event timeline from the -TRM.json logs written by dump_logs, so questions such as "how long after the run starts is the first RA" or "RA sense and duration by strategy" can be answered without re-reading every log.
+
+Each log is walked once and reduced to the reports where something changed: an RA starting or ending for a designated intruder, the RA sense or display target rate changing, or a displayed intruder's TA code changing. Logs are read in parallel worker processes, and their events appended to an HDF5 file in PyTables table format, with indexes on trajectory, run name and event type, so queries on those select matching rows without scanning the whole table. Each run's strategy (mode, rate, cross point, attacker position and altitude deltas) is stored once in a separate runs table, which can be joined to the events on run_id.
+
+The store records the size and modification time of each log read, so it can be rerun on a growing campaign (or across several campaigns) and only reads new or rewritten logs.
+"""
+
+import os
+import json
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+TRM_SUFFIX = "-TRM.json"
+
+EVENTS_KEY = "events"
+RUNS_KEY = "runs"
+
+EVENT_TYPES = [
+    "ra_onset",
+    "ra_end",
+    "sense_change",
+    "target_rate_change",
+    "code_change",
+]
+
+# Intruder value for events which concern ownship's display, not an intruder
+OWNSHIP = -1
+
+# Logs read by each task in a worker process
+LOG_BATCH_SIZE = 16
+# Logs whose events are appended to the store at once
+WRITE_BATCH_SIZE = 512
+
+# Widths of string columns in the store - longer values can't be appended
+STRING_SIZES = {
+    "campaign": 64,
+    "trajectory": 64,
+    "run_name": 96,
+    "event": 24,
+    "file": 512,
+    "mode": 32,
+}
+
+EVENT_COLUMNS = [
+    "run_id",
+    "campaign",
+    "trajectory",
+    "run_name",
+    "report_time",
+    "event",
+    "intruder",
+    "value",
+]
+EVENT_INDEXED = ["run_id", "campaign", "trajectory", "run_name", "event"]
+
+RUN_COLUMNS = [
+    "run_id",
+    "campaign",
+    "trajectory",
+    "run_name",
+    "mode",
+    "rate",
+    "cross_point",
+    "attacker_pos",
+    "start_alt_delta",
+    "end_alt_delta",
+    "reports",
+    "start_time",
+    "end_time",
+    "file",
+    "size",
+    "mtime_ns",
+]
+RUN_INDEXED = ["run_id", "campaign", "trajectory", "run_name", "mode", "file"]
+
+
+def sense(target_rate: float) -> int:
+    """The sense of a target rate: 1 climb, -1 descend, 0 level."""
+    return int(np.sign(target_rate))
+
+
+def intruder_key(intruder: dict, index: int) -> int:
+    """Identifies an intruder in a TRM report by its id, falling back to its position in the list."""
+    intruder_id = intruder.get("id")
+    return index if intruder_id is None else int(intruder_id)
+
+
+def trm_events(content: dict) -> list:
+    """Walks a -TRM.json log, recording each report where the advisory state changed.
+
+    Intruders are tracked by their id, so intruders being added, dropped or reordered in the designation and display lists don't show up as changes. RAs are tracked for every designated intruder, by its active_ra flag (calculate_run_cost only uses the first). Event values are:
+
+    - ra_onset: the display target rate when the RA started
+    - ra_end: the RA's duration in seconds. RAs still active at the end of the log end at its last report.
+    - sense_change: the new sense of the target rate (1 climb, -1 descend, 0 level), while an RA is active
+    - target_rate_change: the new display target rate
+    - code_change: the intruder's new TACODE, as in the TRM display. Every displayed intruder's first code is recorded.
+
+    Parameters
+    ----------
+    content : dict
+        Parsed file contents
+
+    Returns
+    -------
+    list
+        (report_time, event, intruder, value) tuples, in report order. intruder is the intruder's id (or its list index, if it has none), or OWNSHIP.
+    """
+    events = []
+    ra_starts = {}
+    codes = {}
+    target_rate = None
+    current_sense = None
+    report_time = None
+    for report in content.get("run_data") or []:
+        report_time = report.get("report_time")
+        trm_report = report.get("trm_report") or {}
+        designated = (trm_report.get("designation") or {}).get("intruder") or []
+        display = trm_report.get("display") or {}
+
+        rate = display.get("target_rate")
+        if rate is not None and rate != target_rate:
+            if target_rate is not None:
+                events.append((report_time, "target_rate_change", OWNSHIP, rate))
+            target_rate = rate
+
+        designated_ids = set()
+        for i, intruder in enumerate(designated):
+            intruder_id = intruder_key(intruder, i)
+            designated_ids.add(intruder_id)
+            if intruder.get("active_ra") and intruder_id not in ra_starts:
+                ra_starts[intruder_id] = report_time
+                events.append((report_time, "ra_onset", intruder_id, target_rate))
+            elif not intruder.get("active_ra") and intruder_id in ra_starts:
+                events.append(
+                    (
+                        report_time,
+                        "ra_end",
+                        intruder_id,
+                        report_time - ra_starts.pop(intruder_id),
+                    )
+                )
+        # Intruders dropped from designation end their RA too
+        for i in [i for i in ra_starts if i not in designated_ids]:
+            events.append((report_time, "ra_end", i, report_time - ra_starts.pop(i)))
+
+        if ra_starts and target_rate is not None:
+            new_sense = sense(target_rate)
+            # The sense an RA starts with is given by its onset's target rate
+            if current_sense is not None and new_sense != current_sense:
+                events.append((report_time, "sense_change", OWNSHIP, new_sense))
+            current_sense = new_sense
+        else:
+            current_sense = None
+
+        for i, intruder in enumerate(display.get("intruder") or []):
+            intruder_id = intruder_key(intruder, i)
+            code = intruder.get("code")
+            if code is not None and codes.get(intruder_id) != code:
+                codes[intruder_id] = code
+                events.append((report_time, "code_change", intruder_id, code))
+
+    for i, start in ra_starts.items():
+        events.append((report_time, "ra_end", i, report_time - start))
+    return events
+
+
+def trm_run_row(content: dict) -> dict:
+    """Gets a log's strategy metadata and extent, for the runs table.
+
+    Parameters
+    ----------
+    content : dict
+        Parsed file contents
+
+    Returns
+    -------
+    dict
+        Run metadata, without run_id, campaign or file details
+    """
+    metadata = content.get("metadata") or {}
+    run_data = content.get("run_data") or []
+    times = [i.get("report_time") for i in run_data if i.get("report_time") is not None]
+    return {
+        "trajectory": metadata.get("traj_name"),
+        "run_name": metadata.get("run_name"),
+        "mode": metadata.get("mode"),
+        "rate": metadata.get("rate"),
+        "cross_point": metadata.get("cross_point"),
+        "attacker_pos": metadata.get("attacker_pos"),
+        "start_alt_delta": metadata.get("start_alt_delta"),
+        "end_alt_delta": metadata.get("end_alt_delta"),
+        "reports": len(run_data),
+        "start_time": min(times) if times else None,
+        "end_time": max(times) if times else None,
+    }
+
+
+def read_trm_logs(paths: list) -> list:
+    """Reads a batch of -TRM.json logs, for a worker process.
+
+    Parameters
+    ----------
+    paths : list
+        Log paths
+
+    Returns
+    -------
+    list
+        (path, run row, events) for each log, with None in place of the row and events for logs which couldn't be read
+    """
+    results = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                content = json.load(f)
+            results.append((path, trm_run_row(content), trm_events(content)))
+        except (OSError, ValueError, TypeError, AttributeError):
+            results.append((path, None, None))
+    return results
+
+
+def find_trm_logs(input_path: Path) -> list:
+    """Finds -TRM.json logs in an output directory (including its logs/ subdirectory), or returns a single log."""
+    input_path = Path(input_path)
+    if input_path.is_file():
+        return [input_path]
+    return sorted(input_path.rglob("*" + TRM_SUFFIX))
+
+
+class EventStore:
+    """An HDF5 store of TRM log events and the runs they came from.
+
+    Parameters
+    ----------
+    store_path : Path
+        HDF5 file, created if it doesn't exist
+    """
+
+    def __init__(self, store_path: Path):
+        self.store = pd.HDFStore(str(store_path), mode="a")
+        self.signatures = {}
+        self.next_run_id = 0
+        if "/" + RUNS_KEY in self.store.keys():
+            runs = self.store.select(
+                RUNS_KEY, columns=["run_id", "file", "size", "mtime_ns"]
+            )
+            for run_id, file, size, mtime_ns in runs.itertuples(index=False):
+                self.signatures[file] = (int(run_id), int(size), int(mtime_ns))
+            self.next_run_id = int(runs["run_id"].max()) + 1 if len(runs) else 0
+
+    def is_current(self, path: Path) -> bool:
+        """Checks if a log has been read since it was last modified."""
+        stat = os.stat(path)
+        signature = self.signatures.get(str(path))
+        return signature is not None and signature[1:] == (
+            stat.st_size,
+            stat.st_mtime_ns,
+        )
+
+    def remove(self, path: Path):
+        """Removes the events and run read from a log, before it is read again."""
+        signature = self.signatures.pop(str(path), None)
+        if signature is None:
+            return
+        where = "run_id == {}".format(signature[0])
+        for key in [EVENTS_KEY, RUNS_KEY]:
+            if "/" + key in self.store.keys():
+                self.store.remove(key, where=where)
+
+    def add(self, campaign: str, results: list) -> tuple:
+        """Appends the runs and events read from a batch of logs.
+
+        Parameters
+        ----------
+        campaign : str
+            Campaign the logs belong to
+        results : list
+            (path, run row, events) for each log, as from read_trm_logs
+
+        Returns
+        -------
+        tuple
+            Number of runs added and number of events added
+        """
+        runs = []
+        events = []
+        for path, row, run_events in results:
+            # A rewritten log's old events are stale even if it can't be read now
+            self.remove(path)
+            if row is None:
+                continue
+            stat = os.stat(path)
+            run_id = self.next_run_id
+            self.next_run_id += 1
+            self.signatures[str(path)] = (run_id, stat.st_size, stat.st_mtime_ns)
+            runs.append(
+                dict(
+                    row,
+                    run_id=run_id,
+                    campaign=campaign,
+                    file=str(path),
+                    size=stat.st_size,
+                    mtime_ns=stat.st_mtime_ns,
+                )
+            )
+            for report_time, event, intruder, value in run_events:
+                events.append(
+                    (
+                        run_id,
+                        campaign,
+                        row["trajectory"],
+                        row["run_name"],
+                        report_time,
+                        event,
+                        intruder,
+                        value,
+                    )
+                )
+        if runs:
+            self.append(RUNS_KEY, runs_frame(runs), RUN_INDEXED)
+        if events:
+            self.append(EVENTS_KEY, events_frame(events), EVENT_INDEXED)
+        return len(runs), len(events)
+
+    def append(self, key: str, input_df: pd.DataFrame, data_columns: list):
+        """Appends rows to a table, making the given columns queryable."""
+        self.store.append(
+            key,
+            input_df,
+            format="table",
+            data_columns=data_columns,
+            min_itemsize={i: j for i, j in STRING_SIZES.items() if i in input_df},
+            index=False,
+        )
+
+    def create_indexes(self):
+        """Builds full indexes on the queryable columns, once everything is appended."""
+        for key, columns in [(EVENTS_KEY, EVENT_INDEXED), (RUNS_KEY, RUN_INDEXED)]:
+            if "/" + key in self.store.keys():
+                self.store.create_table_index(
+                    key, columns=columns, optlevel=9, kind="full"
+                )
+
+    def close(self):
+        """Builds indexes and closes the store."""
+        self.create_indexes()
+        self.store.close()
+
+
+def runs_frame(rows: list) -> pd.DataFrame:
+    """Builds runs table rows with fixed column types, so batches append to the same table."""
+    output_df = pd.DataFrame(rows, columns=RUN_COLUMNS)
+    for column in ["campaign", "trajectory", "run_name", "mode", "file"]:
+        output_df[column] = output_df[column].fillna("").astype(str)
+    for column in ["run_id", "reports", "size", "mtime_ns"]:
+        output_df[column] = output_df[column].astype(np.int64)
+    for column in [
+        "rate",
+        "cross_point",
+        "attacker_pos",
+        "start_alt_delta",
+        "end_alt_delta",
+        "start_time",
+        "end_time",
+    ]:
+        output_df[column] = pd.to_numeric(output_df[column], errors="coerce").astype(
+            np.float64
+        )
+    return output_df
+
+
+def events_frame(rows: list) -> pd.DataFrame:
+    """Builds events table rows with fixed column types, so batches append to the same table."""
+    output_df = pd.DataFrame(rows, columns=EVENT_COLUMNS)
+    for column in ["campaign", "trajectory", "run_name", "event"]:
+        output_df[column] = output_df[column].fillna("").astype(str)
+    output_df["run_id"] = output_df["run_id"].astype(np.int64)
+    # Intruder ids can be as large as an ICAO address
+    output_df["intruder"] = output_df["intruder"].astype(np.int64)
+    for column in ["report_time", "value"]:
+        output_df[column] = pd.to_numeric(output_df[column], errors="coerce").astype(
+            np.float64
+        )
+    return output_df
+
+
+def index_trm_logs(
+    store: EventStore, input_path: Path, campaign: str = None, workers: int = 1
+) -> dict:
+    """Reads the TRM logs in an output directory which aren't already in the store, and adds their events.
+
+    Parameters
+    ----------
+    store : EventStore
+        Store to add to
+    input_path : Path
+        Simulator output directory, logs directory or single log
+    campaign : str, optional
+        Campaign name stored with each run, by default the input directory's name
+    workers : int, optional
+        Number of processes reading logs, by default 1
+
+    Returns
+    -------
+    dict
+        Counts of logs found, skipped as already read, failed, and runs and events added
+    """
+    input_path = Path(input_path)
+    if campaign is None:
+        campaign = input_path.resolve().name
+    paths = find_trm_logs(input_path)
+    pending = [i for i in paths if not store.is_current(i)]
+    counts = {
+        "logs": len(paths),
+        "skipped": len(paths) - len(pending),
+        "failed": 0,
+        "runs": 0,
+        "events": 0,
+    }
+    batches = [
+        pending[i : i + LOG_BATCH_SIZE] for i in range(0, len(pending), LOG_BATCH_SIZE)
+    ]
+
+    results = []
+
+    def write(batch_results):
+        counts["failed"] += sum(1 for i in batch_results if i[1] is None)
+        results.extend(batch_results)
+        if len(results) >= WRITE_BATCH_SIZE:
+            flush()
+
+    def flush():
+        runs, events = store.add(campaign, results)
+        counts["runs"] += runs
+        counts["events"] += events
+        results.clear()
+
+    if workers <= 1:
+        for batch in batches:
+            write(read_trm_logs(batch))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for batch_results in executor.map(read_trm_logs, batches):
+                write(batch_results)
+    flush()
+    return counts
+
+
+def query_events(
+    store_path: Path,
+    trajectory: str = None,
+    run_name: str = None,
+    event: str = None,
+    campaign: str = None,
+    with_runs: bool = False,
+) -> pd.DataFrame:
+    """Selects events from a store, using its indexes.
+
+    Parameters
+    ----------
+    store_path : Path
+        HDF5 file written by index_trm_logs
+    trajectory : str, optional
+        Only this trajectory's events, by default all
+    run_name : str, optional
+        Only this strategy's events, by default all
+    event : str, optional
+        Only events of this type, by default all
+    campaign : str, optional
+        Only this campaign's events, by default all
+    with_runs : bool, optional
+        Join each event to its run's strategy metadata, by default False
+
+    Returns
+    -------
+    pd.DataFrame
+        Matching events, in run and report order
+    """
+    conditions = []
+    for column, value in [
+        ("campaign", campaign),
+        ("trajectory", trajectory),
+        ("run_name", run_name),
+        ("event", event),
+    ]:
+        if value is not None:
+            conditions.append("{} == {!r}".format(column, value))
+    with pd.HDFStore(str(store_path), mode="r") as store:
+        if "/" + EVENTS_KEY not in store.keys():
+            return pd.DataFrame(columns=EVENT_COLUMNS)
+        output_df = store.select(EVENTS_KEY, where=conditions or None)
+        if with_runs:
+            run_ids = output_df["run_id"].unique().tolist()
+            runs = store.select(RUNS_KEY, where="run_id in {}".format(run_ids))
+            output_df = output_df.merge(
+                runs.drop(columns=["campaign", "trajectory", "run_name"]),
+                on="run_id",
+                how="left",
+            )
+    return output_df.sort_values(["run_id", "report_time"], kind="stable").reset_index(
+        drop=True
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Builds and queries an indexed event timeline from the -TRM.json logs of simulator runs.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    extract_parser = subparsers.add_parser(
+        "extract",
+        help="Add the events of TRM logs not already read to a store.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    extract_parser.add_argument("store_path", type=str, help="HDF5 event store.")
+    extract_parser.add_argument(
+        "input_paths",
+        type=str,
+        nargs="+",
+        help="Simulator output directories (or their logs/ directories) to read TRM logs from.",
+    )
+    extract_parser.add_argument(
+        "--campaign",
+        type=str,
+        help="Campaign name stored with each run, by default each input directory's name.",
+        default=None,
+    )
+    extract_parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of processes reading logs.",
+        default=os.cpu_count() or 1,
+    )
+
+    query_parser = subparsers.add_parser(
+        "query",
+        help="Print events from a store.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    query_parser.add_argument("store_path", type=str, help="HDF5 event store.")
+    query_parser.add_argument(
+        "--trajectory", type=str, help="Only this trajectory.", default=None
+    )
+    query_parser.add_argument(
+        "--run_name", type=str, help="Only this strategy.", default=None
+    )
+    query_parser.add_argument(
+        "--event", type=str, choices=EVENT_TYPES, help="Only this event.", default=None
+    )
+    query_parser.add_argument(
+        "--campaign", type=str, help="Only this campaign.", default=None
+    )
+    query_parser.add_argument(
+        "--with_runs",
+        action="store_true",
+        help="Add each run's strategy metadata to its events.",
+    )
+    query_parser.add_argument(
+        "--output_file",
+        type=str,
+        help="CSV file to write the events to, rather than printing them.",
+        default=None,
+    )
+    args = parser.parse_args()
+
+    if args.command == "extract":
+        store = EventStore(args.store_path)
+        try:
+            for input_path in args.input_paths:
+                counts = index_trm_logs(
+                    store, input_path, args.campaign, max(1, args.workers)
+                )
+                print(
+                    "{}: {logs} logs, {skipped} already read, {failed} failed, {runs} runs and {events} events added".format(
+                        input_path, **counts
+                    )
+                )
+        finally:
+            store.close()
+    else:
+        output_df = query_events(
+            args.store_path,
+            args.trajectory,
+            args.run_name,
+            args.event,
+            args.campaign,
+            args.with_runs,
+        )
+        if args.output_file is not None:
+            output_df.to_csv(args.output_file, index=False)
+        else:
+            with pd.option_context("display.max_rows", None, "display.width", None):
+                print(output_df.to_string(index=False))